@@ -9,9 +9,15 @@ import os.path
 import sys
 
 from PyQt5.QtCore import Qt, QSize, QPoint, QByteArray
-from PyQt5.QtGui import QImageReader, QMouseEvent, QResizeEvent, QKeyEvent
-from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout
+from PyQt5.QtGui import QImageReader, QMouseEvent, QResizeEvent, QKeyEvent, QCloseEvent
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QLabel, QAction
 
+from utils.ExifReader import exifThumbnail
+from utils.ImageCache import ImageCache
+from utils.ImagePrefetcher import ImagePrefetcher
+from utils.ImageRotations import ImageRotations
+from utils.MediaEntry import MediaEntry
+from utils.SimilarImages import SimilarImages, defaultPerceptualCachePath
 from widgets.QConstantRatioImage import QConstantRatioImage
 from widgets.QNoWheeleventScrollArea import QNoWheeleventScrollArea
 from widgets.mainWindow import MainWindow
@@ -34,6 +40,18 @@ class ImageSorter(MainWindow):
         self.dummyLayoutSA = QVBoxLayout()
         self.scrollArea = QNoWheeleventScrollArea()
         self.image = QConstantRatioImage(self, (ZOOM_OUT_RATIO, ZOOM_IN_RATIO))
+        self.imageCache = ImageCache(self.settings.image_cacheSize * 2**20)
+        self.prefetcher = ImagePrefetcher(self.imageCache, self)
+        self.rotations = ImageRotations(self.settings.image_rotationSidecars, self)
+        self.cacheLabel = QLabel()
+        # Path of the image displayed with its embedded thumbnail, while it's decoded in the background
+        self.placeholderPath = None
+        # Similar images of the media list, None if they aren't looked for
+        self.similar: SimilarImages | None = None
+        self.nextSimilarAction = QAction("Jump to next similar image")
+        self.groupSimilarAction = QAction("Group similar images")
+        self.image.resolutionNeeded.connect(self.loadHigherResolution)
+        self.prefetcher.imageDecoded.connect(self.placeholderDecoded)
 
         self.initUI()
         self.isActive = False
@@ -47,36 +65,212 @@ class ImageSorter(MainWindow):
         self.dummyLayoutSA.addWidget(self.scrollArea)
         self.myWidget.addWidget(self.dummyWidgetSA)
         self.image.initUI()
+        self.statusBar().addPermanentWidget(self.cacheLabel)
+        self.actionMenu.insertAction(self.nextDuplicateAction, self.nextSimilarAction)
+        self.actionMenu.insertAction(self.nextDuplicateAction, self.groupSimilarAction)
+        self.nextSimilarAction.triggered.connect(self.nextSimilar)
+        self.groupSimilarAction.triggered.connect(self.groupSimilar)
+        # Settings were restored by MainWindow.initUI
+        self.applySettings()
 
         super().adjustSplitter()
 
     def prepareMediaList(self, _triggered: bool = False, path: str = None, _matchingMime: list[QByteArray] = None):
         super().prepareMediaList(_triggered, path, QImageReader.supportedMimeTypes())
 
+    def prefetchWindow(self) -> list[MediaEntry]:
+        """
+        Images to keep decoded: the current one, then the next ones, then the previous ones
+        """
+        positions = [self.mediaListPosition]
+        positions += range(self.mediaListPosition + 1, self.mediaListPosition + 1 + self.settings.image_prefetchNext)
+        positions += range(self.mediaListPosition - 1, self.mediaListPosition - 1 - self.settings.image_prefetchPrevious, -1)
+        window = []
+        for position in positions:
+            if 0 <= position < len(self.mediaList):
+                entry = self.mediaList[position]
+                if not self.image.isMovie(entry.mime):
+                    window.append(entry)
+        return window
+
     def updateCurrentMedia(self):
         self.setFileName("None")
         self.nonexist = False
+        self.placeholderPath = None
         scrollAreaSize = (self.scrollArea.size()-QSize(50, 50)).expandedTo(QSize(50, 50))
+        self.prefetcher.setViewport(scrollAreaSize * self.devicePixelRatioF())
         if len(self.mediaList) > 0:
-            currpath = self.mediaList[self.mediaListPosition].path
+            entry = self.mediaList[self.mediaListPosition]
+            currpath = entry.path
+            mime = entry.mime
             if os.path.exists(currpath):
                 self.isActive = True
                 self.image.show()
-                if self.image.updateImage(currpath, scrollAreaSize, self.mediaList[self.mediaListPosition].mime):
+                image = None
+                if not self.image.isMovie(mime):
+                    if mime == "image/jpeg" and not self.prefetcher.isDecoded(entry):
+                        image = exifThumbnail(currpath)
+                        if image.isNull():
+                            image = None
+                        else:
+                            self.placeholderPath = currpath
+                    if image is None:
+                        image = self.prefetcher.image(entry)
+                self.prefetcher.prefetch(self.prefetchWindow())
+                self.cacheLabel.setText(self.imageCache.stats())
+                rotation = 0 if image is None else self.rotations.rotation(currpath)
+                fullSize = None if image is None else self.prefetcher.imageSize(entry)
+                if self.image.updateImage(currpath, scrollAreaSize, mime, image, fullSize, rotation):
                     self.setFileName(currpath)
                     self.image.rescale()
                     return
                 self.setFileName("File is corrupted (height or width is null)")
             else:
                 self.setFileName("File no longer exists")
+                self.prefetcher.prefetch(self.prefetchWindow())
             self.nonexist = True
+        else:
+            self.prefetcher.clear()
         self.isActive = False
         self.image.hide()
 
+    def applySettings(self):
+        self.imageCache.setBudget(self.settings.image_cacheSize * 2**20)
+        self.rotations.setSidecars(self.settings.image_rotationSidecars)
+        self.cacheLabel.setText(self.imageCache.stats())
+        cachePath = defaultPerceptualCachePath() if self.settings.indexing_cache else None
+        if not self.settings.image_similarity:
+            if self.similar is not None:
+                self.similar.stop()
+                self.similar.deleteLater()
+                self.similar = None
+                self.updateProgress()
+        elif self.similar is None:
+            self.similar = SimilarImages(self.settings.image_similarityThreshold, cachePath, self)
+            self.similar.updated.connect(self.similarImagesUpdated)
+            # The images already indexed are hashed as well
+            self.similar.add(list(self.mediaList))
+        else:
+            self.similar.cachePath = cachePath
+            self.similar.setThreshold(self.settings.image_similarityThreshold)
+
+    def loadHigherResolution(self, path: str, size: QSize = QSize()):
+        """
+        Decodes again the current image, at the viewport size if it's enough (the window grew), else at full resolution
+        """
+        if not self.isActive or self.mediaList[self.mediaListPosition].path != path:
+            return
+        if path == self.placeholderPath and size.isValid():
+            # The image being decoded in the background will replace the thumbnail
+            return
+        self.placeholderPath = None
+        entry = self.mediaList[self.mediaListPosition]
+        image = self.prefetcher.image(entry)
+        if not size.isValid() or image.width() < size.width() or image.height() < size.height():
+            logging.debug("Decoding %s at full resolution", path)
+            image = self.prefetcher.image(entry, fullResolution=True)
+        self.image.replaceImage(image)
+
+    def rotate(self, trigonometric: bool):
+        """
+        Rotates the current image, its rotation being remembered for the next times it's displayed
+        """
+        if not self.isActive or not self.image.myPixmap:
+            return
+        self.image.rotate(trigonometric)
+        self.rotations.setRotation(self.mediaList[self.mediaListPosition].path, self.image.rotation)
+
+    def placeholderDecoded(self, path: str):
+        """
+        Replaces the thumbnail of the current image by the image, once decoded in the background
+        """
+        if path != self.placeholderPath or not self.isActive or self.mediaList[self.mediaListPosition].path != path:
+            return
+        self.placeholderPath = None
+        self.image.replaceImage(self.prefetcher.image(self.mediaList[self.mediaListPosition]))
+        self.cacheLabel.setText(self.imageCache.stats())
+        # The image may have been zoomed in meanwhile
+        self.image.rescale()
+
+    def forgetMedia(self, path: str):
+        self.imageCache.invalidate(path)
+        if self.similar is not None:
+            self.similar.forget(path)
+
+    def newMediaList(self):
+        if self.similar is not None:
+            self.similar.clear()
+
+    def indexedMedia(self, entries: list[MediaEntry]):
+        if self.similar is not None:
+            self.similar.add(entries)
+
+    def similarImagesUpdated(self):
+        self.updateProgress()
+        if self.similar.isFinished():
+            self.statusBar().showMessage(f"Similar images found ({self.similar.groupCount()} groups of similar "
+                                         f"images).")
+
+    def updateProgress(self):
+        super().updateProgress()
+        if self.isActive and self.similar is not None and self.mediaListPosition < len(self.mediaList):
+            similar = len(self.similar.similar(self.mediaList.getPath(self.mediaListPosition)))
+            if similar:
+                self.progressionLabel.setText(f"{self.progressionLabel.text()} ({similar} similar)")
+
+    def nextSimilar(self):
+        """
+        Jumps to the next image in the list similar to the current one
+        """
+        if not self.isActive or self.similar is None:
+            self.statusBar().showMessage("Similar images aren't looked for (see ImageSorter settings).")
+            return
+        others = self.similar.similar(self.mediaList.getPath(self.mediaListPosition))
+        positions = sorted(self.findPositions(set(others)).values())
+        if not positions:
+            self.statusBar().showMessage("No similar image was found." if not others else
+                                         "The images similar to this one aren't in the list.")
+            return
+        # The similar images after the current one come first, so that they're all cycled through
+        following = [position for position in positions if position > self.mediaListPosition]
+        self.mediaListPosition = following[0] if following else positions[0]
+        self.statusBar().showMessage(f"Jumping to similar image {self.mediaList.getPath(self.mediaListPosition)}.")
+        self.updateProgress()
+        self.updateCurrentMedia()
+
+    def groupSimilar(self):
+        """
+        Reorders the list so that similar images follow each other, from the first one of each group
+        """
+        if not self.isActive or self.similar is None:
+            self.statusBar().showMessage("Similar images aren't looked for (see ImageSorter settings).")
+            return
+        if self.sortWorker is not None:
+            self.statusBar().showMessage("Media list is being sorted, try again once it's sorted.")
+            return
+        order = self.similar.clusterOrder(list(self.mediaList.paths()))
+        self.mediaList.reorder(order)
+        newPositions = [0] * len(order)
+        for position, oldPosition in enumerate(order):
+            newPositions[oldPosition] = position
+        # The displayed image stays the same, and hidden images go back next to the same images
+        self.mediaListPosition = newPositions[self.mediaListPosition]
+        positions = {id(hist): newPositions[hist.position] for hist in (*self.undoHistory, *self.redoHistory)
+                     if hist.entry is not None and hist.position < len(newPositions)}
+        self.undoHistory = self.repositionHistory(self.undoHistory, positions)
+        self.redoHistory = self.repositionHistory(self.redoHistory, positions)
+        self.sortedBy = None
+        self.statusBar().showMessage("Similar images grouped.")
+        self.updateProgress()
+
     def resizeEvent(self, event: QResizeEvent):
         scrollAreaSize = (self.scrollArea.size()-QSize(50, 50)).expandedTo(QSize(50, 50))
+        self.prefetcher.setViewport(scrollAreaSize * self.devicePixelRatioF())
         self.image.calcIdealFactor(scrollAreaSize)
         self.image.rescale()
+        if self.placeholderPath is not None:
+            # Decoded at the new viewport size, else the thumbnail would never be replaced
+            self.prefetcher.prefetch(self.prefetchWindow())
         event.accept()
 
     def zoom(self, factor: QPoint):
@@ -91,8 +285,18 @@ class ImageSorter(MainWindow):
 
     def copyCurrentToClipboard(self):
         self.statusBar().showMessage("Copying image to clipboard.")
+        if self.isActive and not self.image.fullResolution:
+            self.loadHigherResolution(self.mediaList[self.mediaListPosition].path)
         self.clipboard.setImage(self.image.getImage())
 
+    def closeEvent(self, a0: QCloseEvent) -> None:
+        if self.similar is not None:
+            self.similar.stop()
+        self.prefetcher.stop()
+        self.image.tiles.stop()
+        self.rotations.stop()
+        super().closeEvent(a0)
+
     def mouseMoveEvent(self, event: QMouseEvent):
         if event.buttons() & Qt.MiddleButton:
             delta = event.pos() - self.origPos
@@ -131,9 +335,11 @@ class ImageSorter(MainWindow):
         elif act == "zoomRatio":
             self.image.originalRatio()
         elif act == "rotateLeft":
-            self.image.rotate(True)
+            self.rotate(True)
         elif act == "rotateRight":
-            self.image.rotate(False)
+            self.rotate(False)
+        elif act == "nextSimilar":
+            self.nextSimilar()
         else:
             logging.error("Unsupported action from settings (%s). This should never happen", act)
         event.accept()
@@ -4,16 +4,21 @@ AsyncDirectoryIndexer
 Brings the ASyncDirectoryIndexer module
 """
 
+import collections
 import logging
 import math
 import multiprocessing
 import os
 import queue
+import threading
 import time
-from PyQt5.QtCore import QMimeDatabase, QByteArray
+from PyQt5.QtCore import QByteArray
 
 import utils.fileUtils as fsUtils
+from utils.Duplicates import DuplicateFinder, HashCache, hashFiles
+from utils.IndexCache import IndexCache, makeEntries
 from utils.MediaEntry import MediaEntry
+from utils.Settings import MimeDetection
 
 
 class AsyncDirectoryIndexer:
@@ -21,7 +26,11 @@ class AsyncDirectoryIndexer:
     Class allowing asynchronous indexing of directories
     """
     stopKeyword = "STOP"
+    # Tags hashing tasks, and their answers
+    hashKeyword = "HASH"
     prefix = "indexWorker"
+    # Partial chunks are sent anyway after this delay (in seconds), so that slow storage still streams results
+    chunkDelay = 0.1
 
     def __init__(self, threads: int = -1):
         if threads != -1:
@@ -32,41 +41,129 @@ class AsyncDirectoryIndexer:
         self.inputQueue = multiprocessing.Queue()
         self.shutdownEvent = multiprocessing.Event()
         self.indexedCount = 0
-        self.totalCount = 0
+        self.discoveredCount = multiprocessing.Value('q', 0)
+        self.pendingDirs = multiprocessing.Value('q', 0)
         self.rez = None
         self.recursive = False
-        self.folderFiles = []
-        self.mimeTypes = []
+        self.parallelDirs = False
+        self.cachePath: str | None = None
+        # Finds duplicates as files are indexed, if enabled
+        self.duplicates: DuplicateFinder | None = None
+        self.hashCachePath: str | None = None
+        self.running = False
+        self.mimeTypes: frozenset[str] = frozenset()
+        self.mimeDetection = MimeDetection.content
+        self.chunkSize = 64
+        self.pending: collections.deque[MediaEntry] = collections.deque()
+        self.enumerator: threading.Thread | None = None
+        self.enumerationDone = threading.Event()
+        # Files found by the enumerator and not sent yet, shared with the thread sending them after chunkDelay
+        self.chunk: list[tuple[str, int, float, float]] = []
+        self.chunkStart = 0.0
+        self.chunkLock = threading.Lock()
         logging.debug("Created AsyncDirectoryIndexer")
 
-    def indexWorker(self, inQueue: multiprocessing.Queue, outQueue: multiprocessing.Queue, mimeTypes: list[QByteArray], timeout: float = 0.1):
+    def indexWorker(self, inQueue: multiprocessing.Queue, outQueue: multiprocessing.Queue, mimeTypes: frozenset[str], timeout: float = 0.1):
         logging.debug("indexWorker process started")
-        db = QMimeDatabase()
+        detector = fsUtils.MimeDetector(self.mimeDetection)
+        cache = None
+        if self.cachePath is not None:
+            cache = IndexCache(self.cachePath)
+            if not cache.open():
+                cache = None
+        hashCache = None
         while not self.shutdownEvent.is_set():
             try:
                 item = inQueue.get(block=True, timeout=timeout)
-                if item != self.stopKeyword:
-                    outQueue.put(fsUtils.indexFile(item, mimeTypes, db))
             except queue.Empty:
                 continue
 
             if item == self.stopKeyword:
                 break
+            if isinstance(item, tuple) and item[0] == self.hashKeyword:
+                if hashCache is None and self.hashCachePath is not None:
+                    hashCache = HashCache(self.hashCachePath)
+                    if not hashCache.open():
+                        self.hashCachePath = None
+                        hashCache = None
+                _keyword, full, jobs = item
+                try:
+                    results = hashFiles(jobs, full, hashCache)
+                except Exception as err:
+                    # Every request is answered, the duplicate finder waiting for all of them
+                    logging.error("Unable to hash %s files: %s", len(jobs), err)
+                    results = [(job, None) for job in jobs]
+                outQueue.put((self.hashKeyword, full, results))
+            elif self.parallelDirs:
+                # Work units are directories, which may push their subdirectories back to the shared queue
+                try:
+                    self.processDirectory(item, inQueue, outQueue, mimeTypes, detector, cache)
+                finally:
+                    # Even if it failed, so that the indexing is seen as finished
+                    with self.pendingDirs.get_lock():
+                        self.pendingDirs.value -= 1
+            else:
+                # Work units are chunks of paths
+                self.indexChunk(item, outQueue, mimeTypes, detector)
+        if cache is not None:
+            cache.close()
+        if hashCache is not None:
+            hashCache.close()
         logging.debug("indexWorker process exited")
 
+    def processDirectory(self, path: str, inQueue: multiprocessing.Queue, outQueue: multiprocessing.Queue, mimeTypes: frozenset[str],
+                         detector: fsUtils.MimeDetector, cache: IndexCache | None):
+        listing = fsUtils.indexDirectory(path, detector, cache)
+        if listing is None:
+            return
+        if self.recursive:
+            # Counted before being queued, so that pendingDirs can't reach 0 while work remains
+            with self.pendingDirs.get_lock():
+                self.pendingDirs.value += len(listing.subdirs)
+            for name in listing.subdirs:
+                inQueue.put(os.path.join(listing.path, name))
+        self.addDiscovered(len(listing.files))
+        for start in range(0, len(listing.files), self.chunkSize):
+            end = min(start + self.chunkSize, len(listing.files))
+            # Sent as plain tuples, pickling them being much faster than pickling MediaEntry objects
+            outQueue.put((end - start, listing.path, listing.mediaFiles(mimeTypes, start, end)))
+
+    @staticmethod
+    def indexChunk(chunk: list[tuple[str, int, float, float]], outQueue: multiprocessing.Queue, mimeTypes: frozenset[str],
+                   detector: fsUtils.MimeDetector):
+        """
+        Answers a chunk of (path, size, mtime, ctime) with (amount of files processed, "", media found)
+        """
+        result = []
+        for path, size, mtime, ctime in chunk:
+            entry = fsUtils.indexFile(path, mimeTypes, detector, (size, mtime, ctime))
+            if entry:
+                result.append((entry.path, entry.size, entry.mtime, entry.ctime, entry.mime))
+        outQueue.put((len(chunk), "", result))
+
+    def addDiscovered(self, amount: int):
+        with self.discoveredCount.get_lock():
+            self.discoveredCount.value += amount
+
     def startProcess(self):
         for i in range(self.threads):
             multiprocessing.Process(target=self.indexWorker, name=self.prefix + str(i), args=(self.inputQueue, self.outputQueue, self.mimeTypes, 0.5)).start()
 
     def stopProcess(self, finishTasks: bool = False):
-        if not finishTasks:
-            self.emptyTasks()
-        while not self.inputQueue.empty():
-            logging.debug("waiting for indexer processes to stop")
-            time.sleep(0.5)
+        if finishTasks:
+            self.joinEnumerator()
+            while not self.inputQueue.empty():
+                logging.debug("waiting for indexer processes to stop")
+                time.sleep(0.5)
         self.shutdownEvent.set()
+        self.joinEnumerator()
         self.cleanUp()
 
+    def joinEnumerator(self):
+        if self.enumerator is not None:
+            self.enumerator.join()
+            self.enumerator = None
+
     def emptyTasks(self):
         item = True
         while item:
@@ -83,68 +180,174 @@ class AsyncDirectoryIndexer:
         self.outputQueue.close()
         self.outputQueue.join_thread()
         self.outputQueue = None
+        self.running = False
 
-    def asyncIndex(self, path: str, matchingMime: list[QByteArray], recursive=False) -> bool:
+    def asyncIndex(self, path: str, matchingMime: list[QByteArray], recursive=False, chunkSize: int = 64, parallelDirs: bool = False,
+                   mimeDetection: MimeDetection = MimeDetection.content, cachePath: str = None,
+                   duplicates: bool = False, hashCachePath: str = None) -> bool:
         if not os.path.exists(path):
             logging.warning("Unable to start indexing, the folder doesn't exist")
             return False
+        if self.isRunning():
+            logging.debug("Stopping previous indexing before starting a new one")
+            self.stopProcess()
 
         self.recursive = recursive
-        self.folderFiles: list[str] = []
+        self.chunkSize = max(chunkSize, 1)
+        # The index cache works on directories, so it requires directories as work units
+        self.parallelDirs = parallelDirs or cachePath is not None
+        self.cachePath = cachePath
+        self.duplicates = DuplicateFinder() if duplicates else None
+        self.hashCachePath = hashCachePath
+        self.pending = collections.deque()
         self.outputQueue = multiprocessing.Queue()
         self.inputQueue = multiprocessing.Queue()
         self.shutdownEvent = multiprocessing.Event()
-        self.totalCount = 0
+        self.enumerationDone = threading.Event()
+        self.discoveredCount = multiprocessing.Value('q', 0)
+        self.pendingDirs = multiprocessing.Value('q', 0)
         self.indexedCount = 0
+        self.running = True
 
-        self.mimeTypes = matchingMime
+        self.mimeTypes = fsUtils.buildMimeFilter(matchingMime)
+        self.mimeDetection = mimeDetection
+        if self.cachePath is not None:
+            # Creates the cache if needed, before workers use it concurrently
+            cache = IndexCache(self.cachePath)
+            if cache.open():
+                cache.close()
+            else:
+                self.cachePath = None
+        if self.parallelDirs:
+            self.pendingDirs.value = 1
+            self.inputQueue.put(path)
+            self.startProcess()
+            return True
+        # Workers must be forked before the enumerator thread is started
         self.startProcess()
+        self.enumerator = threading.Thread(target=self.enumerateFiles, name=self.prefix + "Enumerator", args=(path,), daemon=True)
+        self.enumerator.start()
+        return True
+
+    def enumerateFiles(self, path: str):
+        """
+        Producer stage, walks the directory tree and feeds the workers as soon as files are discovered
+        """
+        logging.debug("Enumerator thread started")
         folderList = [path]
-        while len(folderList) > 0:
+        self.chunk = []
+        flusher = threading.Thread(target=self.flushChunks, name=self.prefix + "Flusher", daemon=True)
+        flusher.start()
+        while len(folderList) > 0 and not self.shutdownEvent.is_set():
             p = folderList.pop()
-            for e in os.scandir(p):
-                pa = e.path
-                if e.is_file():
-                    self.totalCount += 1
-                    self.folderFiles.append(pa)
-                    self.inputQueue.put(pa)
-                elif self.recursive:
-                    folderList.append(pa)
+            try:
+                with os.scandir(p) as it:
+                    for e in it:
+                        if self.shutdownEvent.is_set():
+                            break
+                        if e.name.startswith("."):
+                            continue
+                        if e.is_file():
+                            try:
+                                st = e.stat()
+                            except OSError:
+                                # Most likely removed while listing its directory
+                                continue
+                            with self.chunkLock:
+                                if len(self.chunk) == 0:
+                                    self.chunkStart = time.monotonic()
+                                self.chunk.append((e.path, st.st_size, st.st_mtime, st.st_ctime))
+                                if len(self.chunk) >= self.chunkSize:
+                                    self.sendChunk()
+                        elif self.recursive and e.is_dir():
+                            folderList.append(e.path)
+            except OSError as err:
+                logging.warning("Unable to list %s: %s", p, err)
+        with self.chunkLock:
+            if len(self.chunk) > 0 and not self.shutdownEvent.is_set():
+                self.sendChunk()
+            self.enumerationDone.set()
+        flusher.join()
+        logging.debug("Enumerator thread exited, %s files discovered", self.discoveredCount.value)
+
+    def flushChunks(self):
+        """
+        Sends the partial chunk once it waited for chunkDelay, even while the enumerator is stuck listing a directory
+        """
+        while not self.enumerationDone.wait(self.chunkDelay / 2):
+            with self.chunkLock:
+                if len(self.chunk) > 0 and time.monotonic() - self.chunkStart > self.chunkDelay:
+                    self.sendChunk()
+
+    def sendChunk(self):
+        """
+        Sends the chunk to the workers, chunkLock being held
+        """
+        self.addDiscovered(len(self.chunk))
+        self.inputQueue.put(self.chunk)
+        self.chunk = []
+
+    def isRunning(self) -> bool:
+        return self.running
 
+    def isEnumerationDone(self) -> bool:
+        if self.parallelDirs:
+            return self.pendingDirs.value == 0
+        return self.enumerationDone.is_set()
+
+    def isFinished(self) -> bool:
+        return self.isEnumerationDone() and self.indexedCount >= self.discoveredCount.value and len(self.pending) == 0 \
+            and (self.duplicates is None or self.duplicates.isFinished())
+
+    def fetch(self) -> bool:
+        """
+        Moves one worker answer from the output queue to the pending entries, returns False if none was available
+        """
+        try:
+            answer = self.outputQueue.get(block=False)
+        except queue.Empty:
+            return False
+        if answer[0] == self.hashKeyword:
+            self.duplicates.addHashes(answer[1], answer[2])
+        else:
+            processed, directory, files = answer
+            entries = makeEntries(directory, files)
+            self.indexedCount += processed
+            self.pending.extend(entries)
+            if self.duplicates is not None:
+                self.duplicates.add(entries)
+        if self.duplicates is not None:
+            for full, jobs in self.duplicates.takeRequests():
+                self.inputQueue.put((self.hashKeyword, full, jobs))
         return True
 
     def get(self) -> MediaEntry | None:
-        if self.outputQueue.empty():
-            return None
-        a = self.outputQueue.get()
-        self.indexedCount += 1
-        return a
+        while len(self.pending) == 0:
+            if not self.fetch():
+                return None
+        return self.pending.popleft()
 
     def getBulk(self, maxItems: int = 5) -> list[MediaEntry] | None:
-        if self.outputQueue.empty():
-            return None
-        rez = []
-        itemCount = 0
-        while itemCount < maxItems:
-            item = self.get()
-            if item is None:
+        while len(self.pending) < maxItems:
+            if not self.fetch():
                 break
-            itemCount += 1
-            rez.append(item)
-        return rez
+        if len(self.pending) == 0:
+            return None
+        return [self.pending.popleft() for _ in range(min(maxItems, len(self.pending)))]
 
     def getBulkTimed(self, timeLimit: int = 0.5) -> list[MediaEntry] | None:
-        if self.outputQueue.empty():
-            return None
-        rez = []
-        curTime = time.monotonic()
-        finalTime = curTime + timeLimit
+        finalTime = time.monotonic() + timeLimit
         while time.monotonic() < finalTime:
-            item = self.getBulk(10)
-            if item is None:
+            if not self.fetch():
                 break
-            rez += item
+        if len(self.pending) == 0:
+            return None
+        rez = list(self.pending)
+        self.pending.clear()
         return rez
 
     def progress(self) -> tuple[int, int]:
-        return self.indexedCount, self.totalCount
+        """
+        Returns the amount of indexed files, and the amount of files discovered so far
+        """
+        return self.indexedCount, self.discoveredCount.value
@@ -0,0 +1,242 @@
+"""
+Duplicates
+
+Module finding duplicate files while indexing: files are grouped by size, files of the same size by a hash of their
+first bytes, then files with the same first bytes by a hash of their whole content.
+Hashes are cached with the size and modification time of the files, so that indexing again only hashes new or
+modified files
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+
+from PyQt5.QtCore import QStandardPaths
+
+from utils.MediaEntry import MediaEntry
+
+CURRENTHASHCACHEVERSION = 1
+# Bytes hashed to tell apart files of the same size, files up to this size being hashed completely at once
+PARTIALHASHSIZE = 64 * 1024
+HASHBUFFERSIZE = 1024 * 1024
+# Files hashed by a single worker task
+HASHCHUNKSIZE = 32
+
+# (path, size, mtime) of a file to hash
+HashJob = tuple[str, int, float]
+
+
+def defaultHashCachePath() -> str:
+    return os.path.join(QStandardPaths.writableLocation(QStandardPaths.CacheLocation), "hashes.sqlite")
+
+
+def hashFile(path: str, limit: int = None) -> bytes:
+    """
+    Returns the hash of the file content, or of its first limit bytes
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    buffer = bytearray(min(limit or HASHBUFFERSIZE, HASHBUFFERSIZE))
+    view = memoryview(buffer)
+    remaining = limit
+    with open(path, "rb", buffering=0) as file:
+        while remaining is None or remaining > 0:
+            count = file.readinto(buffer if remaining is None or remaining >= len(buffer) else view[:remaining])
+            if not count:
+                break
+            digest.update(view[:count])
+            if remaining is not None:
+                remaining -= count
+    return digest.digest()
+
+
+class HashCache:
+    """
+    SQLite-backed cache of the partial and full hashes of files, checked against their size and modification time.
+    A single cache file may be used by several processes at once
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.db: sqlite3.Connection | None = None
+
+    def open(self) -> bool:
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, timeout=30)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            version = self.db.execute("PRAGMA user_version").fetchone()[0]
+            if version != CURRENTHASHCACHEVERSION:
+                logging.info("Creating hash cache (version %s) in %s", CURRENTHASHCACHEVERSION, self.path)
+                with self.db:
+                    self.db.execute("DROP TABLE IF EXISTS hashes")
+                    self.db.execute("CREATE TABLE hashes (path TEXT PRIMARY KEY, size INTEGER NOT NULL,"
+                                    " mtime REAL NOT NULL, partial BLOB, full BLOB)")
+                    self.db.execute(f"PRAGMA user_version = {CURRENTHASHCACHEVERSION}")
+        except (sqlite3.Error, OSError) as err:
+            logging.warning("Unable to open hash cache %s: %s", self.path, err)
+            self.close()
+            return False
+        return True
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def lookup(self, job: HashJob) -> tuple[bytes | None, bytes | None]:
+        """
+        Returns the cached partial and full hashes of a file, None for those unknown or outdated
+        """
+        path, size, mtime = job
+        try:
+            row = self.db.execute("SELECT size, mtime, partial, full FROM hashes WHERE path = ?",
+                                  (os.path.abspath(path),)).fetchone()
+        except (sqlite3.Error, ValueError) as err:
+            logging.warning("Unable to read %s from hash cache: %s", path, err)
+            return None, None
+        if row is None or row[0] != size or row[1] != mtime:
+            return None, None
+        return row[2], row[3]
+
+    def store(self, hashes: list[tuple[HashJob, bytes | None, bytes | None]]):
+        try:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)",
+                                    [(os.path.abspath(path), size, mtime, partial, full)
+                                     for (path, size, mtime), partial, full in hashes])
+        except (sqlite3.Error, ValueError) as err:
+            logging.warning("Unable to store hashes in hash cache: %s", err)
+
+
+def hashFiles(jobs: list[HashJob], full: bool, cache: HashCache | None) -> list[tuple[HashJob, bytes | None]]:
+    """
+    Returns the partial or full hash of each file, None if it can't be read. Run by the indexing workers
+    """
+    results = []
+    computed = []
+    for job in jobs:
+        partial, complete = cache.lookup(job) if cache is not None else (None, None)
+        digest = complete if full else partial
+        if digest is None:
+            try:
+                digest = hashFile(job[0], None if full else PARTIALHASHSIZE)
+            except OSError as err:
+                logging.warning("Unable to hash %s: %s", job[0], err)
+                results.append((job, None))
+                continue
+            if full:
+                complete = digest
+            else:
+                partial = digest
+            computed.append((job, partial, complete))
+        results.append((job, digest))
+    if cache is not None and computed:
+        cache.store(computed)
+    return results
+
+
+class DuplicateFinder:
+    """
+    Groups the indexed files by content, handing out the hashing tasks needed as files are added.
+    Only files sharing their size with another one are hashed, and only those sharing their first bytes as well
+    are hashed completely
+    """
+    def __init__(self):
+        self.bySize: dict[int, list[HashJob]] = {}
+        self.byPartial: dict[tuple[int, bytes], list[HashJob]] = {}
+        # (size, hash) -> paths of the files with this content, shared by groupOf
+        self.byContent: dict[tuple[int, bytes], list[str]] = {}
+        self.groupOf: dict[str, list[str]] = {}
+        # (full hash, jobs) tasks to send to the workers
+        self.requests: list[tuple[bool, list[HashJob]]] = []
+        self.partialJobs: list[HashJob] = []
+        self.fullJobs: list[HashJob] = []
+        # Tasks sent and not answered yet
+        self.pending = 0
+        # Files found to be a copy of an earlier found one, since the last call to takeDuplicates
+        self.newDuplicates: list[str] = []
+
+    def add(self, entries: list[MediaEntry]):
+        for entry in entries:
+            if not entry.size:
+                # Empty files are all the same
+                continue
+            self.addJob(self.bySize, entry.size, (entry.path, entry.size, entry.mtime), self.partialJobs)
+
+    @staticmethod
+    def addJob(groups: dict, key, job: HashJob, jobs: list[HashJob]):
+        """
+        Adds a file to its group, and queues the next hash of the files of the group once there are two of them
+        """
+        group = groups.setdefault(key, [])
+        group.append(job)
+        if len(group) == 2:
+            jobs.extend(group)
+        elif len(group) > 2:
+            jobs.append(job)
+
+    def takeRequests(self) -> list[tuple[bool, list[HashJob]]]:
+        """
+        Returns the tasks to send to the workers, counting them as pending
+        """
+        for full, jobs in ((False, self.partialJobs), (True, self.fullJobs)):
+            for start in range(0, len(jobs), HASHCHUNKSIZE):
+                self.requests.append((full, jobs[start:start + HASHCHUNKSIZE]))
+            jobs.clear()
+        requests, self.requests = self.requests, []
+        self.pending += len(requests)
+        return requests
+
+    def addHashes(self, full: bool, results: list[tuple[HashJob, bytes | None]]):
+        self.pending -= 1
+        for job, digest in results:
+            if digest is None:
+                continue
+            if full:
+                self.addContent(job[0], (job[1], digest))
+            elif job[1] <= PARTIALHASHSIZE:
+                # The whole file was hashed
+                self.addContent(job[0], (job[1], digest))
+            else:
+                self.addJob(self.byPartial, (job[1], digest), job, self.fullJobs)
+
+    def addContent(self, path: str, content: tuple[int, bytes]):
+        group = self.byContent.setdefault(content, [])
+        group.append(path)
+        self.groupOf[path] = group
+        if len(group) > 1:
+            self.newDuplicates.append(path)
+
+    def takeDuplicates(self) -> list[str]:
+        duplicates, self.newDuplicates = self.newDuplicates, []
+        return duplicates
+
+    def isFinished(self) -> bool:
+        return self.pending == 0 and not self.partialJobs and not self.fullJobs
+
+    def duplicates(self, path: str) -> list[str]:
+        """
+        Returns the other files with the same content as the file, in the order they were found
+        """
+        group = self.groupOf.get(path)
+        if group is None:
+            return []
+        return [other for other in group if other != path]
+
+    def original(self, path: str) -> str:
+        """
+        Returns the first file found with the same content as the file
+        """
+        group = self.groupOf.get(path)
+        return group[0] if group else path
+
+    def forget(self, path: str):
+        """
+        Drops a file which was moved or deleted
+        """
+        group = self.groupOf.pop(path, None)
+        if group is not None:
+            group.remove(path)
+
+    def groupCount(self) -> int:
+        return sum(1 for group in self.byContent.values() if len(group) > 1)
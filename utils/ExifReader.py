@@ -0,0 +1,124 @@
+"""
+ExifReader
+
+Module reading the orientation and the embedded thumbnail of JPEG images, without decoding the images themselves
+"""
+import logging
+import struct
+
+from PyQt5.QtCore import QByteArray
+from PyQt5.QtGui import QImage, QTransform
+
+# The Exif segment is limited to 64KB, and is one of the first segments of the file
+EXIFREADSIZE = 128 * 1024
+ORIENTATIONTAG = 0x0112
+THUMBNAILOFFSETTAG = 0x0201
+THUMBNAILLENGTHTAG = 0x0202
+# Exif orientation -> (mirrored horizontally, mirrored vertically, rotated by 90° clockwise), mirroring coming first
+ORIENTATIONS = {1: (False, False, False), 2: (True, False, False), 3: (True, True, False), 4: (False, True, False),
+                5: (False, True, True), 6: (False, False, True), 7: (True, False, True), 8: (True, True, True)}
+
+
+def readExif(path: str) -> tuple[int, bytes | None]:
+    """
+    Returns the orientation of a JPEG image (1 if unknown), and its embedded thumbnail (None if there's none)
+    """
+    try:
+        with open(path, "rb") as file:
+            data = file.read(EXIFREADSIZE)
+    except OSError as err:
+        logging.debug("Unable to read %s: %s", path, err)
+        return 1, None
+    if data[:2] != b"\xff\xd8":
+        return 1, None
+    pos = 2
+    while pos + 4 <= len(data) and data[pos] == 0xFF:
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Fill byte
+            pos += 1
+            continue
+        if marker in (0xD9, 0xDA):
+            # End of image or start of the image data, no Exif segment
+            break
+        length = int.from_bytes(data[pos + 2:pos + 4], "big")
+        if marker == 0xE1 and data[pos + 4:pos + 10] == b"Exif\0\0":
+            return parseTiff(data[pos + 10:pos + 2 + length])
+        pos += 2 + length
+    return 1, None
+
+
+def parseTiff(tiff: bytes) -> tuple[int, bytes | None]:
+    """
+    Reads the orientation in the first IFD of the Exif TIFF structure, and the thumbnail described by the second one
+    """
+    orientation = 1
+    thumbnail = None
+    if tiff[:2] == b"II":
+        order = "<"
+    elif tiff[:2] == b"MM":
+        order = ">"
+    else:
+        return orientation, thumbnail
+    try:
+        ifd0 = readIfd(tiff, order, struct.unpack_from(order + "I", tiff, 4)[0])
+        if ifd0 is None:
+            return orientation, thumbnail
+        entries, nextIfd = ifd0
+        if ORIENTATIONTAG in entries:
+            orientation = entries[ORIENTATIONTAG]
+        ifd1 = readIfd(tiff, order, nextIfd)
+        if ifd1 is not None and THUMBNAILOFFSETTAG in ifd1[0] and THUMBNAILLENGTHTAG in ifd1[0]:
+            start = ifd1[0][THUMBNAILOFFSETTAG]
+            data = tiff[start:start + ifd1[0][THUMBNAILLENGTHTAG]]
+            if data[:2] == b"\xff\xd8":
+                thumbnail = data
+    except struct.error:
+        logging.debug("Truncated Exif data")
+    if orientation not in ORIENTATIONS:
+        orientation = 1
+    return orientation, thumbnail
+
+
+def readIfd(tiff: bytes, order: str, offset: int) -> tuple[dict[int, int], int] | None:
+    """
+    Returns the integer values of an IFD, and the offset of the next one
+    """
+    if offset == 0 or offset + 2 > len(tiff):
+        return None
+    count = struct.unpack_from(order + "H", tiff, offset)[0]
+    entries = {}
+    for i in range(count):
+        tag, valueType, _count = struct.unpack_from(order + "HHI", tiff, offset + 2 + 12 * i)
+        if valueType == 3:
+            # SHORT
+            entries[tag] = struct.unpack_from(order + "H", tiff, offset + 2 + 12 * i + 8)[0]
+        elif valueType == 4:
+            # LONG
+            entries[tag] = struct.unpack_from(order + "I", tiff, offset + 2 + 12 * i + 8)[0]
+    return entries, struct.unpack_from(order + "I", tiff, offset + 2 + 12 * count)[0]
+
+
+def orientImage(image: QImage, orientation: int) -> QImage:
+    """
+    Returns the image as it should be displayed, given its Exif orientation
+    """
+    horizontal, vertical, rotated = ORIENTATIONS.get(orientation, ORIENTATIONS[1])
+    if horizontal or vertical:
+        image = image.mirrored(horizontal, vertical)
+    if rotated:
+        image = image.transformed(QTransform().rotate(90))
+    return image
+
+
+def exifThumbnail(path: str) -> QImage:
+    """
+    Returns the embedded thumbnail of a JPEG image, oriented as the image should be displayed, or a null image
+    """
+    orientation, data = readExif(path)
+    if data is None:
+        return QImage()
+    image = QImage.fromData(QByteArray(data), "JPEG")
+    if image.isNull():
+        return image
+    return orientImage(image, orientation)
@@ -0,0 +1,162 @@
+"""
+FileOperations
+
+Module providing a queue of file operations (move, copy, delete) run in a thread pool, so that sorting never waits
+for the file system
+"""
+import logging
+import os
+import shutil
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, QCoreApplication, pyqtSignal
+
+from utils import fileUtils as fsUtils
+from utils.MediaEntry import MediaEntry
+from utils.MediaList import MediaList
+from utils.OperationJournal import OperationJournal
+from utils.UndoRedo import HistoryEntry
+
+# Destination of deleted files, which all go to the trash
+TRASH = "trash"
+
+
+class FileOperation:
+    """
+    Describes a queued file operation, and the media list entry it applies to
+    """
+    def __init__(self, action: str, entry: MediaEntry, position: int, destination: str = TRASH,
+                 mediaList: MediaList = None):
+        # "move", "copy" or "delete"
+        self.action = action
+        self.entry = entry
+        self.position = position
+        self.destination = destination
+        # List the entry was removed from, it's put back there if the operation fails
+        self.mediaList = mediaList
+        # Id of the operation in the journal, None if it isn't journaled
+        self.id: int | None = None
+        self.history: HistoryEntry | None = None
+        self.error = ""
+        # How the file was moved or copied
+        self.methods: list[str] = []
+
+    def describe(self) -> str:
+        name = os.path.basename(self.entry.path)
+        if self.action == "delete":
+            return f"deleting {name}"
+        return f"{'moving' if self.action == 'move' else 'copying'} {name} to {self.destination}"
+
+
+class FileOperationSignals(QObject):
+    """
+    Signals of FileOperationTask, as QRunnable can't emit signals
+    """
+    done = pyqtSignal(object)
+
+
+class FileOperationTask(QRunnable):
+    """
+    Runs a single file operation in a thread pool
+    """
+    def __init__(self, operation: FileOperation, signals: FileOperationSignals, journal: OperationJournal = None):
+        super().__init__()
+        self.operation = operation
+        self.signals = signals
+        self.journal = journal
+
+    def started(self, path: str):
+        # The destination is known to the journal before anything is written there, to clean it up after a crash
+        if self.journal is not None and self.operation.id is not None:
+            self.journal.target(self.operation.id, path)
+
+    def run(self):
+        operation = self.operation
+        try:
+            if operation.action == "move":
+                operation.history = fsUtils.moveFile(operation.entry.path, operation.destination, operation.methods,
+                                                     self.started)
+            elif operation.action == "copy":
+                operation.history = fsUtils.copyFile(operation.entry.path, operation.destination, operation.methods,
+                                                     self.started)
+            else:
+                operation.history = fsUtils.deleteFile(operation.entry.path)
+            if operation.history is None:
+                operation.error = "source or destination doesn't exist"
+        except (OSError, shutil.Error) as err:
+            operation.error = str(err)
+        if operation.error:
+            logging.error("Failed %s: %s", operation.describe(), operation.error)
+        self.signals.done.emit(operation)
+
+
+class FileOperationQueue(QObject):
+    """
+    Runs file operations in a thread pool, in the order they were queued for a given file.
+    At most perDestination operations run at the same time for a given destination directory, so that
+    a slow destination (network share, USB drive) doesn't take all the threads, and a hard drive isn't thrashed
+    """
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(object)
+    # Amount of pending operations
+    pendingChanged = pyqtSignal(int)
+
+    def __init__(self, perDestination: int = 1, parent: QObject = None, journal: OperationJournal = None):
+        super().__init__(parent)
+        self.perDestination = perDestination
+        self.journal = journal
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(8)
+        self.signals = FileOperationSignals(self)
+        self.signals.done.connect(self.operationDone)
+        self.waiting: list[FileOperation] = []
+        self.running: list[FileOperation] = []
+
+    def __len__(self) -> int:
+        return len(self.waiting) + len(self.running)
+
+    def enqueue(self, operation: FileOperation):
+        self.waiting.append(operation)
+        self.schedule()
+        self.pendingChanged.emit(len(self))
+
+    def setPerDestination(self, perDestination: int):
+        self.perDestination = perDestination
+        self.schedule()
+
+    def schedule(self):
+        """
+        Starts the waiting operations allowed to run, in the order they were queued
+        """
+        perDestination = {}
+        for operation in self.running:
+            perDestination[operation.destination] = perDestination.get(operation.destination, 0) + 1
+        busySources = {operation.entry.path for operation in self.running}
+        waiting = []
+        for operation in self.waiting:
+            if operation.entry.path in busySources or perDestination.get(operation.destination, 0) >= self.perDestination:
+                waiting.append(operation)
+            else:
+                perDestination[operation.destination] = perDestination.get(operation.destination, 0) + 1
+                self.running.append(operation)
+                self.pool.start(FileOperationTask(operation, self.signals, self.journal))
+            # Later operations on the same file must wait for this one
+            busySources.add(operation.entry.path)
+        self.waiting = waiting
+
+    def operationDone(self, operation: FileOperation):
+        self.running.remove(operation)
+        self.schedule()
+        self.pendingChanged.emit(len(self))
+        if operation.error:
+            self.failed.emit(operation)
+        else:
+            self.finished.emit(operation)
+
+    def waitForDone(self):
+        """
+        Runs all the queued operations before returning
+        """
+        while len(self) > 0:
+            self.pool.waitForDone()
+            # Delivers the results, which starts the waiting operations
+            QCoreApplication.processEvents()
@@ -0,0 +1,102 @@
+"""
+ImageCache
+
+Module providing a memory-bounded cache of decoded images
+"""
+import logging
+from collections import OrderedDict
+
+from PyQt5.QtCore import QSize
+from PyQt5.QtGui import QImage
+
+from utils.MediaEntry import MediaEntry
+
+# (path, modification time, target width, target height), the target size being (0, 0) for a full size image.
+# Images of media entries are keyed by the modification time read when indexing, and fit in the target size
+ImageKey = tuple[str, int | float | None, int, int]
+
+
+def entryKey(entry: MediaEntry, box: QSize = QSize()) -> ImageKey:
+    """
+    Key of the image of a media entry decoded to fit in the given size, built without reading the file
+    """
+    if box.isValid() and not box.isEmpty():
+        return entry.path, entry.mtime, box.width(), box.height()
+    return entry.path, entry.mtime, 0, 0
+
+
+class ImageCache:
+    """
+    LRU cache of decoded images, evicting the least recently used ones once their total size exceeds the budget.
+    As keys hold the file modification time, an image modified on disk is never served from the cache
+    """
+    def __init__(self, budget: int):
+        # Budget in bytes
+        self.budget = budget
+        self.usedBytes = 0
+        self.images: OrderedDict[ImageKey, QImage] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key: ImageKey) -> bool:
+        return key in self.images
+
+    def __len__(self) -> int:
+        return len(self.images)
+
+    def get(self, key: ImageKey) -> QImage | None:
+        """
+        Returns the cached image and marks it as recently used, counting hits and misses
+        """
+        image = self.images.get(key)
+        if image is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.images.move_to_end(key)
+        return image
+
+    def touch(self, key: ImageKey):
+        if key in self.images:
+            self.images.move_to_end(key)
+
+    def put(self, key: ImageKey, image: QImage):
+        if image.isNull():
+            return
+        self.remove(key)
+        # Images decoded before the file was modified are useless
+        for other in [other for other in self.images if other[0] == key[0] and other[1] != key[1]]:
+            self.remove(other)
+        self.images[key] = image
+        self.usedBytes += image.sizeInBytes()
+        self.evict()
+
+    def remove(self, key: ImageKey):
+        image = self.images.pop(key, None)
+        if image is not None:
+            self.usedBytes -= image.sizeInBytes()
+
+    def evict(self):
+        while self.usedBytes > self.budget and self.images:
+            key, image = self.images.popitem(last=False)
+            self.usedBytes -= image.sizeInBytes()
+            logging.debug("Evicted %s from image cache", key[0])
+
+    def setBudget(self, budget: int):
+        self.budget = budget
+        self.evict()
+
+    def invalidate(self, path: str):
+        """
+        Forgets all the images decoded from the given path
+        """
+        for key in [key for key in self.images if key[0] == path]:
+            self.remove(key)
+
+    def clear(self):
+        self.images.clear()
+        self.usedBytes = 0
+
+    def stats(self) -> str:
+        return f"Image cache: {self.hits} hits / {self.misses} misses, {len(self.images)} images " \
+               f"({self.usedBytes / 2**20:.0f}/{self.budget / 2**20:.0f} MB)"
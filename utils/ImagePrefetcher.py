@@ -0,0 +1,190 @@
+"""
+ImagePrefetcher
+
+Module providing a background decoder for the images around the current one, so that they're displayed instantly
+"""
+import logging
+import threading
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, QSize, Qt, pyqtSignal
+from PyQt5.QtGui import QImage, QImageReader, QImageIOHandler
+
+from utils.ImageCache import ImageCache, ImageKey, entryKey
+from utils.MediaEntry import MediaEntry
+
+
+class ImageDecodeSignals(QObject):
+    """
+    Signals of ImageDecodeTask, as QRunnable can't emit signals
+    """
+    decoded = pyqtSignal(object, QImage, QSize)
+
+
+class ImageDecodeTask(QRunnable):
+    """
+    Decodes a single image in a thread pool
+    """
+    def __init__(self, key: ImageKey, signals: ImageDecodeSignals):
+        super().__init__()
+        self.key = key
+        self.signals = signals
+        self.image = QImage()
+        self.fullSize = QSize()
+        self.done = threading.Event()
+        self.setAutoDelete(False)
+
+    def run(self):
+        self.image, self.fullSize = decodeImage(self.key)
+        self.done.set()
+        self.signals.decoded.emit(self.key, self.image, self.fullSize)
+
+
+def readFullSize(reader: QImageReader) -> QSize:
+    """
+    Returns the size of the image once oriented, read from its header, or an invalid size if it can't be read
+    """
+    size = reader.size()
+    if size.isValid() and reader.transformation() & QImageIOHandler.TransformationRotate90:
+        size = size.transposed()
+    return size
+
+
+def decodeImage(key: ImageKey) -> tuple[QImage, QSize]:
+    """
+    Decodes an image, scaled down to fit in the target size of the key if it's bigger.
+    Returns the image, and its full size read from its header (invalid if it can't be read)
+    """
+    reader = QImageReader(key[0])
+    # Images are displayed as their Exif orientation says
+    reader.setAutoTransform(True)
+    fullSize = readFullSize(reader)
+    box = QSize(key[2], key[3])
+    if key[2] > 0 and fullSize.isValid() and (fullSize.width() > box.width() or fullSize.height() > box.height()):
+        # Decoding at a lower size is much faster for JPEG, as its decoder then skips part of the work (DCT scaling)
+        size = fullSize.scaled(box, Qt.KeepAspectRatio).expandedTo(QSize(1, 1))
+        # The scaled size applies before the image is rotated
+        if reader.transformation() & QImageIOHandler.TransformationRotate90:
+            size = size.transposed()
+        reader.setScaledSize(size)
+    image = reader.read()
+    if image.isNull():
+        logging.debug("Unable to decode %s: %s", key[0], reader.errorString())
+    return image, fullSize
+
+
+class ImagePrefetcher(QObject):
+    """
+    Keeps decoded the images of a window of media, decoding the missing ones in a thread pool.
+    Decoded images are stored in an ImageCache, the images of the window being the most recently used ones.
+    Images bigger than the viewport are decoded at the size they're displayed at, unless the full resolution is asked.
+    Keys are built from the media entries, and image headers are read by the decoding tasks, so that moving through
+    the list doesn't access the files of the window
+    """
+    imageDecoded = pyqtSignal(str)
+    # Amount of image sizes remembered, so that the size of decoded images is known
+    MAXKNOWNSIZES = 4096
+
+    def __init__(self, cache: ImageCache, parent: QObject = None):
+        super().__init__(parent)
+        self.cache = cache
+        self.pool = QThreadPool(self)
+        self.signals = ImageDecodeSignals(self)
+        self.signals.decoded.connect(self.decoded)
+        self.window: set[ImageKey] = set()
+        self.tasks: dict[ImageKey, ImageDecodeTask] = {}
+        self.viewport = QSize()
+        # (path, modification time) -> full size of the image
+        self.imageSizes: dict[tuple[str, int | float | None], QSize] = {}
+
+    def setViewport(self, viewport: QSize):
+        """
+        Sets the size, in device pixels, images are displayed at
+        """
+        self.viewport = viewport
+
+    def addSize(self, key: ImageKey, size: QSize):
+        if size.isValid():
+            if len(self.imageSizes) >= self.MAXKNOWNSIZES:
+                self.imageSizes.clear()
+            self.imageSizes[key[:2]] = size
+
+    def imageSize(self, entry: MediaEntry) -> QSize:
+        """
+        Returns the full size of the image once oriented, or an invalid size if it can't be read.
+        Its header is only read if it wasn't decoded yet, which only happens for the displayed image
+        """
+        size = self.imageSizes.get((entry.path, entry.mtime))
+        if size is None:
+            size = readFullSize(QImageReader(entry.path))
+            self.addSize(entryKey(entry), size)
+        return size
+
+    def keyFor(self, entry: MediaEntry, fullResolution: bool = False) -> ImageKey:
+        """
+        Key of the image as it should be decoded: fitting in the viewport, unless the full resolution is asked
+        """
+        if not self.viewport.isValid():
+            return entryKey(entry)
+        if fullResolution:
+            size = self.imageSizes.get((entry.path, entry.mtime))
+            if size is None or size.width() > self.viewport.width() or size.height() > self.viewport.height():
+                return entryKey(entry)
+            # Images fitting in the viewport are decoded at full resolution anyway
+        return entryKey(entry, self.viewport)
+
+    def prefetch(self, entries: list[MediaEntry]):
+        """
+        Sets the media to keep decoded, the first ones being decoded first
+        """
+        keys = list(map(self.keyFor, entries))
+        self.window = set(keys)
+        for key in list(self.tasks):
+            if key not in self.window and self.pool.tryTake(self.tasks[key]):
+                del self.tasks[key]
+        for priority, key in enumerate(reversed(keys)):
+            if key in self.cache:
+                self.cache.touch(key)
+            elif key not in self.tasks:
+                task = ImageDecodeTask(key, self.signals)
+                self.tasks[key] = task
+                self.pool.start(task, priority)
+
+    def isDecoded(self, entry: MediaEntry) -> bool:
+        """
+        Returns whether the image is available without decoding it
+        """
+        return self.keyFor(entry) in self.cache
+
+    def image(self, entry: MediaEntry, fullResolution: bool = False) -> QImage:
+        """
+        Returns the decoded image, decoding it right away if it isn't available yet
+        """
+        key = self.keyFor(entry, fullResolution)
+        image = self.cache.get(key)
+        if image is not None:
+            return image
+        task = self.tasks.pop(key, None)
+        if task is not None and not self.pool.tryTake(task):
+            # Already being decoded
+            task.done.wait()
+            image, size = task.image, task.fullSize
+        else:
+            image, size = decodeImage(key)
+        self.addSize(key, size)
+        self.cache.put(key, image)
+        return image
+
+    def decoded(self, key: ImageKey, image: QImage, size: QSize):
+        self.tasks.pop(key, None)
+        self.addSize(key, size)
+        if key in self.window:
+            self.cache.put(key, image)
+            self.imageDecoded.emit(key[0])
+
+    def clear(self):
+        self.prefetch([])
+
+    def stop(self):
+        self.clear()
+        self.pool.clear()
+        self.pool.waitForDone()
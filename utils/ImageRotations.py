@@ -0,0 +1,153 @@
+"""
+ImageRotations
+
+Module remembering the rotation of images, optionally saved in XMP sidecar files (as used by darktable or digiKam).
+Images being displayed as their own orientation says, rotations are relative to it, while sidecars hold the absolute
+orientation of the image
+"""
+import logging
+import os
+import re
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool
+from PyQt5.QtGui import QImageReader, QImageIOHandler
+
+# EXIF/TIFF orientation -> (mirrored horizontally, clockwise rotation applied after the mirroring)
+ORIENTATIONS = {1: (False, 0), 2: (True, 0), 3: (False, 180), 4: (True, 180),
+                5: (True, 270), 6: (False, 90), 7: (True, 90), 8: (False, 270)}
+TRANSFORMS = {transform: orientation for orientation, transform in ORIENTATIONS.items()}
+# Transformation applied by QImageReader when decoding -> EXIF/TIFF orientation
+READERORIENTATIONS = {QImageIOHandler.TransformationNone: 1, QImageIOHandler.TransformationMirror: 2,
+                      QImageIOHandler.TransformationRotate180: 3, QImageIOHandler.TransformationFlip: 4,
+                      QImageIOHandler.TransformationFlipAndRotate90: 5, QImageIOHandler.TransformationRotate90: 6,
+                      QImageIOHandler.TransformationMirrorAndRotate90: 7, QImageIOHandler.TransformationRotate270: 8}
+
+ORIENTATIONRE = re.compile(r'tiff:Orientation(?:="(\d)"|>(\d)</tiff:Orientation>)')
+DESCRIPTIONRE = re.compile(r'<rdf:Description\b')
+SIDECAR = """<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about="" xmlns:tiff="http://ns.adobe.com/tiff/1.0/" tiff:Orientation="{}"/>
+ </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>
+"""
+
+
+def sidecarPath(path: str) -> str:
+    return path + ".xmp"
+
+
+def imageOrientation(path: str) -> int:
+    """
+    Returns the orientation saved in the image itself (Exif), which is applied when it's decoded
+    """
+    return READERORIENTATIONS.get(int(QImageReader(path).transformation()), 1)
+
+
+def readSidecarRotation(path: str) -> int:
+    """
+    Returns the rotation of the image relative to its own orientation, as saved in its sidecar (0 if there's none)
+    """
+    try:
+        with open(sidecarPath(path), encoding="utf-8") as file:
+            match = ORIENTATIONRE.search(file.read())
+    except (OSError, UnicodeDecodeError):
+        return 0
+    if match is None:
+        return 0
+    orientation = int(match.group(1) or match.group(2))
+    if orientation not in ORIENTATIONS:
+        return 0
+    mirrored, rotation = ORIENTATIONS[orientation]
+    imageMirrored, imageRotation = ORIENTATIONS[imageOrientation(path)]
+    if mirrored != imageMirrored:
+        logging.debug("Ignoring orientation of %s, only rotations being supported", sidecarPath(path))
+        return 0
+    return (rotation - imageRotation) % 360
+
+
+def writeSidecarRotation(path: str, rotation: int):
+    """
+    Saves the rotation, relative to the orientation of the image, in the sidecar of the image, keeping the other
+    metadata of an existing sidecar
+    """
+    mirrored, imageRotation = ORIENTATIONS[imageOrientation(path)]
+    orientation = TRANSFORMS[(mirrored, (imageRotation + rotation) % 360)]
+    sidecar = sidecarPath(path)
+    try:
+        with open(sidecar, encoding="utf-8") as file:
+            content = file.read()
+    except FileNotFoundError:
+        content = SIDECAR.format(orientation)
+    else:
+        match = ORIENTATIONRE.search(content)
+        if match is not None:
+            group = 1 if match.group(1) is not None else 2
+            content = content[:match.start(group)] + str(orientation) + content[match.end(group):]
+        else:
+            match = DESCRIPTIONRE.search(content)
+            if match is None:
+                logging.warning("Unable to save rotation of %s, %s isn't a XMP sidecar", path, sidecar)
+                return
+            namespace = "" if "xmlns:tiff=" in content else ' xmlns:tiff="http://ns.adobe.com/tiff/1.0/"'
+            content = f'{content[:match.end()]}{namespace} tiff:Orientation="{orientation}"{content[match.end():]}'
+    # Written next to the sidecar then renamed, so that an interrupted write doesn't lose existing metadata
+    temporary = sidecar + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as file:
+        file.write(content)
+    os.replace(temporary, sidecar)
+
+
+class SidecarWriteTask(QRunnable):
+    """
+    Saves a rotation in a thread pool, so that slow storage doesn't block rotating images
+    """
+    def __init__(self, path: str, rotation: int):
+        super().__init__()
+        self.path = path
+        self.rotation = rotation
+
+    def run(self):
+        try:
+            writeSidecarRotation(self.path, self.rotation)
+        except OSError as err:
+            logging.warning("Unable to save rotation of %s: %s", self.path, err)
+
+
+class ImageRotations(QObject):
+    """
+    Remembers the rotation of the images rotated during the session.
+    When sidecars are enabled, rotations are also saved in sidecars, and read from them for the other images
+    """
+    def __init__(self, sidecars: bool = False, parent: QObject = None):
+        super().__init__(parent)
+        self.sidecars = sidecars
+        self.rotations: dict[str, int] = {}
+        # A single thread, so that successive rotations of an image are saved in order
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+
+    def rotation(self, path: str) -> int:
+        rotation = self.rotations.get(path)
+        if rotation is None:
+            rotation = readSidecarRotation(path) if self.sidecars else 0
+            if self.sidecars:
+                self.rotations[path] = rotation
+        return rotation
+
+    def setRotation(self, path: str, rotation: int):
+        if rotation == self.rotation(path):
+            return
+        self.rotations[path] = rotation
+        if self.sidecars:
+            self.pool.start(SidecarWriteTask(path, rotation))
+
+    def setSidecars(self, sidecars: bool):
+        if sidecars != self.sidecars:
+            self.sidecars = sidecars
+            # Rotations read from sidecars are left, but images never rotated must now be read again
+            self.rotations = {path: rotation for path, rotation in self.rotations.items() if rotation}
+
+    def stop(self):
+        self.pool.waitForDone()
@@ -0,0 +1,140 @@
+"""
+ImageTiles
+
+Module providing a tile decoder, so that only the visible part of a huge image is decoded when zoomed in
+"""
+import logging
+import math
+from collections import OrderedDict
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, QPoint, QRect, QRectF, QSize, pyqtSignal
+from PyQt5.QtGui import QImage, QImageReader, QImageIOHandler
+
+# Size of a tile in displayed pixels, and amount of decoded tiles kept in memory (64MB at a device pixel ratio of 1)
+TILESIZE = 256
+MAXTILES = 256
+# Images with more pixels than this are decoded by tiles when zoomed in, instead of being fully decoded
+TILEDPIXELS = 32 * 2**20
+
+# (path, scale in millionths, column, row)
+TileKey = tuple[str, int, int, int]
+
+
+def supportsTiles(path: str, fullSize: QSize) -> bool:
+    """
+    Returns whether the image is big enough to be decoded by tiles, and its format decodes a part of it efficiently.
+    Images with an Exif orientation aren't, as their parts would have to be rotated too
+    """
+    if fullSize.width() * fullSize.height() <= TILEDPIXELS:
+        return False
+    reader = QImageReader(path)
+    return reader.supportsOption(QImageIOHandler.ClipRect) \
+        and reader.transformation() == QImageIOHandler.TransformationNone
+
+
+class TileSignals(QObject):
+    """
+    Signals of TileTask, as QRunnable can't emit signals
+    """
+    decoded = pyqtSignal(object, QImage)
+
+
+class TileTask(QRunnable):
+    """
+    Decodes a row of tiles of an image at once, as decoding a part of a JPEG image still goes through all the lines
+    above it: a tile costs about as much as the whole row
+    """
+    def __init__(self, tiles: list[tuple[TileKey, QRectF]], scale: float, fullSize: QSize, pixelRatio: float,
+                 signals: TileSignals):
+        super().__init__()
+        self.tiles = tiles
+        self.scale = scale
+        self.fullSize = fullSize
+        self.pixelRatio = pixelRatio
+        self.signals = signals
+        self.setAutoDelete(False)
+
+    def run(self):
+        path = self.tiles[0][0][0]
+        area = QRectF()
+        for _key, rect in self.tiles:
+            area = area.united(rect)
+        reader = QImageReader(path)
+        sourceRect = QRectF(area.topLeft() / self.scale, area.size() / self.scale).toAlignedRect()
+        reader.setClipRect(sourceRect.intersected(QRect(QPoint(), self.fullSize)))
+        reader.setScaledSize((area.size() * self.pixelRatio).toSize())
+        image = reader.read()
+        if image.isNull():
+            logging.debug("Unable to decode tiles of %s: %s", path, reader.errorString())
+        ratio = image.width() / area.width()
+        for key, rect in self.tiles:
+            tile = QRectF((rect.topLeft() - area.topLeft()) * ratio, rect.size() * ratio).toRect()
+            self.signals.decoded.emit(key, image.copy(tile) if not image.isNull() else image)
+
+
+class TileDecoder(QObject):
+    """
+    Decodes in a thread pool the tiles of an image displayed at a given scale, and keeps the last ones in memory
+    """
+    tileReady = pyqtSignal()
+
+    def __init__(self, parent: QObject = None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.signals = TileSignals(self)
+        self.signals.decoded.connect(self.decoded)
+        self.tiles: OrderedDict[TileKey, QImage] = OrderedDict()
+        self.tasks: dict[TileKey, TileTask] = {}
+
+    def visibleTiles(self, path: str, fullSize: QSize, scale: float, area: QRectF,
+                     pixelRatio: float = 1.0) -> list[tuple[QRectF, QImage]]:
+        """
+        Returns the decoded tiles covering the area, in displayed coordinates of the image at the given scale,
+        and starts decoding the missing ones
+        """
+        scaleKey = round(scale * 1e6)
+        bounds = QRectF(0, 0, fullSize.width() * scale, fullSize.height() * scale)
+        area = area.intersected(bounds)
+        wanted = set()
+        result = []
+        if not area.isEmpty():
+            for row in range(math.floor(area.top() / TILESIZE), math.ceil(area.bottom() / TILESIZE)):
+                missing = []
+                for column in range(math.floor(area.left() / TILESIZE), math.ceil(area.right() / TILESIZE)):
+                    key = (path, scaleKey, column, row)
+                    rect = QRectF(column * TILESIZE, row * TILESIZE, TILESIZE, TILESIZE).intersected(bounds)
+                    wanted.add(key)
+                    tile = self.tiles.get(key)
+                    if tile is not None:
+                        self.tiles.move_to_end(key)
+                        result.append((rect, tile))
+                    elif key not in self.tasks:
+                        missing.append((key, rect))
+                if missing:
+                    task = TileTask(missing, scale, fullSize, pixelRatio, self.signals)
+                    for key, _rect in missing:
+                        self.tasks[key] = task
+                    self.pool.start(task)
+        self.cancel(wanted)
+        return result
+
+    def cancel(self, kept: set = frozenset()):
+        """
+        Forgets the tiles waiting to be decoded, except the given ones
+        """
+        for task in set(self.tasks.values()):
+            if not any(key in kept for key, _rect in task.tiles) and self.pool.tryTake(task):
+                for key, _rect in task.tiles:
+                    del self.tasks[key]
+
+    def decoded(self, key: TileKey, image: QImage):
+        if self.tasks.pop(key, None) is None or image.isNull():
+            return
+        self.tiles[key] = image
+        while len(self.tiles) > MAXTILES:
+            self.tiles.popitem(last=False)
+        self.tileReady.emit()
+
+    def stop(self):
+        self.cancel()
+        self.pool.waitForDone()
@@ -0,0 +1,143 @@
+"""
+IndexCache
+
+Module providing a persistent cache of directory listings, so that only modified directories are indexed again
+"""
+import logging
+import marshal
+import os
+import sqlite3
+
+from PyQt5.QtCore import QStandardPaths
+
+from utils.MediaEntry import MediaEntry
+
+CURRENTCACHEVERSION = 2
+
+
+def defaultCachePath() -> str:
+    return os.path.join(QStandardPaths.writableLocation(QStandardPaths.CacheLocation), "index.sqlite")
+
+
+# (name, size, mtime, ctime, mime) of a file
+FileRow = tuple[str, int, float, float, str]
+
+
+def makeEntries(directory: str, files: list[FileRow]) -> list[MediaEntry]:
+    """
+    Returns the entries of files of a directory, the names being full paths if the directory is empty
+    """
+    result = []
+    prefix = os.path.join(directory, "")
+    for name, size, mtime, ctime, mime in files:
+        media = MediaEntry()
+        media.path = prefix + name
+        media.mime = mime
+        media.size = size
+        media.mtime = mtime
+        media.ctime = ctime
+        result.append(media)
+    return result
+
+
+class DirectoryIndex:
+    """
+    Listing of a single directory, with the classification of all its files
+    """
+    def __init__(self, path: str, mtime: int):
+        self.path = path
+        # st_mtime_ns of the directory, taken before it was listed
+        self.mtime = mtime
+        self.files: list[FileRow] = []
+        self.subdirs: list[str] = []
+
+    def mediaFiles(self, filters: frozenset[str], start: int = 0, end: int = None) -> list[FileRow]:
+        return [file for file in self.files[start:end] if file[4] in filters]
+
+    def mediaEntries(self, filters: frozenset[str], start: int = 0, end: int = None) -> list[MediaEntry]:
+        return makeEntries(self.path, self.mediaFiles(filters, start, end))
+
+
+class IndexCache:
+    """
+    SQLite-backed cache of DirectoryIndex, keyed by the directory absolute path and checked against its mtime.
+    Each directory is a single row, its files and subdirectories being marshalled, so that a lookup is a single read.
+    A single cache file may be used by several processes at once
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.db: sqlite3.Connection | None = None
+
+    def open(self) -> bool:
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, timeout=30)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            version = self.db.execute("PRAGMA user_version").fetchone()[0]
+            if version != CURRENTCACHEVERSION:
+                logging.info("Creating index cache (version %s) in %s", CURRENTCACHEVERSION, self.path)
+                with self.db:
+                    self.db.execute("DROP TABLE IF EXISTS directories")
+                    self.db.execute("CREATE TABLE directories (path TEXT PRIMARY KEY, mtime INTEGER NOT NULL,"
+                                    " files BLOB NOT NULL, subdirs BLOB NOT NULL)")
+                    self.db.execute(f"PRAGMA user_version = {CURRENTCACHEVERSION}")
+        except (sqlite3.Error, OSError) as err:
+            logging.warning("Unable to open index cache %s: %s", self.path, err)
+            self.close()
+            return False
+        return True
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def read(self, directory: str) -> DirectoryIndex | None:
+        try:
+            row = self.db.execute("SELECT mtime, files, subdirs FROM directories WHERE path = ?",
+                                  (os.path.abspath(directory),)).fetchone()
+            if row is None:
+                return None
+            listing = DirectoryIndex(directory, row[0])
+            listing.files = marshal.loads(row[1])
+            listing.subdirs = marshal.loads(row[2])
+        except (sqlite3.Error, ValueError, EOFError, TypeError) as err:
+            logging.warning("Unable to read %s from index cache: %s", directory, err)
+            return None
+        return listing
+
+    def lookup(self, directory: str, mtime: int) -> DirectoryIndex | None:
+        """
+        Returns the cached listing of the directory, or None if it isn't cached or was modified since
+        """
+        listing = self.read(directory)
+        if listing is None or listing.mtime != mtime:
+            return None
+        return listing
+
+    def known(self, directory: str) -> dict[str, tuple[int, float, str]]:
+        """
+        Returns the cached (size, mtime, mime) of the files of a directory, even if it was modified since
+        """
+        listing = self.read(directory)
+        if listing is None:
+            return {}
+        return {name: (size, mtime, mime) for name, size, mtime, _ctime, mime in listing.files}
+
+    def store(self, listing: DirectoryIndex):
+        key = os.path.abspath(listing.path)
+        try:
+            with self.db:
+                # Subdirectories which disappeared are forgotten, along with everything below them
+                row = self.db.execute("SELECT subdirs FROM directories WHERE path = ?", (key,)).fetchone()
+                previous = set(marshal.loads(row[0])) if row is not None else set()
+                for name in previous.difference(listing.subdirs):
+                    removed = os.path.join(key, name)
+                    # "0" comes right after "/", so this range holds every path below the removed one
+                    self.db.execute("DELETE FROM directories WHERE path = ? OR (path >= ? AND path < ?)",
+                                    (removed, removed + "/", removed + "0"))
+                self.db.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)",
+                                (key, listing.mtime, marshal.dumps(listing.files), marshal.dumps(listing.subdirs)))
+        except (sqlite3.Error, ValueError, EOFError, TypeError) as err:
+            logging.warning("Unable to store %s in index cache: %s", listing.path, err)
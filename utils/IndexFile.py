@@ -0,0 +1,209 @@
+"""
+IndexFile
+
+Module providing the saved directory index format, a versioned line-based format which can be read progressively.
+
+The first line is a JSON header, each following line is either:
+- "D<TAB>directory", which sets the directory of the next files
+- "mimeId<TAB>size<TAB>mtime<TAB>ctime<TAB>name", a file of the current directory, mimeId being its mimetype position
+  in the header "mimes" list. size, mtime and ctime are empty when unknown (version 1 only had "mimeId<TAB>name")
+Tabulations, newlines and backslashes in names are escaped with a backslash.
+"""
+import json
+import logging
+import os
+import pickle
+
+from utils.MediaEntry import MediaEntry
+
+CURRENTINDEXVERSION = 2
+INDEXFORMATNAME = "MediaSorter directory index"
+PICKLEMAGIC = b"\x80"
+INDEXEXTENSION = ".msindex"
+
+
+class IndexFileError(ValueError):
+    """
+    Raised when reading an invalid index file
+    """
+
+
+def escapeName(name: str) -> str:
+    if "\\" in name or "\t" in name or "\n" in name:
+        return name.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+    return name
+
+
+def unescapeName(name: str) -> str:
+    if "\\" not in name:
+        return name
+    result = []
+    i = 0
+    while i < len(name):
+        c = name[i]
+        if c == "\\" and i + 1 < len(name):
+            i += 1
+            c = {"t": "\t", "n": "\n"}.get(name[i], name[i])
+        result.append(c)
+        i += 1
+    return "".join(result)
+
+
+def isPickleIndex(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(1) == PICKLEMAGIC
+
+
+def saveIndex(path: str, rootPath: str, mediaList: list[MediaEntry], position: int):
+    mimes: dict[str, int] = {}
+    for entry in mediaList:
+        if entry.mime not in mimes:
+            mimes[entry.mime] = len(mimes)
+    header = {"format": INDEXFORMATNAME, "version": CURRENTINDEXVERSION, "path": rootPath, "position": position,
+              "count": len(mediaList), "mimes": list(mimes)}
+    # Written next to the destination first, so that a failure never leaves a truncated index
+    tempPath = path + ".tmp"
+    with open(tempPath, "w", encoding="utf-8", errors="surrogateescape", newline="\n") as f:
+        f.write(json.dumps(header) + "\n")
+        currentDir = None
+        lines = []
+        for entry in mediaList:
+            directory, name = os.path.split(entry.path)
+            if directory != currentDir:
+                currentDir = directory
+                lines.append(f"D\t{escapeName(directory)}\n")
+            size = "" if entry.size is None else entry.size
+            mtime = "" if entry.mtime is None else repr(entry.mtime)
+            ctime = "" if entry.ctime is None else repr(entry.ctime)
+            lines.append(f"{mimes[entry.mime]}\t{size}\t{mtime}\t{ctime}\t{escapeName(name)}\n")
+            if len(lines) >= 10000:
+                f.writelines(lines)
+                lines = []
+        f.writelines(lines)
+    os.replace(tempPath, path)
+
+
+def convertedIndexPath(original: str) -> str:
+    """
+    Path of the converted index of an index saved by older versions, next to it
+    """
+    path = os.path.splitext(original)[0] + INDEXEXTENSION
+    if path == original:
+        path = os.path.splitext(original)[0] + "-converted" + INDEXEXTENSION
+    return path
+
+
+def convertPickleIndex(original: str, newPath: str):
+    """
+    Converts an index saved by older versions (pickle of (path, mediaList, position)) to the current format.
+    The original index is left untouched, raises IndexFileError if it can't be read
+    """
+    with open(original, "rb") as f:
+        try:
+            rootPath, mediaList, position = pickle.load(f)
+        except (pickle.UnpicklingError, EOFError, ValueError, TypeError, AttributeError, ImportError) as err:
+            raise IndexFileError(f"{original} isn't a valid directory index: {err}") from err
+    saveIndex(newPath, rootPath, mediaList, position)
+    logging.info("Converted pickle index %s to %s (%s entries)", original, newPath, len(mediaList))
+
+
+class IndexReader:
+    """
+    Reads an index file progressively, so that the first entries can be displayed before the whole file is read
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+        self.lineNumber = 0
+        self.rootPath = ""
+        self.position = 0
+        self.count = 0
+        self.mimes: list[str] = []
+        self.currentPrefix = ""
+        self.readCount = 0
+        self.version = CURRENTINDEXVERSION
+
+    def open(self):
+        """
+        Opens the index and validates its header, raises IndexFileError if it isn't a valid index
+        """
+        self.file = open(self.path, "r", encoding="utf-8", errors="surrogateescape", newline="\n")
+        try:
+            header = json.loads(self.file.readline())
+        except json.JSONDecodeError as err:
+            self.close()
+            raise IndexFileError(f"{self.path} isn't a directory index") from err
+        if not isinstance(header, dict) or header.get("format") != INDEXFORMATNAME:
+            self.close()
+            raise IndexFileError(f"{self.path} isn't a directory index")
+        if header.get("version", 0) > CURRENTINDEXVERSION:
+            self.close()
+            raise IndexFileError(f"{self.path} was saved by a newer version (index version {header.get('version')})")
+        try:
+            self.version = int(header["version"])
+            self.rootPath = str(header["path"])
+            self.position = int(header["position"])
+            self.count = int(header["count"])
+            self.mimes = [str(m) for m in header["mimes"]]
+        except (KeyError, TypeError, ValueError) as err:
+            self.close()
+            raise IndexFileError(f"Invalid header in {self.path}: {err}") from err
+        self.lineNumber = 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def isFinished(self) -> bool:
+        return self.file is None
+
+    def read(self, maxItems: int) -> list[MediaEntry]:
+        """
+        Reads at most maxItems entries, raises IndexFileError on invalid content. The file is closed once fully read
+        """
+        result = []
+        mimes = self.mimes
+        while len(result) < maxItems and self.file is not None:
+            line = self.file.readline()
+            if not line:
+                self.close()
+                if self.readCount != self.count:
+                    raise IndexFileError(f"{self.path} is truncated ({self.readCount} entries instead of {self.count})")
+                break
+            self.lineNumber += 1
+            kind, sep, value = line.rstrip("\n").partition("\t")
+            if not sep:
+                self.close()
+                raise IndexFileError(f"Invalid line {self.lineNumber} in {self.path}")
+            if kind == "D":
+                directory = unescapeName(value)
+                self.currentPrefix = os.path.join(directory, "") if directory else ""
+                continue
+            try:
+                mimeId = int(kind)
+                if mimeId < 0:
+                    raise IndexError(mimeId)
+                mime = mimes[mimeId]
+            except (ValueError, IndexError) as err:
+                self.close()
+                raise IndexFileError(f"Invalid mimetype on line {self.lineNumber} in {self.path}") from err
+            entry = MediaEntry()
+            entry.mime = mime
+            if self.version >= 2:
+                fields = value.split("\t", 3)
+                if len(fields) != 4:
+                    self.close()
+                    raise IndexFileError(f"Invalid line {self.lineNumber} in {self.path}")
+                size, mtime, ctime, value = fields
+                try:
+                    entry.size = int(size) if size else None
+                    entry.mtime = float(mtime) if mtime else None
+                    entry.ctime = float(ctime) if ctime else None
+                except ValueError as err:
+                    self.close()
+                    raise IndexFileError(f"Invalid file information on line {self.lineNumber} in {self.path}") from err
+            entry.path = self.currentPrefix + unescapeName(value)
+            result.append(entry)
+            self.readCount += 1
+        return result
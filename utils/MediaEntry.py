@@ -8,26 +8,50 @@ class MediaEntry:
     """
     This class represents a Media entry in the media list, common to all types of media
     """
+    __slots__ = ("path", "mime", "size", "mtime", "ctime")
+
     def __init__(self):
         self.path = None
         self.mime = None
-        self.stat: os.stat_result = None
+        # Filled from os.stat, only when needed
+        self.size: int | None = None
+        self.mtime: float | None = None
+        self.ctime: float | None = None
+
+    def __getstate__(self):
+        return self.path, self.mime, self.size, self.mtime, self.ctime
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple) and len(state) == 2:
+            # Slots state, as written by the default reduce method
+            state = state[1]
+        if isinstance(state, dict):
+            # Entries pickled by older versions, which had a __dict__ and an optional os.stat_result
+            self.__init__()
+            self.path = state.get("path")
+            self.mime = state.get("mime")
+            stat = state.get("stat")
+            if stat is not None:
+                self.size, self.mtime, self.ctime = stat.st_size, stat.st_mtime, stat.st_ctime
+            return
+        self.path, self.mime, self.size, self.mtime, self.ctime = state
 
     def __stat__(self):
-        if self.stat is None:
-            self.stat = os.stat(self.path)
+        if self.size is None or self.mtime is None or self.ctime is None:
+            stat = os.stat(self.path)
+            self.size, self.mtime, self.ctime = stat.st_size, stat.st_mtime, stat.st_ctime
 
     def getModifDate(self):
         self.__stat__()
-        return self.stat.st_mtime
+        return self.mtime
 
     def getCreatDate(self):
         self.__stat__()
-        return self.stat.st_ctime
+        return self.ctime
 
     def getSize(self) -> int:
         self.__stat__()
-        return self.stat.st_size
+        return self.size
 
     def __lt__(self, other: "MediaEntry"):
         return self.path < other.path
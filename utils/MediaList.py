@@ -0,0 +1,382 @@
+"""
+MediaList
+
+Module providing a compact, columnar storage for huge lists of MediaEntry
+"""
+import math
+import os
+from array import array
+from typing import Callable, Iterable, Iterator
+
+from utils.MediaEntry import MediaEntry
+
+DIRCOLUMN = 0
+NAMECOLUMN = 1
+MIMECOLUMN = 2
+SIZECOLUMN = 3
+MTIMECOLUMN = 4
+CTIMECOLUMN = 5
+# Entries are stored in blocks of this size, a block being split once it holds twice as many
+BLOCKSIZE = 512
+
+
+class MediaBlock:
+    """
+    Consecutive entries of a MediaList, stored as columns
+    """
+    def __init__(self, columns: list = None):
+        if columns is None:
+            # Unknown values are stored as -1 (size) or NaN (dates)
+            columns = [array('I'), [], array('H'), array('q'), array('d'), array('d')]
+        self.columns = columns
+
+    def __len__(self) -> int:
+        return len(self.columns[NAMECOLUMN])
+
+    def copy(self) -> "MediaBlock":
+        return MediaBlock([column[:] for column in self.columns])
+
+    def split(self) -> "MediaBlock":
+        """
+        Moves the second half of the entries to a new block, which is returned
+        """
+        middle = len(self) // 2
+        other = MediaBlock([column[middle:] for column in self.columns])
+        for column in self.columns:
+            del column[middle:]
+        return other
+
+
+class MediaList:
+    """
+    List of MediaEntry, stored as columns instead of objects.
+    Directories and mimetypes are stored once and referenced by id, sizes and dates are packed in arrays.
+    Columns are split in blocks, indexed by a Fenwick tree of their sizes, so that accessing, inserting or removing
+    an entry at any position is logarithmic.
+    The position of a path is found through an index of the block holding each name, built on the first lookup.
+    Entries are built on access: modifying a returned MediaEntry doesn't modify the list
+    """
+    def __init__(self, entries: Iterable[MediaEntry] = ()):
+        self.directories: list[str] = []
+        self.directoryIds: dict[str, int] = {}
+        self.mimes: list[str] = []
+        self.mimeIds: dict[str, int] = {}
+
+        self.blocks: list[MediaBlock] = [MediaBlock()]
+        # Fenwick tree of the block sizes: tree[i] is the size of the blocks (i & (i + 1)) to i
+        self.tree: list[int] = [0]
+        self.length = 0
+        # Incremented by every change other than appending entries, so that positions known by others can be checked
+        self.structureVersion = 0
+        # Block holding each name of each directory id, None until a position is looked up
+        self.pathIndex: dict[int, dict[str, MediaBlock]] | None = None
+        # Id of each block by id(), None once blocks are added or removed
+        self.blockIds: dict[int, int] | None = None
+        self.extend(entries)
+
+    def rebuildTree(self):
+        tree = [len(block) for block in self.blocks]
+        for i in range(len(tree)):
+            parent = i | (i + 1)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self.tree = tree
+        self.blockIds = None
+
+    def addToTree(self, blockId: int, delta: int):
+        while blockId < len(self.tree):
+            self.tree[blockId] += delta
+            blockId |= blockId + 1
+
+    def locate(self, index: int) -> tuple[MediaBlock, int, int]:
+        """
+        Returns the block holding the entry at the given (valid) index, the block id and the entry offset in it
+        """
+        tree = self.tree
+        blockId = 0
+        step = 1 << (len(tree).bit_length() - 1)
+        while step:
+            following = blockId + step
+            if following <= len(tree) and tree[following - 1] <= index:
+                blockId = following
+                index -= tree[following - 1]
+            step >>= 1
+        return self.blocks[blockId], blockId, index
+
+    def blockStart(self, blockId: int) -> int:
+        """
+        Returns the index of the first entry of the given block
+        """
+        start = 0
+        i = blockId - 1
+        while i >= 0:
+            start += self.tree[i]
+            i = (i & (i + 1)) - 1
+        return start
+
+    def indexBlock(self, block: MediaBlock, start: int = 0, end: int = None):
+        """
+        Records the entries of a block, between the given offsets, in the path index if it is built
+        """
+        if self.pathIndex is None:
+            return
+        for dirId, name in zip(block.columns[DIRCOLUMN][start:end], block.columns[NAMECOLUMN][start:end]):
+            names = self.pathIndex.get(dirId)
+            if names is None:
+                names = self.pathIndex[dirId] = {}
+            names[name] = block
+
+    def positionOf(self, path: str) -> int | None:
+        """
+        Returns the position of the entry with the given path, or None if it isn't in the list.
+        Only the block holding the entry is scanned, once the path index is built
+        """
+        if self.pathIndex is None:
+            self.pathIndex = {}
+            for block in self.blocks:
+                self.indexBlock(block)
+        separator = path.rfind(os.sep) + 1
+        dirId = self.directoryIds.get(path[:separator])
+        name = path[separator:]
+        block = self.pathIndex.get(dirId, {}).get(name)
+        if block is None:
+            return None
+        if self.blockIds is None:
+            self.blockIds = {id(block): blockId for blockId, block in enumerate(self.blocks)}
+        dirColumn, nameColumn = block.columns[DIRCOLUMN], block.columns[NAMECOLUMN]
+        offset = nameColumn.index(name)
+        while dirColumn[offset] != dirId:
+            offset = nameColumn.index(name, offset + 1)
+        return self.blockStart(self.blockIds[id(block)]) + offset
+
+    def columns(self) -> list:
+        """
+        Returns the whole columns, as a copy
+        """
+        result = []
+        for columnId, column in enumerate(self.blocks[0].columns):
+            values = column[:0]
+            for block in self.blocks:
+                values += block.columns[columnId]
+            result.append(values)
+        return result
+
+    def setColumns(self, columns: list):
+        self.blocks = [MediaBlock([column[start:start + BLOCKSIZE] for column in columns])
+                       for start in range(0, len(columns[NAMECOLUMN]), BLOCKSIZE)] or [MediaBlock()]
+        self.length = len(columns[NAMECOLUMN])
+        self.pathIndex = None
+        self.rebuildTree()
+
+    def columnValues(self, columnId: int) -> list:
+        values = []
+        for block in self.blocks:
+            values.extend(block.columns[columnId])
+        return values
+
+    def getValue(self, columnId: int, index: int):
+        block, _blockId, offset = self.locate(index)
+        return block.columns[columnId][offset]
+
+    def setStat(self, index: int, size: int, mtime: float, ctime: float):
+        block, _blockId, offset = self.locate(index)
+        block.columns[SIZECOLUMN][offset] = size
+        block.columns[MTIMECOLUMN][offset] = mtime
+        block.columns[CTIMECOLUMN][offset] = ctime
+
+    def copy(self) -> "MediaList":
+        result = MediaList()
+        result.directories = list(self.directories)
+        result.directoryIds = dict(self.directoryIds)
+        result.mimes = list(self.mimes)
+        result.mimeIds = dict(self.mimeIds)
+        result.blocks = [block.copy() for block in self.blocks]
+        result.tree = list(self.tree)
+        result.length = self.length
+        return result
+
+    def reorder(self, order: list[int]):
+        """
+        Reorders the list so that the entry at position order[i] moves to position i
+        """
+        reordered = []
+        for column in self.columns():
+            values = [column[i] for i in order]
+            reordered.append(array(column.typecode, values) if isinstance(column, array) else values)
+        self.setColumns(reordered)
+        self.structureVersion += 1
+
+    def getPath(self, index: int) -> str:
+        block, _blockId, offset = self.locate(index)
+        return self.directories[block.columns[DIRCOLUMN][offset]] + block.columns[NAMECOLUMN][offset]
+
+    def paths(self) -> Iterator[str]:
+        directories = self.directories
+        for block in self.blocks:
+            for dirId, name in zip(block.columns[DIRCOLUMN], block.columns[NAMECOLUMN]):
+                yield directories[dirId] + name
+
+    def directoryId(self, directory: str) -> int:
+        dirId = self.directoryIds.get(directory)
+        if dirId is None:
+            dirId = len(self.directories)
+            self.directories.append(directory)
+            self.directoryIds[directory] = dirId
+        return dirId
+
+    def mimeId(self, mime: str) -> int:
+        mimeId = self.mimeIds.get(mime)
+        if mimeId is None:
+            mimeId = len(self.mimes)
+            self.mimes.append(mime)
+            self.mimeIds[mime] = mimeId
+        return mimeId
+
+    def packEntry(self, entry: MediaEntry) -> tuple[int, str, int, int, float, float]:
+        # Directories are stored with their trailing separator, so that a path is a single concatenation
+        separator = entry.path.rfind(os.sep) + 1
+        return (self.directoryId(entry.path[:separator]), entry.path[separator:], self.mimeId(entry.mime),
+                -1 if entry.size is None else entry.size,
+                math.nan if entry.mtime is None else entry.mtime,
+                math.nan if entry.ctime is None else entry.ctime)
+
+    def buildEntry(self, block: MediaBlock, offset: int) -> MediaEntry:
+        dirColumn, nameColumn, mimeColumn, sizeColumn, mtimeColumn, ctimeColumn = block.columns
+        entry = MediaEntry()
+        entry.path = self.directories[dirColumn[offset]] + nameColumn[offset]
+        entry.mime = self.mimes[mimeColumn[offset]]
+        size = sizeColumn[offset]
+        entry.size = None if size < 0 else size
+        mtime = mtimeColumn[offset]
+        entry.mtime = None if math.isnan(mtime) else mtime
+        ctime = ctimeColumn[offset]
+        entry.ctime = None if math.isnan(ctime) else ctime
+        return entry
+
+    def __len__(self) -> int:
+        return self.length
+
+    def normalizeIndex(self, index: int) -> int:
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("MediaList index out of range")
+        return index
+
+    def __getitem__(self, index: int) -> MediaEntry:
+        block, _blockId, offset = self.locate(self.normalizeIndex(index))
+        return self.buildEntry(block, offset)
+
+    def __iter__(self) -> Iterator[MediaEntry]:
+        for block in self.blocks:
+            for offset in range(len(block)):
+                yield self.buildEntry(block, offset)
+
+    def appendBlock(self):
+        """
+        Adds an empty block at the end of the list
+        """
+        self.blocks.append(MediaBlock())
+        if self.blockIds is not None:
+            self.blockIds[id(self.blocks[-1])] = len(self.blocks) - 1
+        # The new tree node covers the blocks (i & (i + 1)) to i, the last of them being empty
+        i = len(self.tree)
+        total = 0
+        child = i - 1
+        while child >= (i & (i + 1)):
+            total += self.tree[child]
+            child = (child & (child + 1)) - 1
+        self.tree.append(total)
+
+    def append(self, entry: MediaEntry):
+        if len(self.blocks[-1]) >= BLOCKSIZE:
+            self.appendBlock()
+        for column, value in zip(self.blocks[-1].columns, self.packEntry(entry)):
+            column.append(value)
+        self.indexBlock(self.blocks[-1], len(self.blocks[-1]) - 1)
+        self.addToTree(len(self.blocks) - 1, 1)
+        self.length += 1
+
+    def extend(self, entries: Iterable[MediaEntry]):
+        packed = [self.packEntry(entry) for entry in entries]
+        if not packed:
+            return
+        values = list(zip(*packed))
+        start = 0
+        while start < len(packed):
+            if len(self.blocks[-1]) >= BLOCKSIZE:
+                self.blocks.append(MediaBlock())
+            block = self.blocks[-1]
+            offset = len(block)
+            end = start + BLOCKSIZE - offset
+            for column, columnValues in zip(block.columns, values):
+                column.extend(columnValues[start:end])
+            self.indexBlock(block, offset)
+            start = end
+        self.length += len(packed)
+        self.rebuildTree()
+
+    def __iadd__(self, entries: Iterable[MediaEntry]) -> "MediaList":
+        self.extend(entries)
+        return self
+
+    def insert(self, index: int, entry: MediaEntry):
+        index = max(0, min(index if index >= 0 else index + len(self), len(self)))
+        if index == len(self):
+            self.append(entry)
+        else:
+            block, blockId, offset = self.locate(index)
+            for column, value in zip(block.columns, self.packEntry(entry)):
+                column.insert(offset, value)
+            self.indexBlock(block, offset, offset + 1)
+            self.length += 1
+            if len(block) > 2 * BLOCKSIZE:
+                other = block.split()
+                self.blocks.insert(blockId + 1, other)
+                self.indexBlock(other)
+                self.rebuildTree()
+            else:
+                self.addToTree(blockId, 1)
+        self.structureVersion += 1
+
+    def insertMany(self, positions: list[int], entries: list[MediaEntry]):
+        """
+        Inserts each entry before the entry currently at the matching position, positions being in increasing order
+        """
+        # Inserting from the end keeps the positions of the following insertions valid
+        for position, entry in reversed(list(zip(positions, entries))):
+            self.insert(position, entry)
+
+    def pop(self, index: int = -1) -> MediaEntry:
+        block, blockId, offset = self.locate(self.normalizeIndex(index))
+        entry = self.buildEntry(block, offset)
+        if self.pathIndex is not None:
+            names = self.pathIndex[block.columns[DIRCOLUMN][offset]]
+            name = block.columns[NAMECOLUMN][offset]
+            if names.get(name) is block:
+                del names[name]
+        for column in block.columns:
+            del column[offset]
+        self.length -= 1
+        if len(block) == 0 and len(self.blocks) > 1:
+            del self.blocks[blockId]
+            self.rebuildTree()
+        else:
+            self.addToTree(blockId, -1)
+        self.structureVersion += 1
+        return entry
+
+    def clear(self):
+        self.blocks = [MediaBlock()]
+        self.tree = [0]
+        self.length = 0
+        self.pathIndex = None
+        self.blockIds = None
+        self.structureVersion += 1
+
+    def sort(self, key: Callable[[MediaEntry], object] = None, reverse: bool = False):
+        # Entries are rebuilt from the sorted objects, which also keeps stat values fetched by the key function
+        entries = list(self)
+        entries.sort(key=key, reverse=reverse)
+        self.clear()
+        self.extend(entries)
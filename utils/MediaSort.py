@@ -0,0 +1,198 @@
+"""
+MediaSort
+
+Module providing the sorting engine of the media list.
+Sort keys are computed from the MediaList columns, and the sort itself runs outside the GUI thread
+"""
+import logging
+import math
+import os
+import re
+from typing import Callable
+
+from PyQt5.QtCore import QThread, QObject
+
+from utils.MediaEntry import MediaEntry
+from utils.MediaList import MediaList, SIZECOLUMN, MTIMECOLUMN, CTIMECOLUMN
+from utils.Settings import SortMethod
+
+NATURALSPLIT = re.compile(r"(\d+)")
+
+
+def naturalKey(text: str) -> list:
+    """
+    Case-insensitive key, sorting numbers by value ("img2" comes before "img10")
+    """
+    parts: list = NATURALSPLIT.split(text.casefold())
+    parts[1::2] = map(int, parts[1::2])
+    return parts
+
+
+def isReversed(method: SortMethod) -> bool:
+    return method in (SortMethod.nameRev, SortMethod.sizeDec, SortMethod.creatDateDec, SortMethod.modifDateDec)
+
+
+def entryKey(entry: MediaEntry, method: SortMethod):
+    """
+    Sort key of a single entry, may raise OSError if its file information must be fetched
+    """
+    if method in (SortMethod.name, SortMethod.nameRev):
+        return naturalKey(entry.path)
+    if method in (SortMethod.size, SortMethod.sizeDec):
+        return entry.getSize()
+    if method in (SortMethod.creatDate, SortMethod.creatDateDec):
+        return entry.getCreatDate()
+    if method in (SortMethod.modifDate, SortMethod.modifDateDec):
+        return entry.getModifDate()
+    return 0
+
+
+def sortColumn(method: SortMethod) -> int | None:
+    """
+    Id of the MediaList column holding the sort keys of the given size/date method, None for other methods
+    """
+    if method in (SortMethod.size, SortMethod.sizeDec):
+        return SIZECOLUMN
+    if method in (SortMethod.creatDate, SortMethod.creatDateDec):
+        return CTIMECOLUMN
+    if method in (SortMethod.modifDate, SortMethod.modifDateDec):
+        return MTIMECOLUMN
+    return None
+
+
+def fillStat(mediaList: MediaList, index: int) -> bool:
+    """
+    Fetches the missing file information of an entry from the filesystem, returns False if the file can't be read
+    """
+    try:
+        stat = os.stat(mediaList.getPath(index))
+    except OSError:
+        return False
+    mediaList.setStat(index, stat.st_size, stat.st_mtime, stat.st_ctime)
+    return True
+
+
+def isUnknown(value) -> bool:
+    return value < 0 or math.isnan(value)
+
+
+def listKeys(mediaList: MediaList, method: SortMethod) -> list:
+    """
+    Sort keys of all the entries, computed from the columns.
+    Missing file information is fetched from the filesystem and stored in the list
+    """
+    if method in (SortMethod.name, SortMethod.nameRev):
+        return [naturalKey(path) for path in mediaList.paths()]
+    columnId = sortColumn(method)
+    if columnId is None:
+        return [0] * len(mediaList)
+    keys = mediaList.columnValues(columnId)
+    for i, value in enumerate(keys):
+        if isUnknown(value):
+            keys[i] = mediaList.getValue(columnId, i) if fillStat(mediaList, i) else 0
+    return keys
+
+
+def keyGetter(mediaList: MediaList, method: SortMethod) -> Callable[[int], object]:
+    """
+    Function returning the sort key of the entry at a given index, as computed by listKeys
+    """
+    if method in (SortMethod.name, SortMethod.nameRev):
+        return lambda index: naturalKey(mediaList.getPath(index))
+    columnId = sortColumn(method)
+    if columnId is None:
+        return lambda index: 0
+
+    def columnKey(index: int):
+        value = mediaList.getValue(columnId, index)
+        if isUnknown(value):
+            return mediaList.getValue(columnId, index) if fillStat(mediaList, index) else 0
+        return value
+    return columnKey
+
+
+def insertionPoint(keyAt: Callable[[int], object], key, low: int, high: int, reverse: bool = False) -> int:
+    """
+    Position in [low, high] at which an entry with the given key must be inserted to keep sorted the keys returned
+    by keyAt, after the equal ones
+    """
+    while low < high:
+        middle = (low + high) // 2
+        current = keyAt(middle)
+        if (current >= key) if reverse else (current <= key):
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def sortedPosition(mediaList: MediaList, entry: MediaEntry, method: SortMethod) -> int:
+    """
+    Position at which the entry must be inserted in a list sorted by method, -1 if its file can't be read
+    """
+    try:
+        key = entryKey(entry, method)
+    except OSError:
+        return -1
+    return insertionPoint(keyGetter(mediaList, method), key, 0, len(mediaList), isReversed(method))
+
+
+def mergeSorted(mediaList: MediaList, entries: list[MediaEntry], method: SortMethod) -> list[int]:
+    """
+    Inserts entries in a list already sorted by method, keeping it sorted.
+    Returns the final positions of the inserted entries, in increasing order
+    """
+    reverse = isReversed(method)
+    batch = MediaList(entries)
+    keys = listKeys(batch, method)
+    order = sorted(range(len(keys)), key=keys.__getitem__, reverse=reverse)
+    keyAt = keyGetter(mediaList, method)
+    positions = [0] * len(order)
+    # The middle entry of the batch is located first, which bounds the search of the entries before and after it
+    ranges = [(0, len(order), 0, len(mediaList))]
+    while ranges:
+        first, last, low, high = ranges.pop()
+        if first >= last:
+            continue
+        middle = (first + last) // 2
+        position = insertionPoint(keyAt, keys[order[middle]], low, high, reverse)
+        positions[middle] = position
+        ranges.append((first, middle, low, position))
+        ranges.append((middle + 1, last, position, high))
+    mediaList.insertMany(positions, [batch[i] for i in order])
+    return [position + i for i, position in enumerate(positions)]
+
+
+class SortWorker(QThread):
+    """
+    Sorts a copy of the media list in a separate thread.
+    Once finished, order holds the original position of each sorted entry, newPositions the sorted position of
+    each original entry, and historyPositions the position at which each of the given history entries would now be
+    inserted (-1 if unknown)
+    """
+    def __init__(self, mediaList: MediaList, method: SortMethod, historyEntries: list[MediaEntry], parent: QObject = None):
+        super().__init__(parent)
+        self.mediaList = mediaList
+        self.method = method
+        self.historyEntries = historyEntries
+        self.order: list[int] = []
+        self.newPositions: list[int] = []
+        self.historyPositions: list[int] = []
+
+    def run(self):
+        reverse = isReversed(self.method)
+        keys = listKeys(self.mediaList, self.method)
+        self.order = sorted(range(len(keys)), key=keys.__getitem__, reverse=reverse)
+        self.mediaList.reorder(self.order)
+        # Computed here rather than searching order once finished, which would scan the list in the UI thread
+        self.newPositions = [0] * len(self.order)
+        for position, oldPosition in enumerate(self.order):
+            self.newPositions[oldPosition] = position
+        sortedKeys = [keys[i] for i in self.order]
+        for entry in self.historyEntries:
+            try:
+                self.historyPositions.append(insertionPoint(sortedKeys.__getitem__, entryKey(entry, self.method),
+                                                            0, len(sortedKeys), reverse))
+            except OSError:
+                self.historyPositions.append(-1)
+        logging.debug("Sorted %s entries", len(self.order))
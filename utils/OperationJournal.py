@@ -0,0 +1,335 @@
+"""
+OperationJournal
+
+Module keeping an append-only journal of the actions of each sorting session, so that a session can be resumed,
+rolled back or replayed after the application was closed or crashed
+"""
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+from PyQt5.QtCore import QStandardPaths
+
+from utils.UndoRedo import HistoryEntry
+
+# Amount of session journals kept, older ones being removed when a session starts
+KEPTSESSIONS = 20
+JOURNALEXTENSION = ".jsonl"
+
+
+def defaultJournalDirectory() -> str:
+    return os.path.join(QStandardPaths.writableLocation(QStandardPaths.AppDataLocation), "journal")
+
+
+def historyRecord(hist: HistoryEntry | None) -> dict | None:
+    if hist is None:
+        return None
+    return {"action": hist.action, "position": hist.position, "oldPath": hist.oldPath, "newPath": hist.newPath,
+            "path": hist.entry.path if hist.entry is not None else None}
+
+
+def recordHistory(record: dict | None) -> HistoryEntry | None:
+    """
+    Returns the history entry of a record. Media entries aren't saved, as the list is indexed again when resuming
+    """
+    if record is None:
+        return None
+    return HistoryEntry(record["action"], None, record.get("position"), record.get("oldPath"), record.get("newPath"))
+
+
+def writeRecords(path: str, records: list[dict]):
+    """
+    Appends records to a journal which isn't being written by a session, and waits for them to be on disk
+    """
+    with open(path, "a", encoding="utf-8") as file:
+        file.write("".join(json.dumps(record) + "\n" for record in records))
+        file.flush()
+        os.fsync(file.fileno())
+
+
+class SessionJournal:
+    """
+    Content of the journal of a session, as replayed from its records
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.root: str | None = None
+        self.started = 0.0
+        # False if the application closed or crashed before the end of the session
+        self.ended = False
+        self.undoHistory: list[HistoryEntry] = []
+        self.redoHistory: list[HistoryEntry] = []
+        # Operation id -> begin record (with the target path, once known) of operations never done nor failed
+        self.unfinished: dict[int, dict] = {}
+        self.lastId = -1
+
+    def read(self):
+        """
+        Replays the records of the journal. A truncated last record (crash while writing it) is ignored
+        """
+        with open(self.path, encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning("Ignoring corrupted record in journal %s", self.path)
+                    continue
+                self.replay(record)
+        # Hidden entries can't be brought back to a list indexed again
+        self.undoHistory = [hist for hist in self.undoHistory if hist.action != "hide"]
+        self.redoHistory = [hist for hist in self.redoHistory if hist.action != "hide"]
+
+    def replay(self, record: dict):
+        kind = record.get("type")
+        if kind == "session":
+            # Written again when a session is resumed
+            self.root = record["root"]
+            self.started = record["time"]
+            self.ended = False
+        elif kind == "end":
+            self.ended = True
+        elif kind == "begin":
+            self.unfinished[record["id"]] = record
+            self.lastId = max(self.lastId, record["id"])
+        elif kind == "target":
+            if record["id"] in self.unfinished:
+                self.unfinished[record["id"]].update(target=record["path"], targetTime=record["time"])
+        elif kind == "failed":
+            self.unfinished.pop(record["id"], None)
+        elif kind == "do":
+            if record.get("id") is not None:
+                self.unfinished.pop(record["id"], None)
+            self.undoHistory.append(recordHistory(record["history"]))
+            self.redoHistory = []
+        elif kind in ("undo", "redo"):
+            history, otherHistory = ((self.undoHistory, self.redoHistory) if kind == "undo"
+                                     else (self.redoHistory, self.undoHistory))
+            if history:
+                history.pop()
+            hist = recordHistory(record["history"])
+            if hist is not None:
+                otherHistory.append(hist)
+
+    def reconcile(self) -> tuple[int, int]:
+        """
+        Finishes or rolls back the operations interrupted by a crash, and records their outcome in the journal.
+        Moves which were copying the file to another file system are rolled back, removing the partial copy.
+        Returns the amount of operations found done, and of operations rolled back
+        """
+        records = []
+        done = 0
+        for operationId, begin in sorted(self.unfinished.items()):
+            try:
+                hist = self.reconcileOperation(begin)
+            except OSError as err:
+                logging.error("Unable to check interrupted %s of %s: %s", begin["action"], begin["source"], err)
+                hist = None
+            if hist is None:
+                records.append({"type": "failed", "id": operationId})
+            else:
+                done += 1
+                records.append({"type": "do", "id": operationId, "history": historyRecord(hist)})
+                self.undoHistory.append(hist)
+                self.redoHistory = []
+        if records:
+            writeRecords(self.path, records)
+        self.unfinished = {}
+        return done, len(records) - done
+
+    @staticmethod
+    def reconcileOperation(begin: dict) -> HistoryEntry | None:
+        """
+        Returns the history entry of an interrupted operation which was done, None if it wasn't (anymore)
+        """
+        source, target, action = begin["source"], begin.get("target"), begin["action"]
+        sourceExists = os.path.exists(source)
+        if action == "delete":
+            # The trash doesn't tell where the file went, it can only be restored from the trash
+            if not sourceExists:
+                logging.info("Interrupted deletion of %s was done", source)
+            return None
+        if target is None or not os.path.exists(target):
+            if not sourceExists:
+                logging.warning("Interrupted %s of %s: the file is neither in place nor moved", action, source)
+            return None
+        if action == "move" and not sourceExists:
+            logging.info("Interrupted move of %s to %s was done", source, target)
+            return HistoryEntry("move", None, begin.get("position"), source, target)
+        sourceStat, targetStat = os.stat(source), os.stat(target)
+        # Metadata is copied once the content is
+        copied = sourceStat.st_size == targetStat.st_size and sourceStat.st_mtime_ns == targetStat.st_mtime_ns
+        if action == "copy" and copied:
+            logging.info("Interrupted copy of %s to %s was done", source, target)
+            return HistoryEntry("copy", None, begin.get("position"), source, target)
+        if not copied and targetStat.st_mtime < begin["targetTime"] - 1:
+            # Not written by us: another process created it before the name was tried again
+            logging.warning("Interrupted %s of %s: %s isn't a copy of it, leaving it", action, source, target)
+            return None
+        # The source is intact: a move interrupted while copying to another file system is rolled back
+        logging.info("Removing %s, partial copy of %s", target, source)
+        try:
+            os.remove(target)
+        except OSError as err:
+            logging.error("Unable to remove %s, partial copy of %s: %s", target, source, err)
+        return None
+
+
+def sessionJournals(directory: str) -> list[str]:
+    """
+    Returns the journals of the previous sessions, from the oldest to the latest
+    """
+    try:
+        names = sorted(name for name in os.listdir(directory) if name.endswith(JOURNALEXTENSION))
+    except FileNotFoundError:
+        return []
+    return [os.path.join(directory, name) for name in names]
+
+
+class OperationJournal:
+    """
+    Writes the journal of the current session, one JSON record per line.
+    Records are written by a thread which syncs them to disk in groups, so that recording an action doesn't wait
+    for the disk. Only threads needing a record to be on disk before going on (before starting to copy a file) wait
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        # Directory of the current session, None if actions aren't journaled
+        self.root: str | None = None
+        self.path: str | None = None
+        self.resumed = False
+        self.file = None
+        self.thread: threading.Thread | None = None
+        self.condition = threading.Condition()
+        self.pending: list[str] = []
+        self.queued = 0
+        self.synced = 0
+        self.stopping = False
+        # Ids are unique across sessions, as operations started in a session may end in the next one
+        self.ids = itertools.count()
+
+    def startSession(self, root: str, journalPath: str = None, lastId: int = -1):
+        """
+        Ends the current session, and starts journaling a new one, or goes on with an existing journal if given.
+        The journal is only created once there's something to journal
+        """
+        self.close()
+        self.root = root
+        self.resumed = journalPath is not None
+        if journalPath is None:
+            # Sorted by start time, the nanoseconds telling apart sessions started in the same second
+            journalPath = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{time.time_ns() % 10**9:09d}-"
+                                                       f"{os.getpid()}{JOURNALEXTENSION}")
+        self.path = journalPath
+        self.ids = itertools.count(max(next(self.ids), lastId + 1))
+
+    def open(self) -> bool:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if not self.resumed:
+                self.pruneSessions()
+            self.file = open(self.path, "a", encoding="utf-8")
+        except OSError as err:
+            logging.error("Unable to open journal %s, actions won't be journaled: %s", self.path, err)
+            self.root = None
+            return False
+        logging.info("Journaling session in %s", self.path)
+        self.stopping = False
+        self.pending.append(json.dumps({"type": "session", "root": self.root, "time": time.time()}) + "\n")
+        self.queued += 1
+        self.thread = threading.Thread(target=self.writer, name="OperationJournal", daemon=True)
+        self.thread.start()
+        return True
+
+    def pruneSessions(self):
+        for path in sessionJournals(self.directory)[:-KEPTSESSIONS + 1]:
+            try:
+                os.remove(path)
+            except OSError as err:
+                logging.warning("Unable to remove old journal %s: %s", path, err)
+
+    def append(self, record: dict, wait: bool = False):
+        """
+        Queues a record, waiting until it's on disk if wait is set
+        """
+        line = json.dumps(record) + "\n"
+        with self.condition:
+            if self.root is None or (self.file is None and not self.open()):
+                return
+            self.pending.append(line)
+            self.queued += 1
+            number = self.queued
+            self.condition.notify_all()
+            while wait and self.synced < number and self.file is not None:
+                self.condition.wait()
+
+    def writer(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopping:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                lines, self.pending = self.pending, []
+                number = self.queued
+            try:
+                self.file.write("".join(lines))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except OSError as err:
+                logging.error("Unable to write journal %s: %s", self.path, err)
+            with self.condition:
+                self.synced = number
+                self.condition.notify_all()
+
+    def begin(self, action: str, source: str, destination: str, position: int) -> int:
+        """
+        Records the start of a file operation, returning its id
+        """
+        operationId = next(self.ids)
+        self.append({"type": "begin", "id": operationId, "action": action, "source": source,
+                     "destination": destination, "position": position})
+        return operationId
+
+    def target(self, operationId: int, path: str):
+        """
+        Records where a file operation writes, before it writes there
+        """
+        self.append({"type": "target", "id": operationId, "path": path, "time": time.time()}, wait=True)
+
+    def failed(self, operationId: int):
+        self.append({"type": "failed", "id": operationId})
+
+    def do(self, hist: HistoryEntry, operationId: int = None):
+        self.append({"type": "do", "id": operationId, "history": historyRecord(hist)})
+
+    def undo(self, hist: HistoryEntry | None):
+        """
+        Records that the last action was undone, hist being the action redoing it if any
+        """
+        self.append({"type": "undo", "history": historyRecord(hist)})
+
+    def redo(self, hist: HistoryEntry | None):
+        self.append({"type": "redo", "history": historyRecord(hist)})
+
+    def close(self):
+        """
+        Ends the session, once all its records are on disk
+        """
+        if self.file is None:
+            self.root = None
+            return
+        self.append({"type": "end"})
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.thread.join()
+        with self.condition:
+            self.file.close()
+            self.file = None
+            self.condition.notify_all()
+        self.thread = None
+        self.root = None
+        self.queued = self.synced = 0
@@ -7,7 +7,7 @@ import pickle
 
 from PyQt5.QtCore import Qt, QSize, QSettings, QPoint
 
-CURRENTSETTINGSVERSION = 4
+CURRENTSETTINGSVERSION = 6
 
 class SortMethod(enum.Enum):
     """
@@ -23,6 +23,14 @@ class SortMethod(enum.Enum):
     modifDate = 7  # Date of modification
     modifDateDec = 8  # Date of modification (reverse)
 
+class MimeDetection(enum.Enum):
+    """
+    Strategies available to detect the mimetype of a file
+    """
+    extension = 0  # File extension only, never opens the file
+    extensionThenContent = 1  # File extension, file content is only read when the extension is unknown or ambiguous
+    content = 2  # Both file name and content, as decided by QMimeDatabase
+
 class Settings:
     """
     This class embeds the MediaSorter settings. A few helper methods are provided to ease manipulation
@@ -44,13 +52,28 @@ class Settings:
         self.indexing_threads = -1
         self.indexing_refreshPeriod = 0.5
         self.indexing_batchSize = 10
+        self.indexing_chunkSize = 64
         self.indexing_batchTime = False
         self.indexing_batchTimeLimit = 0.5
         self.indexing_recursive = False
+        self.indexing_parallelDirs = False
+        self.indexing_mimeDetection = MimeDetection.content
+        self.indexing_cache = True
+        self.indexing_duplicates = False
+        self.indexing_hideDuplicates = False
         self.autosort = False
         self.sort_method = SortMethod.none
+        self.fileOperations_perDestination = 1
+        self.fileOperations_journal = True
+        self.gallery_thumbnailSize = 160
 
         # ImageSorter
+        self.image_prefetchNext = 3
+        self.image_prefetchPrevious = 1
+        self.image_cacheSize = 512
+        self.image_rotationSidecars = False
+        self.image_similarity = False
+        self.image_similarityThreshold = 7
 
         # VideoSorter
         self.volume = 50
@@ -76,14 +99,29 @@ class Settings:
         self.settings.setValue("indexing_threads", self.indexing_threads)
         self.settings.setValue("indexing_refreshPeriod", self.indexing_refreshPeriod)
         self.settings.setValue("indexing_batchSize", self.indexing_batchSize)
+        self.settings.setValue("indexing_chunkSize", self.indexing_chunkSize)
         self.settings.setValue("indexing_batchTime", self.indexing_batchTime)
         self.settings.setValue("indexing_batchTimeLimit", self.indexing_batchTimeLimit)
         self.settings.setValue("indexing_recursive", self.indexing_recursive)
+        self.settings.setValue("indexing_parallelDirs", self.indexing_parallelDirs)
+        self.settings.setValue("indexing_mimeDetection", pickle.dumps(self.indexing_mimeDetection))
+        self.settings.setValue("indexing_cache", self.indexing_cache)
+        self.settings.setValue("indexing_duplicates", self.indexing_duplicates)
+        self.settings.setValue("indexing_hideDuplicates", self.indexing_hideDuplicates)
         self.settings.setValue("autosort", self.autosort)
         self.settings.setValue("sort_method", pickle.dumps(self.sort_method))
+        self.settings.setValue("fileOperations_perDestination", self.fileOperations_perDestination)
+        self.settings.setValue("fileOperations_journal", self.fileOperations_journal)
+        self.settings.setValue("gallery_thumbnailSize", self.gallery_thumbnailSize)
         self.settings.endGroup()
 
         self.settings.beginGroup("ImageSorter")
+        self.settings.setValue("image_prefetchNext", self.image_prefetchNext)
+        self.settings.setValue("image_prefetchPrevious", self.image_prefetchPrevious)
+        self.settings.setValue("image_cacheSize", self.image_cacheSize)
+        self.settings.setValue("image_rotationSidecars", self.image_rotationSidecars)
+        self.settings.setValue("image_similarity", self.image_similarity)
+        self.settings.setValue("image_similarityThreshold", self.image_similarityThreshold)
         self.settings.endGroup()
 
         self.settings.beginGroup("VideoSorter")
@@ -105,10 +143,12 @@ class Settings:
         self.globalKeys = self.settings.value("defaultKeys", {Qt.Key_Right: "next", Qt.Key_Left: "prev",
                                                               Qt.Key_Home: "first", Qt.Key_End: "last",
                                                               Qt.Key_Delete: "delete", Qt.Key_Insert: "clipboard",
-                                                              Qt.Key_Backspace: "hide"})
+                                                              Qt.Key_Backspace: "hide", Qt.Key_F3: "duplicate",
+                                                              Qt.Key_F5: "gallery"})
         self.imageKeys = self.settings.value("imageKeys", {Qt.Key_Plus: "zoomUp", Qt.Key_Minus: "zoomDown",
                                                            Qt.Key_0: "zoomReset", Qt.Key_1: "zoomRatio",
-                                                           Qt.Key_4: "rotateLeft", Qt.Key_6: "rotateRight"})
+                                                           Qt.Key_4: "rotateLeft", Qt.Key_6: "rotateRight",
+                                                           Qt.Key_F4: "nextSimilar"})
         self.videoKeys = self.settings.value("videoKeys", {Qt.Key_Plus: "volumeUp", Qt.Key_Minus: "volumeDown",
                                                            Qt.Key_0: "volumeReset", Qt.Key_Space: "pause"})
         self.settings.endGroup()
@@ -125,14 +165,29 @@ class Settings:
         self.indexing_threads = self.settings.value("indexing_threads", -1, type=int)
         self.indexing_refreshPeriod = self.settings.value("indexing_refreshPeriod", 50, type=int)
         self.indexing_batchSize = self.settings.value("indexing_batchSize", 50, type=int)
+        self.indexing_chunkSize = self.settings.value("indexing_chunkSize", 64, type=int)
         self.indexing_batchTime = self.settings.value("indexing_batchTime", False, type=bool)
         self.indexing_batchTimeLimit = self.settings.value("indexing_batchTimeLimit", 0.5, type=float)
         self.indexing_recursive = self.settings.value("indexing_recursive", False, type=bool)
+        self.indexing_parallelDirs = self.settings.value("indexing_parallelDirs", False, type=bool)
+        self.indexing_mimeDetection = pickle.loads(self.settings.value("indexing_mimeDetection", pickle.dumps(MimeDetection.content)))
+        self.indexing_cache = self.settings.value("indexing_cache", True, type=bool)
+        self.indexing_duplicates = self.settings.value("indexing_duplicates", False, type=bool)
+        self.indexing_hideDuplicates = self.settings.value("indexing_hideDuplicates", False, type=bool)
         self.autosort = self.settings.value("autosort", False, type=bool)
         self.sort_method = pickle.loads(self.settings.value("sort_method", pickle.dumps(SortMethod.none)))
+        self.fileOperations_perDestination = self.settings.value("fileOperations_perDestination", 1, type=int)
+        self.fileOperations_journal = self.settings.value("fileOperations_journal", True, type=bool)
+        self.gallery_thumbnailSize = self.settings.value("gallery_thumbnailSize", 160, type=int)
         self.settings.endGroup()
 
         self.settings.beginGroup("ImageSorter")
+        self.image_prefetchNext = self.settings.value("image_prefetchNext", 3, type=int)
+        self.image_prefetchPrevious = self.settings.value("image_prefetchPrevious", 1, type=int)
+        self.image_cacheSize = self.settings.value("image_cacheSize", 512, type=int)
+        self.image_rotationSidecars = self.settings.value("image_rotationSidecars", False, type=bool)
+        self.image_similarity = self.settings.value("image_similarity", False, type=bool)
+        self.image_similarityThreshold = self.settings.value("image_similarityThreshold", 7, type=int)
         self.settings.endGroup()
 
         self.settings.beginGroup("VideoSorter")
@@ -151,5 +206,10 @@ class Settings:
             self.settingsVersion = 3
             self.imageKeys.update({Qt.Key_4: "rotateLeft", Qt.Key_6: "rotateRight"})
             # Version 3 adds new entries so no update required
+        if self.settingsVersion <= 4:
+            self.imageKeys.setdefault(Qt.Key_F4, "nextSimilar")
+        if self.settingsVersion <= 5:
+            self.globalKeys.setdefault(Qt.Key_F3, "duplicate")
+            self.globalKeys.setdefault(Qt.Key_F5, "gallery")
         self.settingsVersion = CURRENTSETTINGSVERSION
         self.save(size, pos)
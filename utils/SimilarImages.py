@@ -0,0 +1,346 @@
+"""
+SimilarImages
+
+Module finding similar images (resized or re-encoded copies of the same picture) with a perceptual hash: the dHash
+of an image tells, for each pixel of a tiny grayscale version of the image, if it's brighter than its right neighbour.
+Similar images have hashes differing by a few bits only
+"""
+import itertools
+import logging
+import os
+import sqlite3
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, QSize, Qt, QStandardPaths, pyqtSignal
+from PyQt5.QtGui import QImage, QImageReader
+
+from utils.MediaEntry import MediaEntry
+
+CURRENTPERCEPTUALCACHEVERSION = 1
+# Size images are decoded at before being reduced to 9x8 pixels, decoding JPEG at a lower size being much faster
+HASHDECODESIZE = 64
+# Images hashed by a single task
+HASHCHUNKSIZE = 16
+# The 64 bits hashes are split in blocks to be indexed
+BLOCKS = 4
+BLOCKBITS = 16
+BLOCKMASK = (1 << BLOCKBITS) - 1
+
+# (path, size, mtime) of an image to hash, size and mtime being None if they weren't read while indexing
+HashJob = tuple[str, int | None, float | None]
+
+
+def defaultPerceptualCachePath() -> str:
+    return os.path.join(QStandardPaths.writableLocation(QStandardPaths.CacheLocation), "perceptual.sqlite")
+
+
+def perceptualHash(path: str) -> int | None:
+    """
+    Returns the 64 bits dHash of an image, None if it can't be decoded
+    """
+    reader = QImageReader(path)
+    reader.setAutoTransform(True)
+    size = reader.size()
+    if size.isValid() and size.width() > HASHDECODESIZE and size.height() > HASHDECODESIZE:
+        reader.setScaledSize(QSize(HASHDECODESIZE, HASHDECODESIZE))
+    image = reader.read()
+    if image.isNull():
+        logging.debug("Unable to decode %s: %s", path, reader.errorString())
+        return None
+    image = image.scaled(9, 8, Qt.IgnoreAspectRatio, Qt.SmoothTransformation).convertToFormat(QImage.Format_Grayscale8)
+    pixels = image.constBits()
+    pixels.setsize(image.sizeInBytes())
+    pixels = bytes(pixels)
+    lineLength = image.bytesPerLine()
+    value = 0
+    for y in range(8):
+        row = pixels[y * lineLength:y * lineLength + 9]
+        for x in range(8):
+            value = (value << 1) | (row[x] > row[x + 1])
+    return value
+
+
+class PerceptualHashCache:
+    """
+    SQLite-backed cache of the perceptual hashes of images, checked against their size and modification time.
+    A single cache file may be used by several threads at once
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.db: sqlite3.Connection | None = None
+
+    def open(self) -> bool:
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, timeout=30)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            version = self.db.execute("PRAGMA user_version").fetchone()[0]
+            if version != CURRENTPERCEPTUALCACHEVERSION:
+                logging.info("Creating perceptual hash cache (version %s) in %s", CURRENTPERCEPTUALCACHEVERSION,
+                             self.path)
+                with self.db:
+                    self.db.execute("DROP TABLE IF EXISTS hashes")
+                    self.db.execute("CREATE TABLE hashes (path TEXT PRIMARY KEY, size INTEGER NOT NULL,"
+                                    " mtime REAL NOT NULL, hash INTEGER NOT NULL)")
+                    self.db.execute(f"PRAGMA user_version = {CURRENTPERCEPTUALCACHEVERSION}")
+        except (sqlite3.Error, OSError) as err:
+            logging.warning("Unable to open perceptual hash cache %s: %s", self.path, err)
+            self.close()
+            return False
+        return True
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def lookup(self, job: HashJob) -> int | None:
+        path, size, mtime = job
+        try:
+            row = self.db.execute("SELECT size, mtime, hash FROM hashes WHERE path = ?",
+                                  (os.path.abspath(path),)).fetchone()
+        except (sqlite3.Error, ValueError) as err:
+            logging.warning("Unable to read %s from perceptual hash cache: %s", path, err)
+            return None
+        if row is None or row[0] != size or row[1] != mtime:
+            return None
+        # Stored as a signed 64 bits integer
+        return row[2] & 0xFFFFFFFFFFFFFFFF
+
+    def store(self, hashes: list[tuple[HashJob, int]]):
+        try:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)",
+                                    [(os.path.abspath(path), size, mtime, value - (1 << 64) if value >> 63 else value)
+                                     for (path, size, mtime), value in hashes])
+        except (sqlite3.Error, ValueError) as err:
+            logging.warning("Unable to store hashes in perceptual hash cache: %s", err)
+
+
+class PerceptualHashSignals(QObject):
+    """
+    Signals of PerceptualHashTask, as QRunnable can't emit signals
+    """
+    hashed = pyqtSignal(int, list)
+
+
+class PerceptualHashTask(QRunnable):
+    """
+    Hashes a chunk of images in a thread pool
+    """
+    def __init__(self, jobs: list[HashJob], cachePath: str | None, generation: int, signals: PerceptualHashSignals):
+        super().__init__()
+        self.jobs = jobs
+        self.cachePath = cachePath
+        self.generation = generation
+        self.signals = signals
+
+    def run(self):
+        results = []
+        try:
+            self.hash(results)
+        finally:
+            # Always answered, so that the pending tasks are counted right
+            self.signals.hashed.emit(self.generation, results)
+
+    def hash(self, results: list[tuple[str, int | None]]):
+        cache = None
+        if self.cachePath is not None:
+            cache = PerceptualHashCache(self.cachePath)
+            if not cache.open():
+                cache = None
+        computed = []
+        for job in self.jobs:
+            if job[1] is None or job[2] is None:
+                try:
+                    stat = os.stat(job[0])
+                except OSError as err:
+                    logging.warning("Unable to hash %s: %s", job[0], err)
+                    results.append((job[0], None))
+                    continue
+                job = (job[0], stat.st_size, stat.st_mtime)
+            value = cache.lookup(job) if cache is not None else None
+            if value is None:
+                value = perceptualHash(job[0])
+                if value is not None:
+                    computed.append((job, value))
+            results.append((job[0], value))
+        if cache is not None:
+            if computed:
+                cache.store(computed)
+            cache.close()
+
+
+class HammingIndex:
+    """
+    Multi-index hashing of 64 bits hashes: hashes are indexed by each of their 4 blocks of 16 bits.
+    Two hashes within radius bits have a block within radius // 4 bits, so that only the hashes having a block
+    close to one of those of the searched hash are compared
+    """
+    def __init__(self, radius: int):
+        self.radius = radius
+        # XOR masks of the blocks within radius // 4 bits
+        self.flips = [sum(1 << bit for bit in bits) for count in range(radius // BLOCKS + 1)
+                      for bits in itertools.combinations(range(BLOCKBITS), count)]
+        self.tables: list[dict[int, list[int]]] = [{} for _ in range(BLOCKS)]
+        self.paths: dict[int, list[str]] = {}
+
+    def add(self, value: int, path: str):
+        paths = self.paths.get(value)
+        if paths is None:
+            self.paths[value] = [path]
+            for i, table in enumerate(self.tables):
+                table.setdefault((value >> (BLOCKBITS * i)) & BLOCKMASK, []).append(value)
+        else:
+            paths.append(path)
+
+    def remove(self, value: int, path: str):
+        # Hashes without paths are left in the tables, and skipped by neighbours
+        paths = self.paths.get(value)
+        if paths is not None and path in paths:
+            paths.remove(path)
+
+    def neighbours(self, value: int) -> list[tuple[int, int]]:
+        """
+        Returns the (distance, hash) of the hashes within radius bits of the hash
+        """
+        buckets = []
+        for i, table in enumerate(self.tables):
+            block = (value >> (BLOCKBITS * i)) & BLOCKMASK
+            buckets.extend(filter(None, map(table.get, [block ^ flip for flip in self.flips])))
+        candidates = set().union(*buckets)
+        return [(distance, other) for other in candidates
+                if (distance := (other ^ value).bit_count()) <= self.radius and self.paths[other]]
+
+
+class SimilarImages(QObject):
+    """
+    Perceptual hashes of the images of the media list, computed in a thread pool as images are indexed.
+    Images are grouped in clusters: similar images, and the images similar to those, belong to the same cluster
+    """
+    updated = pyqtSignal()
+
+    def __init__(self, threshold: int = 7, cachePath: str = None, parent: QObject = None):
+        super().__init__(parent)
+        self.threshold = threshold
+        self.cachePath = cachePath
+        self.pool = QThreadPool(self)
+        self.signals = PerceptualHashSignals(self)
+        self.signals.hashed.connect(self.hashed)
+        # Results of tasks started before the last clear are dropped
+        self.generation = 0
+        self.pending = 0
+        self.hashes: dict[str, int] = {}
+        self.index = HammingIndex(threshold)
+        # Image -> first image of its cluster, and first image -> images of the cluster
+        self.clusterOf: dict[str, str] = {}
+        self.clusters: dict[str, list[str]] = {}
+
+    def add(self, entries: list[MediaEntry]):
+        jobs = [(entry.path, entry.size, entry.mtime) for entry in entries]
+        for start in range(0, len(jobs), HASHCHUNKSIZE):
+            self.pool.start(PerceptualHashTask(jobs[start:start + HASHCHUNKSIZE], self.cachePath, self.generation,
+                                               self.signals))
+            self.pending += 1
+
+    def hashed(self, generation: int, results: list[tuple[str, int | None]]):
+        if generation != self.generation:
+            return
+        self.pending -= 1
+        for path, value in results:
+            if value is not None:
+                self.insert(path, value)
+        self.updated.emit()
+
+    def insert(self, path: str, value: int):
+        if path in self.hashes:
+            self.forget(path)
+        self.hashes[path] = value
+        self.index.add(value, path)
+        if path not in self.clusterOf:
+            self.clusterOf[path] = path
+            self.clusters[path] = [path]
+        for _distance, other in self.index.neighbours(value):
+            self.merge(path, self.index.paths[other][0])
+
+    def merge(self, path: str, other: str):
+        """
+        Merges the clusters of two images, the images of the smaller cluster joining the larger one
+        """
+        cluster, otherCluster = self.clusterOf[path], self.clusterOf[other]
+        if cluster == otherCluster:
+            return
+        if len(self.clusters[cluster]) < len(self.clusters[otherCluster]):
+            cluster, otherCluster = otherCluster, cluster
+        members = self.clusters.pop(otherCluster)
+        for member in members:
+            self.clusterOf[member] = cluster
+        self.clusters[cluster].extend(members)
+
+    def similar(self, path: str) -> list[str]:
+        """
+        Returns the images similar to the image, from the most similar
+        """
+        value = self.hashes.get(path)
+        if value is None:
+            return []
+        return [other for _distance, neighbour in sorted(self.index.neighbours(value))
+                for other in self.index.paths[neighbour] if other != path]
+
+    def clusterOrder(self, paths: list[str]) -> list[int]:
+        """
+        Returns the order of the paths putting the images of a cluster right after the first one of the cluster,
+        the order being kept otherwise
+        """
+        # Each image is sorted by the position of the first image of its cluster, the sort being stable
+        firsts: dict[str, int] = {}
+        keys = list(map(firsts.setdefault, map(self.clusterOf.get, paths, paths), range(len(paths))))
+        return sorted(range(len(paths)), key=keys.__getitem__)
+
+    def forget(self, path: str):
+        value = self.hashes.pop(path, None)
+        if value is not None:
+            self.index.remove(value, path)
+            # The images it linked stay in the same cluster
+            cluster = self.clusterOf.pop(path)
+            members = self.clusters.pop(cluster)
+            members.remove(path)
+            if members:
+                # Keyed by one of its remaining images, so that the image may be inserted again
+                if cluster == path:
+                    cluster = members[0]
+                    for member in members:
+                        self.clusterOf[member] = cluster
+                self.clusters[cluster] = members
+
+    def setThreshold(self, threshold: int):
+        if threshold == self.threshold:
+            return
+        self.threshold = threshold
+        hashes = self.hashes
+        self.hashes = {}
+        self.index = HammingIndex(threshold)
+        self.clusterOf = {}
+        self.clusters = {}
+        for path, value in hashes.items():
+            self.insert(path, value)
+        self.updated.emit()
+
+    def clear(self):
+        self.pool.clear()
+        self.generation += 1
+        self.pending = 0
+        self.hashes = {}
+        self.index = HammingIndex(self.threshold)
+        self.clusterOf = {}
+        self.clusters = {}
+
+    def isFinished(self) -> bool:
+        return self.pending == 0
+
+    def groupCount(self) -> int:
+        return sum(1 for cluster in self.clusters.values() if len(cluster) > 1)
+
+    def stop(self):
+        self.pool.clear()
+        self.pool.waitForDone()
@@ -0,0 +1,125 @@
+"""
+Thumbnails
+
+Module providing a background loader of the thumbnails of the gallery, decoding only those of the visible media
+"""
+import logging
+
+from PyQt5.QtCore import QObject, QRunnable, QThread, QThreadPool, QSize, pyqtSignal
+from PyQt5.QtGui import QImage
+
+from utils.ImageCache import ImageCache, ImageKey, entryKey
+from utils.ImagePrefetcher import decodeImage
+from utils.MediaEntry import MediaEntry
+
+# Memory used to keep decoded thumbnails
+THUMBNAILCACHESIZE = 128 * 2**20
+
+
+def decodeThumbnail(key: ImageKey) -> QImage:
+    """
+    Decodes an image at the size fitting in the thumbnail size of the key, or a null image if it isn't an image
+    """
+    return decodeImage(key)[0]
+
+
+class ThumbnailSignals(QObject):
+    """
+    Signals of ThumbnailTask, as QRunnable can't emit signals
+    """
+    decoded = pyqtSignal(object, QImage)
+
+
+class ThumbnailTask(QRunnable):
+    """
+    Decodes a single thumbnail in a thread pool, at idle priority so that it never slows down the sorter
+    """
+    def __init__(self, key: ImageKey, signals: ThumbnailSignals):
+        super().__init__()
+        self.key = key
+        self.signals = signals
+        self.setAutoDelete(False)
+
+    def run(self):
+        QThread.currentThread().setPriority(QThread.IdlePriority)
+        self.signals.decoded.emit(self.key, decodeThumbnail(self.key))
+
+
+class ThumbnailLoader(QObject):
+    """
+    Keeps decoded the thumbnails of a window of media (the visible ones), decoding the missing ones in a thread pool.
+    Thumbnails which aren't visible anymore aren't decoded, and the decoded ones are kept in an ImageCache
+    """
+    thumbnailDecoded = pyqtSignal(str)
+
+    def __init__(self, size: int, parent: QObject = None):
+        super().__init__(parent)
+        self.size = QSize(size, size)
+        self.cache = ImageCache(THUMBNAILCACHESIZE)
+        self.pool = QThreadPool(self)
+        self.signals = ThumbnailSignals(self)
+        self.signals.decoded.connect(self.decoded)
+        self.entries: list[MediaEntry] = []
+        # Path -> key of the thumbnails of the window, built from the entries so that no file is read to paint them
+        self.keys: dict[str, ImageKey] = {}
+        self.tasks: dict[ImageKey, ThumbnailTask] = {}
+        # Files of the media list which aren't images, or can't be decoded
+        self.failed: set[ImageKey] = set()
+
+    def setSize(self, size: int):
+        if size != self.size.width():
+            self.size = QSize(size, size)
+            self.cache.clear()
+            self.failed.clear()
+            self.load(self.entries)
+
+    def load(self, entries: list[MediaEntry]):
+        """
+        Sets the media whose thumbnails are shown, the first ones being decoded first
+        """
+        self.entries = entries
+        self.keys = {entry.path: entryKey(entry, self.size) for entry in entries}
+        window = set(self.keys.values())
+        for key in list(self.tasks):
+            if key not in window and self.pool.tryTake(self.tasks[key]):
+                del self.tasks[key]
+        for priority, key in enumerate(reversed(self.keys.values())):
+            if key in self.cache:
+                self.cache.touch(key)
+            elif key not in self.tasks and key not in self.failed:
+                task = ThumbnailTask(key, self.signals)
+                self.tasks[key] = task
+                self.pool.start(task, priority)
+
+    def thumbnail(self, path: str) -> QImage | None:
+        """
+        Returns the thumbnail of a media of the window, None if it isn't decoded (yet)
+        """
+        key = self.keys.get(path)
+        if key is None:
+            return None
+        return self.cache.get(key)
+
+    def decoded(self, key: ImageKey, image: QImage):
+        self.tasks.pop(key, None)
+        if image.isNull():
+            logging.debug("No thumbnail for %s", key[0])
+            self.failed.add(key)
+            return
+        if key[2:] == (self.size.width(), self.size.height()):
+            self.cache.put(key, image)
+            self.thumbnailDecoded.emit(key[0])
+
+    def invalidate(self, path: str):
+        self.cache.invalidate(path)
+
+    def forgetFailures(self):
+        """
+        Forgets the files which couldn't be decoded, once the media list they belong to is replaced
+        """
+        self.failed.clear()
+
+    def stop(self):
+        self.load([])
+        self.pool.clear()
+        self.pool.waitForDone()
@@ -2,45 +2,47 @@
 This module provides utilities & common classes for the Undo/Redo features
 """
 
-import copy
+import collections
 import os
+from typing import Callable, NamedTuple
 
 from utils.MediaEntry import MediaEntry
 import utils.fileUtils as fsUtils
 
 
-class HistoryEntry:
+class HistoryEntry(NamedTuple):
     """
-    This class provides basic description of an undo/redoable action
+    This class provides basic description of an undo/redoable action.
+    Entries are immutable, so that they're shared instead of copied, and modified with _replace
     """
-    def __init__(self):
-        self.action = None
-        self.entry = None
-        self.position = None
-        self.oldPath = None
-        self.newPath = None
+    action: str
+    entry: MediaEntry | None = None
+    position: int | None = None
+    oldPath: str | None = None
+    newPath: str | None = None
 
 
-def doHistory(historySize: int, history: list[HistoryEntry], otherHistory: list[HistoryEntry], mediaList: list[MediaEntry], mediaListPosition: int) -> tuple[str, int]:
+History = collections.deque[HistoryEntry]
+
+
+def doHistory(history: History, otherHistory: History, mediaList: list[MediaEntry], mediaListPosition: int,
+              insertPosition: Callable[[MediaEntry], int] = None) -> tuple[str, int, HistoryEntry | None]:
+    """
+    Undoes the last action of history, adding the action undoing it to otherHistory (bounded by its maxlen).
+    insertPosition gives where a hidden entry goes back, if the list is sorted (-1 if unknown).
+    Returns a message, the new position, and the action added to otherHistory if any
+    """
     act_msg = "no action"
     newPos = mediaListPosition
+    newAction = None
     if len(history) > 0:
         previousAction = history.pop()
-        newAction = copy.deepcopy(previousAction)
-        # if "oldPos" in previousAction:
-        #     newPos = previousAction.position
+        newAction = previousAction
 
         if previousAction.action == "move":
             newAction = fsUtils.moveFile(previousAction.newPath, os.path.split(previousAction.oldPath)[0])
             if newAction is not None:
-                # newAction.entry = previousAction.entry
-                # newAction.position = previousAction.position
                 act_msg = "move "+previousAction.oldPath
-                # if os.path.exists(previousAction.entry["path"]):
-                #     mediaList.insert(previousAction.position, previousAction.entry)
-                # else:
-                #     mediaList.pop(mediaListPosition)
-                #     newPos = mediaListPosition
         elif previousAction.action == "copy":
             newAction = fsUtils.deleteCopyFile(previousAction.oldPath, previousAction.newPath)
             if newAction is not None:
@@ -52,10 +54,13 @@ def doHistory(historySize: int, history: list[HistoryEntry], otherHistory: list[
         elif previousAction.action == "hide":
             newAction = None
             act_msg = "hide "+previousAction.entry.path
-            mediaList.insert(previousAction.position, previousAction.entry)
-            newPos = min(previousAction.position, len(mediaList)+1)
+            position = previousAction.position
+            if insertPosition is not None:
+                sortedPosition = insertPosition(previousAction.entry)
+                if sortedPosition >= 0:
+                    position = sortedPosition
+            mediaList.insert(position, previousAction.entry)
+            newPos = min(position, len(mediaList)+1)
         if newAction is not None:
             otherHistory.append(newAction)
-        if len(otherHistory) > historySize:
-            otherHistory.pop(0)
-    return act_msg, newPos
+    return act_msg, newPos, newAction
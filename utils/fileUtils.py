@@ -3,71 +3,384 @@ fileUtils
 
 Module providing lots of functions related to file manipulation, mimetypes, etc...
 """
+import ctypes
+import errno
 import logging
 import os
+import threading
+import time
 import uuid
 import shutil
 
-from PyQt5.QtCore import QDir, QMimeDatabase, QFile, QByteArray
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from PyQt5.QtCore import QMimeDatabase, QFile, QByteArray
 from PyQt5.QtWidgets import QWidget, QFileDialog
 
+from utils.IndexCache import IndexCache, DirectoryIndex
 from utils.MediaEntry import MediaEntry
+from utils.Settings import MimeDetection
 from utils.UndoRedo import HistoryEntry
 
+# ioctl cloning a whole file (reflink), on btrfs, XFS and a few others
+FICLONE = 0x40049409
+# Buffer of the plain copy, when no copy offload works
+COPYBUFFERSIZE = 1024 * 1024
+# renameat2 flag making the rename fail if the destination exists
+RENAME_NOREPLACE = 1
+AT_FDCWD = -100
+try:
+    renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+except (OSError, AttributeError, TypeError):
+    renameat2 = None
+# Delay during which the listing of a destination directory is trusted without checking its modification time
+LISTINGTRUSTDELAY = 5.0
+# Attempts to find a free name in a destination, other processes creating the same names meanwhile
+MAXNAMEATTEMPTS = 10
+# Errors meaning a copy method isn't available for these files, the next one is tried
+UNSUPPORTEDERRORS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EBADF,
+                     errno.ETXTBSY, errno.EPERM}
 
-def listFiles(path: str, matchingMime: list[QByteArray], recursive=False) -> list[MediaEntry]:
-    filters = matchingMime
-    if filters is None:
-        logging.warning("Calling listFiles without a matchingMime argument will return an empty list")
-        return []
-    if recursive:
-        return listFilesRecursive(path, matchingMime)
-    result = []
-    myFiles: list[str] = QDir(path).entryList(filters=(QDir.Files | QDir.NoDotAndDotDot))
 
-    for e in myFiles:
-        fullpath = os.path.join(path, e)
-        entry = indexFile(fullpath, filters, QMimeDatabase())
-        if entry:
-            result.append(entry)
+class MimeDetector:
+    """
+    Detects mimetypes following a MimeDetection strategy.
+    Lookups based on the file name are memoized per extension, as they are costly with QMimeDatabase
+    """
+    fallbackMime = "application/octet-stream"
 
-    return result
+    def __init__(self, detection: MimeDetection = MimeDetection.content, db: QMimeDatabase = None):
+        self.detection = detection
+        self.db = db if db is not None else QMimeDatabase()
+        self.byExtension: dict[str, str | None] = {}
+
+    def fromName(self, path: str) -> str | None:
+        """
+        Returns the mimetype matching the file extension, or None if it is unknown or ambiguous
+        """
+        extension = os.path.splitext(path)[1].lower()
+        if extension not in self.byExtension:
+            candidates = self.db.mimeTypesForFileName("file" + extension) if extension else []
+            self.byExtension[extension] = candidates[0].name() if len(candidates) == 1 else None
+        return self.byExtension[extension]
 
-def listFilesRecursive(path: str, matchingMime: list[QByteArray]) -> list[MediaEntry]:
+    def detect(self, path: str) -> str:
+        if self.detection == MimeDetection.content:
+            return self.db.mimeTypeForFile(path).name()
+        fileType = self.fromName(path)
+        if fileType is not None:
+            return fileType
+        if self.detection == MimeDetection.extension:
+            return self.fallbackMime
+        return self.db.mimeTypeForFile(path).name()
+
+
+def buildMimeFilter(matchingMime: list[QByteArray]) -> frozenset[str]:
+    """
+    Converts a list of mimetypes (as returned by Qt) to a set of strings, which can be checked in constant time
+    """
+    return frozenset(m if isinstance(m, str) else bytes(m).decode() for m in matchingMime)
+
+
+def listFiles(path: str, matchingMime: list[QByteArray], recursive=False, detection: MimeDetection = MimeDetection.content,
+              cachePath: str = None) -> list[MediaEntry]:
+    if matchingMime is None:
+        logging.warning("Calling listFiles without a matchingMime argument will return an empty list")
+        return []
+    filters = buildMimeFilter(matchingMime)
+    detector = MimeDetector(detection)
+    cache = None
+    if cachePath is not None:
+        cache = IndexCache(cachePath)
+        if not cache.open():
+            cache = None
     result = []
     folder = [path]
     while len(folder) > 0:
-        p = folder.pop()
-        myFiles: list[str] = QDir(p).entryList(filters=(QDir.Files | QDir.NoDotAndDotDot | QDir.Dirs))
-
-        for e in myFiles:
-            if os.path.isdir(e):
-                folder.append(e)
-            else:
-                fullpath = os.path.join(path, e)
-                entry = indexFile(fullpath, matchingMime, QMimeDatabase())
-                if entry:
-                    result.append(entry)
-
+        listing = indexDirectory(folder.pop(), detector, cache)
+        if listing is None:
+            continue
+        result += listing.mediaEntries(filters)
+        if recursive:
+            folder += [os.path.join(listing.path, e) for e in reversed(listing.subdirs)]
+    if cache is not None:
+        cache.close()
     return result
 
-def indexFile(fileInfo: str, filters: list[QByteArray], db: QMimeDatabase) -> MediaEntry | None:
-    fileType = db.mimeTypeForFile(fileInfo).name()
+
+def indexDirectory(path: str, detector: MimeDetector, cache: IndexCache = None) -> DirectoryIndex | None:
+    """
+    Lists and classifies a directory, the cached listing is used instead if the directory wasn't modified since
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError as err:
+        logging.warning("Unable to list %s: %s", path, err)
+        return None
+    if cache is not None:
+        listing = cache.lookup(path, mtime)
+        if listing is not None:
+            return listing
+    listing = scanDirectory(path, mtime, detector, cache.known(path) if cache is not None else {})
+    if listing is not None and cache is not None:
+        cache.store(listing)
+    return listing
+
+
+def scanDirectory(path: str, mtime: int, detector: MimeDetector, known: dict[str, tuple[int, float, str]]) -> DirectoryIndex | None:
+    """
+    Lists and classifies a directory, files whose size and mtime match a known entry aren't classified again
+    """
+    listing = DirectoryIndex(path, mtime)
+    try:
+        with os.scandir(path) as it:
+            for e in it:
+                if e.name.startswith("."):
+                    # Hidden files and directories are skipped, as QDir did
+                    continue
+                if e.is_file():
+                    try:
+                        st = e.stat()
+                    except OSError:
+                        # Most likely removed while listing its directory
+                        continue
+                    previous = known.get(e.name)
+                    if previous is not None and previous[0] == st.st_size and previous[1] == st.st_mtime:
+                        fileType = previous[2]
+                    else:
+                        fileType = detector.detect(e.path)
+                    listing.files.append((e.name, st.st_size, st.st_mtime, st.st_ctime, fileType))
+                elif e.is_dir():
+                    listing.subdirs.append(e.name)
+    except OSError as err:
+        logging.warning("Unable to list %s: %s", path, err)
+        return None
+    listing.files.sort()
+    listing.subdirs.sort()
+    return listing
+
+
+def indexFile(fileInfo: str, filters: frozenset[str], detector: MimeDetector, stat: tuple[int, float, float] = None) -> MediaEntry | None:
+    """
+    Returns a MediaEntry if the file matches the filters, stat being its (size, mtime, ctime) if already known
+    """
+    fileType = detector.detect(fileInfo)
     # magic.from_file(fullpath, mime=True)
     if fileType in filters:
         media = MediaEntry()
         media.path = fileInfo
         media.mime = fileType
+        if stat is not None:
+            media.size, media.mtime, media.ctime = stat
         return media
     return None
 
 
+def copyData(source, destination) -> str:
+    """
+    Copies the content of a file object to another, both being empty files open for the copy.
+    Returns the method used: "reflink" shares the data blocks (instant, on btrfs/XFS), "copy_file_range" and
+    "sendfile" copy in the kernel (copy_file_range also being offloaded by NFS and SMB servers), "buffered" through
+    a buffer
+    """
+    source.flush()
+    sourceFd, destinationFd = source.fileno(), destination.fileno()
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(destinationFd, FICLONE, sourceFd)
+            return "reflink"
+        except OSError as err:
+            if err.errno not in UNSUPPORTEDERRORS:
+                raise
+    size = os.fstat(sourceFd).st_size
+    for method in ("copy_file_range", "sendfile"):
+        if not hasattr(os, method):
+            continue
+        copied = 0
+        try:
+            while True:
+                if method == "copy_file_range":
+                    count = os.copy_file_range(sourceFd, destinationFd, max(size - copied, COPYBUFFERSIZE))
+                else:
+                    count = os.sendfile(destinationFd, sourceFd, copied, max(size - copied, COPYBUFFERSIZE))
+                if count == 0:
+                    return method
+                copied += count
+        except OSError as err:
+            # Only falling back if nothing was copied, as a partial copy can't be told apart from a real error
+            if copied > 0 or err.errno not in UNSUPPORTEDERRORS:
+                raise
+    buffer = bytearray(COPYBUFFERSIZE)
+    view = memoryview(buffer)
+    while True:
+        count = source.readinto(buffer)
+        if not count:
+            return "buffered"
+        destination.write(view[:count])
+
+
+def copyFileContent(original: str, newFilename: str) -> str:
+    """
+    Copies a file with its metadata (as shutil.copy2), using the fastest available method which is returned.
+    A partial copy is removed if the copy fails
+    """
+    with open(original, "rb") as source, open(newFilename, "xb") as destination:
+        try:
+            method = copyData(source, destination)
+        except BaseException:
+            destination.close()
+            os.remove(newFilename)
+            raise
+    shutil.copystat(original, newFilename)
+    logging.debug("Copied %s to %s (%s)", original, newFilename, method)
+    return method
+
+
+def renameNoReplace(original: str, newFilename: str):
+    """
+    Renames a file, raising FileExistsError instead of replacing an existing destination, even if it's created
+    by another process at the same time (renameat2 with RENAME_NOREPLACE, or a hard link)
+    """
+    if renameat2 is not None:
+        if renameat2(AT_FDCWD, os.fsencode(original), AT_FDCWD, os.fsencode(newFilename), RENAME_NOREPLACE) == 0:
+            return
+        err = ctypes.get_errno()
+        if err not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+            raise OSError(err, os.strerror(err), original, None, newFilename)
+    # The file system doesn't support RENAME_NOREPLACE, linking fails as well if the destination exists
+    try:
+        os.link(original, newFilename)
+    except OSError as err:
+        if err.errno in (errno.EEXIST, errno.ENOENT, errno.EXDEV):
+            raise
+        # No hard links either (FAT, some network shares), another process may create the destination meanwhile
+        if os.path.lexists(newFilename):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), newFilename) from err
+        os.rename(original, newFilename)
+        return
+    os.remove(original)
+
+
+def moveFileContent(original: str, newFilename: str) -> str:
+    """
+    Moves a file by renaming it, or by copying then removing it if it's on another file system.
+    The destination is never replaced. Returns "rename", or the copy method used
+    """
+    try:
+        renameNoReplace(original, newFilename)
+        return "rename"
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+    method = copyFileContent(original, newFilename)
+    os.remove(original)
+    return method
+
+
 def getRandomName(path: str) -> str:
     randomPath = uuid.uuid4().hex
     splitText = os.path.splitext(path)
     return splitText[0] + "-" + randomPath + splitText[1]
 
 
+class DestinationCache:
+    """
+    Names of the files of the destination directories, so that finding a free name doesn't check the existence of
+    each candidate. Listings are kept up to date in memory with the files we create or remove, and listed again once
+    the directory modification time shows another process modified it, which is only checked once the listing is
+    older than LISTINGTRUSTDELAY. As files are then created without replacing existing ones, an outdated listing
+    only means another name is tried
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # directory -> (modification time, names, time it was last checked, whether we modified it since)
+        self.listings: dict[str, tuple[int, set[str], float, bool]] = {}
+
+    def names(self, directory: str) -> set[str]:
+        """
+        Returns the names of the files in the directory, raising OSError if it can't be listed
+        """
+        listing = self.listings.get(directory)
+        if listing is not None and time.monotonic() - listing[2] < LISTINGTRUSTDELAY:
+            return listing[1]
+        mtime = os.stat(directory).st_mtime_ns
+        # Our own changes account for a new modification time
+        if listing is None or (listing[0] != mtime and not listing[3]):
+            logging.debug("Listing destination %s", directory)
+            listing = (mtime, set(os.listdir(directory)), time.monotonic(), False)
+        else:
+            listing = (mtime, listing[1], time.monotonic(), False)
+        self.listings[directory] = listing
+        return listing[1]
+
+    def freeName(self, directory: str, name: str) -> str:
+        """
+        Returns the name, or a random name derived from it if it's taken in the directory
+        """
+        with self.lock:
+            names = self.names(directory)
+            newName = name
+            while newName in names:
+                newName = getRandomName(name)
+            return newName
+
+    def update(self, directory: str, added: str = None, removed: str = None):
+        """
+        Records a file we created or removed in the directory, without reading it again
+        """
+        with self.lock:
+            listing = self.listings.get(directory)
+            if listing is None:
+                return
+            if added is not None:
+                listing[1].add(added)
+            if removed is not None:
+                listing[1].discard(removed)
+            if not listing[3]:
+                self.listings[directory] = (listing[0], listing[1], listing[2], True)
+
+    def invalidate(self, directory: str):
+        with self.lock:
+            self.listings.pop(directory, None)
+
+
+destinationCache = DestinationCache()
+
+
+def transferFile(original: str, newDirectory: str, transfer, started=None) -> tuple[str, str] | None:
+    """
+    Moves or copies (as transfer does) the file to the directory, under a free name.
+    started is called with the new path before each transfer attempt, if given.
+    Returns the new path and the method used, None if the source or the destination doesn't exist
+    """
+    name = os.path.basename(original)
+    for _attempt in range(MAXNAMEATTEMPTS):
+        try:
+            newName = destinationCache.freeName(newDirectory, name)
+        except OSError as err:
+            logging.warning("Destination (%s) can't be listed: %s", newDirectory, err)
+            return None
+        newFilename = os.path.join(newDirectory, newName)
+        if started is not None:
+            started(newFilename)
+        try:
+            method = transfer(original, newFilename)
+        except FileExistsError:
+            # Created by another process since the directory was listed
+            destinationCache.invalidate(newDirectory)
+            continue
+        except FileNotFoundError as err:
+            logging.warning("Unable to transfer %s to %s: %s", original, newDirectory, err)
+            destinationCache.invalidate(newDirectory)
+            return None
+        destinationCache.update(newDirectory, added=newName)
+        return newFilename, method
+    raise FileExistsError(errno.EEXIST, "No free name found", os.path.join(newDirectory, name))
+
+
 def deleteFile(original: str) -> HistoryEntry | None:
     if not os.path.exists(original):
         logging.warning("Source (%s) doesn't exist", original)
@@ -77,59 +390,39 @@ def deleteFile(original: str) -> HistoryEntry | None:
     if not result:
         return None
 
-    hist = HistoryEntry()
-    hist.action = "move"
-    hist.oldPath = original
-    hist.newPath = newFilename
-    return hist
+    return HistoryEntry("move", oldPath=original, newPath=newFilename)
 
 
-def moveFile(original: str, newDirectory: str) -> HistoryEntry | None:
-    if not os.path.isdir(newDirectory):
-        logging.warning("Destination (%s) doesn't exist", newDirectory)
-        return None
-    if not os.path.exists(original):
-        logging.warning("Source (%s) doesn't exist", original)
-        return None
-    splitText = os.path.split(original)
-    newFilename = newDirectory + "/" + splitText[1]
-    if os.path.exists(newFilename):
-        randomName = getRandomName(splitText[1])
-        while os.path.exists(newDirectory + "/" + randomName):
-            randomName = getRandomName(splitText[1])
-        newFilename = newDirectory + "/" + randomName
-    # Using shutil to work between FS if needed
-    shutil.move(original, newFilename)
-
-    hist = HistoryEntry()
-    hist.action = "move"
-    hist.oldPath = original
-    hist.newPath = newFilename
-    return hist
-
-
-def copyFile(original: str, newDirectory: str) -> HistoryEntry | None:
-    if not os.path.isdir(newDirectory):
-        logging.warning("Destination (%s) doesn't exist", newDirectory)
+def moveFile(original: str, newDirectory: str, methods: list[str] = None, started=None) -> HistoryEntry | None:
+    """
+    Moves the file to the directory, under a random name if the name is taken.
+    The method used is appended to methods, if given, and started is called with the new path before moving it
+    """
+    transferred = transferFile(original, newDirectory, moveFileContent, started)
+    if transferred is None:
         return None
-    if not os.path.exists(original):
-        logging.warning("Source (%s) doesn't exist", original)
+    newFilename, method = transferred
+    if methods is not None:
+        methods.append(method)
+    # Files moved back by undo can then have their name again
+    destinationCache.update(os.path.dirname(original), removed=os.path.basename(original))
+
+    return HistoryEntry("move", oldPath=original, newPath=newFilename)
+
+
+def copyFile(original: str, newDirectory: str, methods: list[str] = None, started=None) -> HistoryEntry | None:
+    """
+    Copies the file to the directory, with its metadata, under a random name if the name is taken.
+    The method used is appended to methods, if given, and started is called with the new path before copying it
+    """
+    transferred = transferFile(original, newDirectory, copyFileContent, started)
+    if transferred is None:
         return None
-    splitText = os.path.split(original)
-    newFilename = os.path.join(newDirectory, splitText[1])
-    if os.path.exists(newFilename):
-        randomName = getRandomName(splitText[1])
-        while os.path.exists(os.path.join(newDirectory, randomName)):
-            randomName = getRandomName(splitText[1])
-        newFilename = os.path.join(newDirectory, randomName)
-    # Using copy2 to preserve metadata
-    shutil.copy2(original, newFilename)
-
-    hist = HistoryEntry()
-    hist.action = "copy"
-    hist.oldPath = original
-    hist.newPath = newFilename
-    return hist
+    newFilename, method = transferred
+    if methods is not None:
+        methods.append(method)
+
+    return HistoryEntry("copy", oldPath=original, newPath=newFilename)
 
 
 def deleteCopyFile(original: str, newFilename: str) -> HistoryEntry | None:
@@ -138,12 +431,9 @@ def deleteCopyFile(original: str, newFilename: str) -> HistoryEntry | None:
         return None
     os.remove(newFilename)
     splitText = os.path.split(newFilename)
+    destinationCache.update(splitText[0], removed=splitText[1])
 
-    hist = HistoryEntry()
-    hist.action = "delete_copy"
-    hist.oldPath = original
-    hist.newPath = splitText[0]
-    return hist
+    return HistoryEntry("delete_copy", oldPath=original, newPath=splitText[0])
 
 
 def chooseDirectory(parent: QWidget) -> tuple[bool, str]:
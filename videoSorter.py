@@ -84,7 +84,7 @@ class VideoSorter(MainWindow):
                 self.setFileName(relPath)
                 self.videoPlayer.setMedia(QMediaContent(QUrl.fromLocalFile(absPath)))
                 self.playButton.setEnabled(True)
-                if self.settings.video_autoplay:
+                if self.settings.video_autoplay and not self.gallery.isVisible():
                     self.videoPlayer.play()
                 self.statusBar().showMessage("Playing.")
                 return
@@ -98,6 +98,11 @@ class VideoSorter(MainWindow):
         self.statusBar().showMessage("Pausing.")
         # self.videoWidget.setVisible(False)
 
+    def showGallery(self, shown: bool):
+        if shown:
+            self.videoPlayer.pause()
+        super().showGallery(shown)
+
     def play(self):
         if self.isActive:
             if self.videoPlayer.state() == QMediaPlayer.PlayingState:
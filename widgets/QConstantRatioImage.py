@@ -5,15 +5,22 @@ Module providing a QLabel-herited class with zoom support, which ensures respect
 """
 import logging
 
-from PyQt5.QtCore import Qt, QSize
-from PyQt5.QtGui import QPixmap, QMovie, QImage, QTransform
+from PyQt5.QtCore import Qt, QSize, QRectF, pyqtSignal
+from PyQt5.QtGui import QPixmap, QMovie, QImage, QTransform, QPainter, QPaintEvent
 from PyQt5.QtWidgets import QLabel, QSizePolicy, QWidget
 
+from utils.ImageTiles import TileDecoder, TILESIZE, supportsTiles
+
 
 class QConstantRatioImage(QLabel):
     """
-    Widget to display images with zoom support, which ensures respecting image original ratio
+    Widget to display images with zoom support, which ensures respecting image original ratio.
+    The displayed image may have been decoded at a lower resolution than the file's one, in which case
+    resolutionNeeded is emitted with the needed size (in device pixels) once the image is zoomed past that resolution.
+    Still images are painted by the widget itself, only the exposed part being scaled, and huge images are decoded
+    by tiles around the visible part once zoomed past the decoded resolution, instead of being fully decoded
     """
+    resolutionNeeded = pyqtSignal(str, QSize)
 
     def __init__(self, parent: QWidget = None, zoomFactors: tuple[float, float] = (0.8, 1.25)):
         super().__init__(parent)
@@ -23,6 +30,14 @@ class QConstantRatioImage(QLabel):
         self.minFactor = 0.0
         self.idealFactor = 1.0
         self.myPixmap = QPixmap()
+        self.path = ""
+        # Size of the image in the file, the pixmap may be smaller
+        self.fullSize = QSize()
+        self.fullResolution = True
+        self.rotation = 0
+        self.tiled = False
+        self.tiles = TileDecoder(self)
+        self.tiles.tileReady.connect(self.update)
         self.movie = QMovie()
         self.zoomFactors = zoomFactors
 
@@ -58,13 +73,10 @@ class QConstantRatioImage(QLabel):
     def rotate(self, trigonometric=False):
         if not self.myPixmap:
             return
-        rotMatrix = QTransform()
         if trigonometric:
-            rotMatrix.rotate(90)
+            self.rotation = (self.rotation + 90) % 360
         else:
-            rotMatrix.rotate(-90)
-        self.myPixmap = self.myPixmap.transformed(rotMatrix)
-        self.setPixmap(self.myPixmap)
+            self.rotation = (self.rotation - 90) % 360
         self.rescale()
 
     def resetZoom(self):
@@ -77,32 +89,95 @@ class QConstantRatioImage(QLabel):
         self.scaleFactor = 1.0
         self.rescale()
 
+    def sourceSize(self) -> QSize:
+        """
+        Size of the displayed image at a 1.0 scale factor, whatever the resolution it was decoded at
+        """
+        if not self.myPixmap:
+            return self.movie.currentPixmap().size()
+        if self.rotation % 180:
+            return self.fullSize.transposed()
+        return self.fullSize
+
+    def viewTransform(self) -> QTransform:
+        """
+        Transformation from the unrotated image, displayed at the current scale, to the widget coordinates
+        """
+        rotation = QTransform().rotate(self.rotation)
+        bounds = rotation.mapRect(QRectF(0, 0, self.scaleFactor * self.fullSize.width(),
+                                         self.scaleFactor * self.fullSize.height()))
+        return rotation * QTransform.fromTranslate(-bounds.left(), -bounds.top())
+
+    def needsTiles(self) -> bool:
+        return self.tiled and self.scaleFactor * self.fullSize.width() * self.devicePixelRatioF() \
+            > self.myPixmap.width() + 1
+
     def rescale(self):
-        pixmap = self.myPixmap
-        if not pixmap:
-            pixmap = self.movie.currentPixmap()
-        self.resize(self.scaleFactor * pixmap.size())
+        displayed = self.scaleFactor * self.sourceSize()
+        self.resize(displayed)
+        self.update()
+        if self.myPixmap and not self.fullResolution and not self.tiled:
+            # The pixmap isn't rotated, contrary to the displayed size
+            displayed = self.scaleFactor * self.devicePixelRatioF() * self.fullSize
+            # One pixel of slack, as the displayed and decoded sizes are rounded differently
+            if displayed.width() > self.myPixmap.width() + 1 or displayed.height() > self.myPixmap.height() + 1:
+                self.resolutionNeeded.emit(self.path, displayed)
+
+    def replaceImage(self, image: QImage):
+        """
+        Replaces the displayed image by the same one, decoded at a higher resolution
+        """
+        if image.isNull() or not self.myPixmap:
+            return
+        self.fullResolution = image.size() == self.fullSize
+        self.myPixmap = QPixmap.fromImage(image)
+        self.update()
 
     def getImage(self) -> QImage:
-        pixmap = self.myPixmap
-        if not pixmap:
-            pixmap = self.movie.currentPixmap()
-        return pixmap.toImage()
+        if not self.myPixmap:
+            return self.movie.currentPixmap().toImage()
+        return self.myPixmap.toImage().transformed(QTransform().rotate(self.rotation))
+
+    def paintEvent(self, event: QPaintEvent):
+        if not self.myPixmap:
+            super().paintEvent(event)
+            return
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        transform = self.viewTransform()
+        painter.setTransform(transform)
+        inverted = transform.inverted()[0]
+        # Part of the unrotated image to paint, only this part of the pixmap is scaled
+        exposed = inverted.mapRect(QRectF(event.rect()))
+        ratio = self.myPixmap.width() / (self.scaleFactor * self.fullSize.width())
+        painter.drawPixmap(exposed, self.myPixmap, QRectF(exposed.topLeft() * ratio, exposed.size() * ratio))
+        if self.needsTiles():
+            # Tiles around the visible part are decoded too, so that they're ready when panning
+            visible = inverted.mapRect(QRectF(self.visibleRegion().boundingRect()))
+            visible.adjust(-TILESIZE, -TILESIZE, TILESIZE, TILESIZE)
+            for rect, tile in self.tiles.visibleTiles(self.path, self.fullSize, self.scaleFactor, visible,
+                                                      self.devicePixelRatioF()):
+                if rect.intersects(exposed):
+                    painter.drawImage(rect, tile)
+        painter.end()
 
     def calcIdealFactor(self, windowSize: QSize):
-        pixmap = self.myPixmap
-        if not pixmap:
-            pixmap = self.movie.currentPixmap()
-        if pixmap.size().height() > windowSize.height() or pixmap.size().width() > windowSize.width():
+        size = self.sourceSize()
+        if size.height() > windowSize.height() or size.width() > windowSize.width():
             # dim = True if height is the dim to study
-            self.idealFactor = min(windowSize.height() / pixmap.size().height(), windowSize.width() / pixmap.size().width())
+            self.idealFactor = min(windowSize.height() / size.height(), windowSize.width() / size.width())
             self.idealFactor = min(1.0, self.idealFactor)
 
-    def updateImage(self, newFilename: str, windowSize: QSize = QSize(1920, 1080), mimeType: str = None) -> bool:
+    @staticmethod
+    def isMovie(mimeType: str) -> bool:
+        # For some reason, QMovie.supporterFormats returns only the last part of the mimetype...
+        return mimeType.split('/')[-1] in QMovie.supportedFormats()
+
+    def updateImage(self, newFilename: str, windowSize: QSize = QSize(1920, 1080), mimeType: str = None,
+                    image: QImage = None, fullSize: QSize = None, rotation: int = 0) -> bool:
         working = False
         if newFilename:
-            # For some reason, QMovie.supporterFormats returns only the last part of the mimetype...
-            if mimeType.split('/')[-1] in QMovie.supportedFormats():
+            if self.isMovie(mimeType):
                 self.movie = QMovie(newFilename)
                 if self.movie.isValid():
                     self.setMovie(self.movie)
@@ -111,21 +186,28 @@ class QConstantRatioImage(QLabel):
                 else:
                     logging.error("Movie (%s) isn't valid ", newFilename)
                 self.myPixmap = None
+                self.tiled = False
             else:
-                self.myPixmap = QPixmap(newFilename)
+                # The image may have been decoded beforehand, in which case only the conversion is left
+                self.myPixmap = QPixmap(newFilename) if image is None else QPixmap.fromImage(image)
+                self.path = newFilename
+                self.rotation = rotation
+                self.tiles.cancel()
+                self.clear()
                 if not self.myPixmap.isNull():
-                    pixmapSize = self.myPixmap.size()
-                    if pixmapSize.height() > 0 and pixmapSize.width() > 0:
-                        self.setPixmap(self.myPixmap)
+                    self.fullSize = self.myPixmap.size() if fullSize is None or not fullSize.isValid() else fullSize
+                    self.fullResolution = self.myPixmap.size() == self.fullSize
+                    if self.fullSize.height() > 0 and self.fullSize.width() > 0:
+                        self.tiled = not self.fullResolution and supportsTiles(newFilename, self.fullSize)
 
-                        self.minFactor = 100/max(pixmapSize.height(), pixmapSize.width())
+                        self.minFactor = 100/max(self.fullSize.height(), self.fullSize.width())
 
                         self.calcIdealFactor(windowSize)
 
                         self.scaleFactor = self.idealFactor
                         self.zoomPosition = 0
 
-                        self.adjustSize()
+                        self.resize(self.sourceSize())
                         working = True
                 self.movie = None
         return working
@@ -0,0 +1,173 @@
+"""
+QMediaGallery
+
+Module providing a gallery of the media list, where several media can be selected to apply an action to all of them
+"""
+import os
+
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QObject, QSize, QTimer, QItemSelectionModel
+from PyQt5.QtGui import QKeyEvent, QKeySequence, QResizeEvent, QShowEvent, QHideEvent
+from PyQt5.QtWidgets import QListView, QWidget
+
+from utils.MediaEntry import MediaEntry
+from utils.MediaList import MediaList
+from utils.Thumbnails import ThumbnailLoader
+
+# Keys handled by the gallery, the other ones going to the sorter
+NAVIGATIONKEYS = {Qt.Key_Left, Qt.Key_Right, Qt.Key_Up, Qt.Key_Down, Qt.Key_Home, Qt.Key_End, Qt.Key_PageUp,
+                  Qt.Key_PageDown, Qt.Key_Return, Qt.Key_Enter}
+# Room around the thumbnails, in pixels
+GRIDMARGIN = 16
+# Delay before decoding the visible thumbnails, so that those only scrolled past aren't decoded (ms)
+VISIBLEDELAY = 50
+
+
+class MediaListModel(QAbstractListModel):
+    """
+    Model of the media list. Its rows are only updated when synchronized with the list, so that the view is told
+    about the entries added or removed: entries appended are inserted, any other change resets the model
+    """
+    def __init__(self, thumbnails: ThumbnailLoader, parent: QObject = None):
+        super().__init__(parent)
+        self.thumbnails = thumbnails
+        self.mediaList = MediaList()
+        self.rows = 0
+        self.version = self.mediaList.structureVersion
+        # Set while rows are removed or reset, the current row then changing without being chosen by the user
+        self.updating = False
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else self.rows
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole):
+        if not index.isValid() or index.row() >= self.rows:
+            return None
+        if role == Qt.DisplayRole:
+            return os.path.basename(self.mediaList.getPath(index.row()))
+        if role == Qt.ToolTipRole:
+            return self.mediaList.getPath(index.row())
+        if role == Qt.DecorationRole:
+            return self.thumbnails.thumbnail(self.mediaList.getPath(index.row()))
+        return None
+
+    def synchronize(self, mediaList: MediaList):
+        if mediaList is self.mediaList and mediaList.structureVersion == self.version:
+            if len(mediaList) > self.rows:
+                self.beginInsertRows(QModelIndex(), self.rows, len(mediaList) - 1)
+                self.rows = len(mediaList)
+                self.endInsertRows()
+            return
+        if mediaList is not self.mediaList:
+            self.thumbnails.forgetFailures()
+        self.updating = True
+        self.beginResetModel()
+        self.mediaList = mediaList
+        self.rows = len(mediaList)
+        self.version = mediaList.structureVersion
+        self.endResetModel()
+        self.updating = False
+
+    def pop(self, mediaList: MediaList, position: int) -> MediaEntry:
+        """
+        Removes an entry from the media list, telling the view which row was removed
+        """
+        self.synchronize(mediaList)
+        self.updating = True
+        self.beginRemoveRows(QModelIndex(), position, position)
+        entry = mediaList.pop(position)
+        self.rows -= 1
+        self.version = mediaList.structureVersion
+        self.endRemoveRows()
+        self.updating = False
+        return entry
+
+
+class QMediaGallery(QListView):
+    """
+    Grid of thumbnails of the media list. Only the rows shown are laid out and painted by the view, and only the
+    thumbnails of the visible media are decoded
+    """
+    def __init__(self, model: MediaListModel, thumbnails: ThumbnailLoader, parent: QWidget = None):
+        super().__init__(parent)
+        self.thumbnails = thumbnails
+        self.visibleTimer = QTimer(self)
+        self.visibleTimer.setSingleShot(True)
+        self.visibleTimer.setInterval(VISIBLEDELAY)
+
+        self.setViewMode(QListView.IconMode)
+        self.setMovement(QListView.Static)
+        self.setResizeMode(QListView.Adjust)
+        self.setUniformItemSizes(True)
+        # Huge lists are laid out in the background
+        self.setLayoutMode(QListView.Batched)
+        self.setBatchSize(1000)
+        self.setVerticalScrollMode(QListView.ScrollPerPixel)
+        self.setSelectionMode(QListView.ExtendedSelection)
+        self.setTextElideMode(Qt.ElideMiddle)
+        self.setModel(model)
+        self.setThumbnailSize(thumbnails.size.width())
+
+        self.visibleTimer.timeout.connect(self.loadVisible)
+        self.verticalScrollBar().valueChanged.connect(self.visibleTimer.start)
+        model.modelReset.connect(self.visibleTimer.start)
+        model.rowsInserted.connect(self.visibleTimer.start)
+        model.rowsRemoved.connect(self.visibleTimer.start)
+        thumbnails.thumbnailDecoded.connect(self.viewport().update)
+
+    def setThumbnailSize(self, size: int):
+        self.setIconSize(QSize(size, size))
+        self.setGridSize(QSize(size + GRIDMARGIN, size + GRIDMARGIN + self.fontMetrics().height()))
+        self.thumbnails.setSize(size)
+        self.visibleTimer.start()
+
+    def visibleRows(self) -> range:
+        """
+        Rows of the media shown, items being laid out on a grid from left to right
+        """
+        grid = self.gridSize()
+        columns = max(1, self.viewport().width() // grid.width())
+        first = self.verticalOffset() // grid.height() * columns
+        last = ((self.verticalOffset() + self.viewport().height()) // grid.height() + 1) * columns
+        return range(first, min(last, self.model().rowCount()))
+
+    def loadVisible(self):
+        if not self.isVisible():
+            self.thumbnails.load([])
+            return
+        mediaList = self.model().mediaList
+        self.thumbnails.load([mediaList[row] for row in self.visibleRows()])
+
+    def selectedPositions(self) -> list[int]:
+        rows = set()
+        for selectionRange in self.selectionModel().selection():
+            rows.update(range(selectionRange.top(), selectionRange.bottom() + 1))
+        return sorted(rows)
+
+    def setCurrentPosition(self, position: int):
+        """
+        Makes a media the current and only selected one, unless it's already the current one
+        """
+        if not 0 <= position < self.model().rowCount() or self.currentIndex().row() == position:
+            return
+        index = self.model().index(position)
+        self.selectionModel().setCurrentIndex(index, QItemSelectionModel.ClearAndSelect)
+        self.scrollTo(index)
+
+    def keyPressEvent(self, event: QKeyEvent):
+        if event.key() in NAVIGATIONKEYS or event.matches(QKeySequence.SelectAll):
+            super().keyPressEvent(event)
+        else:
+            # Bindings are handled by the sorter
+            event.ignore()
+
+    def resizeEvent(self, event: QResizeEvent):
+        super().resizeEvent(event)
+        self.visibleTimer.start()
+
+    def showEvent(self, event: QShowEvent):
+        super().showEvent(event)
+        self.visibleTimer.start()
+
+    def hideEvent(self, event: QHideEvent):
+        super().hideEvent(event)
+        self.visibleTimer.start()
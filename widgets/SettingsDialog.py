@@ -7,7 +7,7 @@ from PyQt5.QtCore import Qt, QSize
 from PyQt5.QtWidgets import QDialog, QWidget, QTabWidget, QVBoxLayout, QHBoxLayout, QPushButton, QSpinBox, \
     QDoubleSpinBox, QCheckBox, QComboBox, QFormLayout, QGroupBox
 
-from utils.Settings import Settings, SortMethod
+from utils.Settings import Settings, SortMethod, MimeDetection
 
 
 class SettingsDialog(QDialog):
@@ -38,13 +38,29 @@ class SettingsDialog(QDialog):
         self.global_historyLength = QSpinBox()
         self.global_autosort = QCheckBox()
         self.global_sort_method = QComboBox()
+        self.global_fileOperations_perDestination = QSpinBox()
+        self.global_fileOperations_journal = QCheckBox()
+        self.global_gallery_thumbnailSize = QSpinBox()
         self.global_indexing_async = QCheckBox()
         self.global_indexing_threads = QSpinBox()
         self.global_indexing_refreshPeriod = QSpinBox()
         self.global_indexing_batchSize = QSpinBox()
+        self.global_indexing_chunkSize = QSpinBox()
         self.global_indexing_batchTime = QCheckBox()
         self.global_indexing_batchTimeLimit = QDoubleSpinBox()
         self.global_indexing_recursive = QCheckBox()
+        self.global_indexing_parallelDirs = QCheckBox()
+        self.global_indexing_mimeDetection = QComboBox()
+        self.global_indexing_cache = QCheckBox()
+        self.global_indexing_duplicates = QCheckBox()
+        self.global_indexing_hideDuplicates = QCheckBox()
+
+        self.image_prefetchNext = QSpinBox()
+        self.image_prefetchPrevious = QSpinBox()
+        self.image_cacheSize = QSpinBox()
+        self.image_rotationSidecars = QCheckBox()
+        self.image_similarity = QCheckBox()
+        self.image_similarityThreshold = QSpinBox()
 
         self.video_volume = QSpinBox()
         self.video_autoplay = QCheckBox()
@@ -68,16 +84,44 @@ class SettingsDialog(QDialog):
         self.layoutGlobalGlobal.addRow("Undo/Redo history length", self.global_historyLength)
         self.layoutGlobalGlobal.addRow("Auto-sort list when indexing completes (default: False)", self.global_autosort)
         self.layoutGlobalGlobal.addRow("Select sorting method (default: none)", self.global_sort_method)
+        self.layoutGlobalGlobal.addRow("Amount of files moved/copied at the same time to a given folder (default: 1)",
+                                       self.global_fileOperations_perDestination)
+        self.layoutGlobalGlobal.addRow("Journal actions, to resume or roll back a session after closing (default: True)",
+                                       self.global_fileOperations_journal)
+        self.layoutGlobalGlobal.addRow("Size of the thumbnails of the gallery (default: 160px)",
+                                       self.global_gallery_thumbnailSize)
         self.layoutIndexing.addRow("Use Async indexing, highly recommended especially on slow storage/huge folders ("
                                  "Default: True)", self.global_indexing_async)
         self.layoutIndexing.addRow("Set amount of threads for async indexing (-1/0 means half available cores)",
                                  self.global_indexing_threads)
         self.layoutIndexing.addRow("Set indexing refresh period (default: 50ms)", self.global_indexing_refreshPeriod)
         self.layoutIndexing.addRow("Set batching size for indexing (default: 50 items)", self.global_indexing_batchSize)
+        self.layoutIndexing.addRow("Set amount of files sent at once to each indexing worker (default: 64 files)",
+                                 self.global_indexing_chunkSize)
         self.layoutIndexing.addRow("Enable/Disable batching limit on time rather than amount (default: False)",
                                  self.global_indexing_batchTime)
         self.layoutIndexing.addRow("Set batching time limit (default: 0.5s)", self.global_indexing_batchTimeLimit)
         self.layoutIndexing.addRow("Index recursively (default: False)", self.global_indexing_recursive)
+        self.layoutIndexing.addRow("Let each async worker scan its own subdirectories, useful on network storage ("
+                                 "Default: False)", self.global_indexing_parallelDirs)
+        self.layoutIndexing.addRow("Select how file types are detected (default: file name and content)",
+                                 self.global_indexing_mimeDetection)
+        self.layoutIndexing.addRow("Keep an index cache, so that only modified directories are indexed again ("
+                                 "Default: True)", self.global_indexing_cache)
+        self.layoutIndexing.addRow("Find duplicate files while indexing asynchronously (Default: False)",
+                                 self.global_indexing_duplicates)
+        self.layoutIndexing.addRow("Hide the duplicates found, keeping the first copy found (Default: False)",
+                                 self.global_indexing_hideDuplicates)
+
+        self.layoutImage.addRow("Amount of next images decoded in advance (default: 3)", self.image_prefetchNext)
+        self.layoutImage.addRow("Amount of previous images kept decoded (default: 1)", self.image_prefetchPrevious)
+        self.layoutImage.addRow("Memory used to keep decoded images (default: 512MB)", self.image_cacheSize)
+        self.layoutImage.addRow("Save rotations in XMP sidecar files, next to the images (default: False)",
+                                self.image_rotationSidecars)
+        self.layoutImage.addRow("Find similar images (resized or re-encoded copies) (default: False)",
+                                self.image_similarity)
+        self.layoutImage.addRow("Bits two similar images may differ by, higher values being slower (default: 7)",
+                                self.image_similarityThreshold)
 
         self.layoutVideo.addRow("Video volume", self.video_volume)
         self.layoutVideo.addRow("Auto-play videos", self.video_autoplay)
@@ -86,15 +130,26 @@ class SettingsDialog(QDialog):
         self.buttonLayout.addWidget(self.cancelButton)
 
         self.global_historyLength.setMinimum(5)
-        self.global_historyLength.setMaximum(100)
+        self.global_historyLength.setMaximum(100000)
+        self.global_fileOperations_perDestination.setMinimum(1)
+        self.global_fileOperations_perDestination.setMaximum(8)
+        self.global_gallery_thumbnailSize.setMinimum(32)
+        self.global_gallery_thumbnailSize.setMaximum(512)
+        self.global_gallery_thumbnailSize.setSuffix(" px")
         self.global_indexing_threads.setMinimum(-1)
         self.global_indexing_threads.setMaximum(100)
         self.global_indexing_refreshPeriod.setMinimum(5)
         self.global_indexing_refreshPeriod.setMaximum(1000)
         self.global_indexing_batchSize.setMinimum(1)
         self.global_indexing_batchSize.setMaximum(10000)
+        self.global_indexing_chunkSize.setMinimum(1)
+        self.global_indexing_chunkSize.setMaximum(10000)
         self.global_indexing_batchTimeLimit.setMinimum(0.01)
         self.global_indexing_batchTimeLimit.setMaximum(1.0)
+        self.global_indexing_mimeDetection.addItem("file extension only (fastest)", MimeDetection.extension)
+        self.global_indexing_mimeDetection.addItem("file extension, content if ambiguous",
+                                                   MimeDetection.extensionThenContent)
+        self.global_indexing_mimeDetection.addItem("file name and content", MimeDetection.content)
         self.global_sort_method.addItem("none", SortMethod.none)
         self.global_sort_method.addItem("name (alphabetical)", SortMethod.name)
         self.global_sort_method.addItem("name (reverse)", SortMethod.nameRev)
@@ -105,6 +160,16 @@ class SettingsDialog(QDialog):
         self.global_sort_method.addItem("modification date (increasing)", SortMethod.modifDate)
         self.global_sort_method.addItem("modification date (decreasing)", SortMethod.modifDateDec)
 
+        self.image_prefetchNext.setMinimum(0)
+        self.image_prefetchNext.setMaximum(50)
+        self.image_prefetchPrevious.setMinimum(0)
+        self.image_prefetchPrevious.setMaximum(50)
+        self.image_cacheSize.setMinimum(0)
+        self.image_cacheSize.setMaximum(65536)
+        self.image_cacheSize.setSuffix(" MB")
+        self.image_similarityThreshold.setMinimum(0)
+        self.image_similarityThreshold.setMaximum(12)
+
         self.video_volume.setMinimum(0)
         self.video_volume.setMaximum(100)
 
@@ -116,11 +181,27 @@ class SettingsDialog(QDialog):
         self.global_indexing_threads.setValue(self.settings.indexing_threads)
         self.global_indexing_refreshPeriod.setValue(self.settings.indexing_refreshPeriod)
         self.global_indexing_batchSize.setValue(self.settings.indexing_batchSize)
+        self.global_indexing_chunkSize.setValue(self.settings.indexing_chunkSize)
         self.global_indexing_batchTime.setChecked(self.settings.indexing_batchTime)
         self.global_indexing_batchTimeLimit.setValue(self.settings.indexing_batchTimeLimit)
         self.global_indexing_recursive.setChecked(self.settings.indexing_recursive)
+        self.global_indexing_parallelDirs.setChecked(self.settings.indexing_parallelDirs)
+        self.global_indexing_mimeDetection.setCurrentIndex(self.settings.indexing_mimeDetection.value)
+        self.global_indexing_cache.setChecked(self.settings.indexing_cache)
+        self.global_indexing_duplicates.setChecked(self.settings.indexing_duplicates)
+        self.global_indexing_hideDuplicates.setChecked(self.settings.indexing_hideDuplicates)
         self.global_autosort.setChecked(self.settings.autosort)
         self.global_sort_method.setCurrentIndex(self.settings.sort_method.value)
+        self.global_fileOperations_perDestination.setValue(self.settings.fileOperations_perDestination)
+        self.global_fileOperations_journal.setChecked(self.settings.fileOperations_journal)
+        self.global_gallery_thumbnailSize.setValue(self.settings.gallery_thumbnailSize)
+
+        self.image_prefetchNext.setValue(self.settings.image_prefetchNext)
+        self.image_prefetchPrevious.setValue(self.settings.image_prefetchPrevious)
+        self.image_cacheSize.setValue(self.settings.image_cacheSize)
+        self.image_rotationSidecars.setChecked(self.settings.image_rotationSidecars)
+        self.image_similarity.setChecked(self.settings.image_similarity)
+        self.image_similarityThreshold.setValue(self.settings.image_similarityThreshold)
 
         self.video_volume.setValue(self.settings.volume)
         self.video_autoplay.setChecked(self.settings.video_autoplay)
@@ -131,11 +212,27 @@ class SettingsDialog(QDialog):
         self.settings.indexing_threads = self.global_indexing_threads.value()
         self.settings.indexing_refreshPeriod = self.global_indexing_refreshPeriod.value()
         self.settings.indexing_batchSize = self.global_indexing_batchSize.value()
+        self.settings.indexing_chunkSize = self.global_indexing_chunkSize.value()
         self.settings.indexing_batchTime = self.global_indexing_batchTime.isChecked()
         self.settings.indexing_batchTimeLimit = self.global_indexing_batchTimeLimit.value()
         self.settings.indexing_recursive = self.global_indexing_recursive.isChecked()
+        self.settings.indexing_parallelDirs = self.global_indexing_parallelDirs.isChecked()
+        self.settings.indexing_mimeDetection = MimeDetection(self.global_indexing_mimeDetection.currentIndex())
+        self.settings.indexing_cache = self.global_indexing_cache.isChecked()
+        self.settings.indexing_duplicates = self.global_indexing_duplicates.isChecked()
+        self.settings.indexing_hideDuplicates = self.global_indexing_hideDuplicates.isChecked()
         self.settings.autosort = self.global_autosort.isChecked()
         self.settings.sort_method = SortMethod(self.global_sort_method.currentIndex())
+        self.settings.fileOperations_perDestination = self.global_fileOperations_perDestination.value()
+        self.settings.fileOperations_journal = self.global_fileOperations_journal.isChecked()
+        self.settings.gallery_thumbnailSize = self.global_gallery_thumbnailSize.value()
+
+        self.settings.image_prefetchNext = self.image_prefetchNext.value()
+        self.settings.image_prefetchPrevious = self.image_prefetchPrevious.value()
+        self.settings.image_cacheSize = self.image_cacheSize.value()
+        self.settings.image_rotationSidecars = self.image_rotationSidecars.isChecked()
+        self.settings.image_similarity = self.image_similarity.isChecked()
+        self.settings.image_similarityThreshold = self.image_similarityThreshold.value()
 
         self.settings.volume = self.video_volume.value()
         self.settings.video_autoplay = self.video_autoplay.isChecked()
@@ -6,12 +6,12 @@ Module providing the base for creating a Sorter
 imageSorter & videoSorter inherit from this base class
 """
 
+import collections
 import copy
 import logging
-import pickle
 import math
 
-from PyQt5.QtCore import Qt, pyqtSlot, QTimer, QPoint, QByteArray, QCoreApplication
+from PyQt5.QtCore import Qt, pyqtSlot, QTimer, QPoint, QByteArray, QCoreApplication, QModelIndex
 from PyQt5.QtGui import QGuiApplication, QWheelEvent, QKeyEvent, QCloseEvent
 from PyQt5.QtWidgets import QMainWindow, \
     QAction, QTableWidget, QAbstractItemView, QTableWidgetItem, QFileDialog, QSplitter, QVBoxLayout, QWidget, QLabel, \
@@ -19,13 +19,28 @@ from PyQt5.QtWidgets import QMainWindow, \
 
 from utils import fileUtils as fsUtils
 from utils import AsyncDirectoryIndexer
+from utils import IndexCache
+from utils import IndexFile
 from utils import BindingsGlobals
+from utils.Duplicates import DuplicateFinder, defaultHashCachePath
+from utils.FileOperations import FileOperation, FileOperationQueue
+from utils.MediaEntry import MediaEntry
+from utils.MediaList import MediaList
+from utils.MediaSort import SortWorker, mergeSorted, sortedPosition
+from utils.OperationJournal import OperationJournal, SessionJournal, defaultJournalDirectory, historyRecord, \
+    sessionJournals, writeRecords
 from utils.Settings import Settings, SortMethod
-from utils.UndoRedo import HistoryEntry, doHistory
+from utils.Thumbnails import ThumbnailLoader
+from utils.UndoRedo import History, HistoryEntry, doHistory
 from widgets.QJumpWindow import QJumpWindow
+from widgets.QMediaGallery import MediaListModel, QMediaGallery
 from widgets.bindingsWindow import BindingsWindow
 from widgets.SettingsDialog import SettingsDialog
 
+# Amount of entries read from a directory index before displaying the first one, then at each loading step
+INDEXFIRSTCHUNK = 1000
+INDEXLOADCHUNK = 50000
+
 
 class MainWindow(QMainWindow):
     """
@@ -44,7 +59,7 @@ class MainWindow(QMainWindow):
         logging.getLogger().setLevel(self.settings.logLevel)
         self.title = "MediaSorter"
         self.mediaListPosition = 0
-        self.mediaList = []
+        self.mediaList = MediaList()
         self.path = ".."
         self.configFilePath = ""
         self.bindings = {}
@@ -52,8 +67,23 @@ class MainWindow(QMainWindow):
         self.forbiddenKeys += self.settings.globalKeys.keys()
         self.isActive = False
         self.nonexist = False
-        self.undoHistory = []
-        self.redoHistory = []
+        # Oldest entries are dropped by the deques once historyLength is reached
+        self.undoHistory: History = collections.deque(maxlen=self.settings.historyLength)
+        self.redoHistory: History = collections.deque(maxlen=self.settings.historyLength)
+        self.journal = OperationJournal(defaultJournalDirectory())
+        # Previous session whose history is restored once its directory is opened again
+        self.resumedSession: SessionJournal | None = None
+        self.sortWorker: SortWorker | None = None
+        self.sortRequested = False
+        self.sortSource: MediaList | None = None
+        self.sortSourceVersion = 0
+        self.sortHistory: list[HistoryEntry] = []
+        # Method the media list is known to be sorted by, so that new entries can be merged in
+        self.sortedBy: SortMethod | None = None
+        # Duplicates found while indexing the media list, None if they aren't looked for
+        self.duplicates: DuplicateFinder | None = None
+        # Duplicates to hide once they're fetched from the indexer
+        self.duplicatesToHide: set[str] = set()
         self.origPos = None
         self.origHor = None
         self.origVer = None
@@ -67,11 +97,16 @@ class MainWindow(QMainWindow):
         self.openConfigAction = QAction("Open Config")
         self.newConfigAction = QAction("New Config")
         self.reloadAction = QAction("Reload")
+        self.resumeSessionAction = QAction("Resume last session")
+        self.rollbackSessionAction = QAction("Roll back last session")
+        self.replaySessionAction = QAction("Replay last session")
         self.quitAction = QAction("Quit")
         self.undoAction = QAction("Undo")
         self.redoAction = QAction("Redo")
         self.sortAction = QAction("Sort media list")
         self.jumpToAction = QAction("Jump To")
+        self.nextDuplicateAction = QAction("Jump to next duplicate")
+        self.galleryAction = QAction("Gallery")
         self.editConfigAction = QAction("Edit config")
         self.settingsAction = QAction("Settings")
         self.aboutAction = QAction("About")
@@ -83,12 +118,19 @@ class MainWindow(QMainWindow):
         self.fileNameLabel = QLabel("Current file : None")
         self.actionsAvailable = QTableWidget(1, 2, self)
         self.progressionLabel = QLabel("0/0")
+        self.thumbnails = ThumbnailLoader(self.settings.gallery_thumbnailSize, self)
+        self.galleryModel = MediaListModel(self.thumbnails, self)
+        self.gallery = QMediaGallery(self.galleryModel, self.thumbnails)
+        self.fileOperationsLabel = QLabel()
         self.bottomLayout = QHBoxLayout()
 
         self.clipboard = QGuiApplication.clipboard()
 
         self.asyncIndexer = AsyncDirectoryIndexer.AsyncDirectoryIndexer(threads=self.settings.indexing_threads)
         self.asyncIndexerTimer = QTimer()
+        self.indexReader: IndexFile.IndexReader | None = None
+        self.indexLoaderTimer = QTimer()
+        self.fileOperations = FileOperationQueue(self.settings.fileOperations_perDestination, self, self.journal)
 
         # initUI will be called on herited classes
 
@@ -97,6 +139,7 @@ class MainWindow(QMainWindow):
         self.setWindowTitle(self.title)
 
         size, pos = self.settings.restore()
+        self.resizeHistory()
         self.resize(size)
         self.move(pos)
 
@@ -108,12 +151,18 @@ class MainWindow(QMainWindow):
         self.fileMenu.addAction(self.newConfigAction)
         self.fileMenu.addAction(self.reloadAction)
         self.fileMenu.addSeparator()
+        self.fileMenu.addAction(self.resumeSessionAction)
+        self.fileMenu.addAction(self.rollbackSessionAction)
+        self.fileMenu.addAction(self.replaySessionAction)
+        self.fileMenu.addSeparator()
         self.fileMenu.addAction(self.quitAction)
         self.actionMenu.addAction(self.undoAction)
         self.actionMenu.addAction(self.redoAction)
         self.actionMenu.addSeparator()
         self.actionMenu.addAction(self.sortAction)
         self.actionMenu.addAction(self.jumpToAction)
+        self.actionMenu.addAction(self.nextDuplicateAction)
+        self.actionMenu.addAction(self.galleryAction)
         self.actionMenu.addSeparator()
         self.actionMenu.addAction(self.editConfigAction)
         self.actionMenu.addSeparator()
@@ -122,9 +171,15 @@ class MainWindow(QMainWindow):
 
         self.quitAction.triggered.connect(self.close)
         self.reloadAction.triggered.connect(self.prepareMediaList)
+        self.resumeSessionAction.triggered.connect(self.resumeSession)
+        self.rollbackSessionAction.triggered.connect(self.rollbackSession)
+        self.replaySessionAction.triggered.connect(self.replaySession)
         self.undoAction.triggered.connect(self.undo)
         self.redoAction.triggered.connect(self.redo)
         self.jumpToAction.triggered.connect(self.jumpTo)
+        self.nextDuplicateAction.triggered.connect(self.nextDuplicate)
+        self.galleryAction.setCheckable(True)
+        self.galleryAction.toggled.connect(self.showGallery)
         self.sortAction.triggered.connect(self.sortMediaList)
         self.openDirectoryAction.triggered.connect(self.chooseDir)
         self.saveDirectoryIndexAction.triggered.connect(self.saveDirIndex)
@@ -140,6 +195,12 @@ class MainWindow(QMainWindow):
         self.actionWidget.setLayout(self.actionLayout)
         self.actionLayout.addWidget(self.actionsAvailable)
         self.myWidget.addWidget(self.actionWidget)
+        # Shown instead of the media viewer added by sorters
+        self.myWidget.addWidget(self.gallery)
+        self.gallery.hide()
+        self.gallery.setThumbnailSize(self.settings.gallery_thumbnailSize)
+        self.gallery.selectionModel().currentChanged.connect(self.galleryCurrentChanged)
+        self.gallery.activated.connect(self.galleryActivated)
         self.mainWidget.setLayout(self.mainLayout)
         self.mainLayout.addWidget(self.myWidget)
         self.mainLayout.addLayout(self.bottomLayout)
@@ -159,7 +220,14 @@ class MainWindow(QMainWindow):
         self.progressionLabel.setWordWrap(False)
 
         self.asyncIndexerTimer.timeout.connect(self.asyncPeriodicChecker)
+        self.indexLoaderTimer.timeout.connect(self.loadDirIndexStep)
+        self.fileOperations.finished.connect(self.fileOperationFinished)
+        self.fileOperations.failed.connect(self.fileOperationFailed)
+        self.fileOperations.pendingChanged.connect(self.updateFileOperationsLabel)
+        self.fileOperations.setPerDestination(self.settings.fileOperations_perDestination)
+        self.statusBar().addPermanentWidget(self.fileOperationsLabel)
         self.statusBar().showMessage("Ready.")
+        self.recoverJournal()
 
     def adjustSplitter(self):
         # Initial repartition of the screen : 35%/65%
@@ -170,21 +238,37 @@ class MainWindow(QMainWindow):
         # self.myWidget.moveSplitter(math.ceil(self.myWidget.size().width()/3), 1)
 
     def prepareMediaList(self, _triggered: bool = False, path: str = None, matchingMime: list[QByteArray] = None):
+        self.finishFileOperations()
         if path is not None:
             self.path = path
+        self.stopDirIndexLoading()
         self.mediaListPosition = 0
-        self.mediaList = []
-        self.emptyUndoRedo()
+        self.mediaList = MediaList()
+        self.sortedBy = None
+        self.duplicates = None
+        self.duplicatesToHide = set()
+        self.startSession()
+        self.newMediaList()
         self.updateCurrentMedia()
         self.isActive = False
+        self.updateProgress()
+        cachePath = IndexCache.defaultCachePath() if self.settings.indexing_cache else None
+        hashCachePath = defaultHashCachePath() if self.settings.indexing_cache else None
         if self.settings.indexing_async:
-            if self.asyncIndexer.asyncIndex(self.path, matchingMime, self.settings.indexing_recursive):
+            if self.asyncIndexer.asyncIndex(self.path, matchingMime, self.settings.indexing_recursive,
+                                            self.settings.indexing_chunkSize, self.settings.indexing_parallelDirs,
+                                            self.settings.indexing_mimeDetection, cachePath,
+                                            self.settings.indexing_duplicates, hashCachePath):
+                self.duplicates = self.asyncIndexer.duplicates
                 logging.debug("Asynchronous indexing started")
                 self.statusBar().showMessage(f"Starting to index {self.path}.")
                 self.asyncIndexerTimer.start(self.settings.indexing_refreshPeriod)  #ms
         else:
             self.statusBar().showMessage("Directory indexing has started.")
-            self.mediaList = fsUtils.listFiles(self.path, matchingMime, self.settings.indexing_recursive)
+            entries = fsUtils.listFiles(self.path, matchingMime, self.settings.indexing_recursive,
+                                        self.settings.indexing_mimeDetection, cachePath)
+            self.mediaList = MediaList(entries)
+            self.indexedMedia(entries)
             self.statusBar().showMessage("Directory indexing has finished.")
             logging.debug("Synchronous Indexing ended")
             if len(self.mediaList) > 0:
@@ -196,68 +280,402 @@ class MainWindow(QMainWindow):
                 logging.info("Synchronous indexing found suitable files, activating the window")
 
     def sortMediaList(self):
-        if self.isActive:
-            logging.info("Sorting media list")
-            self.statusBar().showMessage("Sorting media list.")
-            self.mediaListPosition = 0
-            if self.settings.sort_method == SortMethod.name:
-                self.mediaList.sort()
-            elif self.settings.sort_method == SortMethod.nameRev:
-                self.mediaList.sort(reverse=True)
-            elif self.settings.sort_method == SortMethod.size:
-                self.mediaList.sort(key=lambda x: x.getSize())
-            elif self.settings.sort_method == SortMethod.sizeDec:
-                self.mediaList.sort(key=lambda x: x.getSize(), reverse=True)
-            elif self.settings.sort_method == SortMethod.creatDate:
-                self.mediaList.sort(key=lambda x: x.getCreatDate())
-            elif self.settings.sort_method == SortMethod.creatDateDec:
-                self.mediaList.sort(key=lambda x: x.getCreatDate(), reverse=True)
-            elif self.settings.sort_method == SortMethod.modifDate:
-                self.mediaList.sort(key=lambda x: x.getModifDate())
-            elif self.settings.sort_method == SortMethod.modifDateDec:
-                self.mediaList.sort(key=lambda x: x.getModifDate(), reverse=True)
-            self.updateProgress()
-            self.updateCurrentMedia()
-            self.emptyUndoRedo()
+        if not self.isActive or self.settings.sort_method == SortMethod.none:
+            return
+        if self.sortWorker is not None:
+            # The running sort is started again once finished, as the list or the method may have changed
+            self.sortRequested = True
+            return
+        logging.info("Sorting media list")
+        self.statusBar().showMessage("Sorting media list.")
+        self.sortRequested = False
+        self.sortSource = self.mediaList
+        self.sortSourceVersion = self.mediaList.structureVersion
+        self.sortHistory = [hist for hist in (*self.undoHistory, *self.redoHistory) if hist.entry is not None]
+        self.sortWorker = SortWorker(self.mediaList.copy(), self.settings.sort_method,
+                                     [hist.entry for hist in self.sortHistory], self)
+        self.sortWorker.finished.connect(self.sortFinished)
+        self.sortWorker.start()
+
+    def sortFinished(self):
+        worker = self.sortWorker
+        self.sortWorker = None
+        worker.deleteLater()
+        source, self.sortSource = self.sortSource, None
+        if self.mediaList is not source:
+            logging.info("Media list was replaced while sorting, dropping the sorted list")
+            return
+        if self.sortRequested or self.mediaList.structureVersion != self.sortSourceVersion:
+            logging.info("Media list was modified while sorting, sorting again")
+            self.sortMediaList()
+            return
+        sortedList = worker.mediaList
+        # Entries appended meanwhile (asynchronous indexing) are kept after the sorted ones
+        for i in range(len(sortedList), len(self.mediaList)):
+            sortedList.append(self.mediaList[i])
+        if self.mediaListPosition < len(worker.order):
+            # The displayed media stays the same, only its position changes
+            self.mediaListPosition = worker.newPositions[self.mediaListPosition]
+        positions = {id(hist): position for hist, position in zip(self.sortHistory, worker.historyPositions)
+                     if position >= 0}
+        if positions:
+            self.undoHistory = self.repositionHistory(self.undoHistory, positions)
+            self.redoHistory = self.repositionHistory(self.redoHistory, positions)
+        self.sortHistory = []
+        self.mediaList = sortedList
+        self.sortedBy = worker.method if len(sortedList) == len(worker.order) else None
+        self.statusBar().showMessage("Media list sorted.")
+        logging.info("Media list sorted")
+        self.updateProgress()
+        self.updateCurrentMedia()
 
     def asyncPeriodicChecker(self):
-        progress = self.asyncIndexer.progress()
         if self.settings.indexing_batchTime:
             newEntries = self.asyncIndexer.getBulkTimed(self.settings.indexing_batchTimeLimit)
         else:
             newEntries = self.asyncIndexer.getBulk(self.settings.indexing_batchSize)
+        if self.duplicates is not None and self.settings.indexing_hideDuplicates:
+            newEntries = self.hideDuplicates(newEntries or [])
         if newEntries and len(newEntries) > 0:
             flag = (len(self.mediaList) == 0)
-            self.mediaList += newEntries
+            if self.canMergeSorted():
+                # The list stays sorted, and the displayed media stays the same
+                self.sortedBy = self.settings.sort_method
+                positions = mergeSorted(self.mediaList, newEntries, self.sortedBy)
+                if not flag:
+                    self.shiftPositions(positions)
+            else:
+                self.mediaList += newEntries
+            self.indexedMedia(newEntries)
             if flag:
                 self.updateCurrentMedia()
                 self.isActive = True
                 logging.info("Asynchronous indexing found suitable files, activating the window")
             self.updateProgress()
-        if progress[0] == progress[1]:
-            self.statusBar().showMessage("Directory indexing has finished.")
+        indexed, discovered = self.asyncIndexer.progress()
+        if self.asyncIndexer.isFinished():
+            if self.duplicates is not None:
+                self.statusBar().showMessage(f"Directory indexing has finished ({indexed} files indexed, "
+                                             f"{self.duplicates.groupCount()} files with duplicates).")
+                self.updateProgress()
+            else:
+                self.statusBar().showMessage(f"Directory indexing has finished ({indexed} files indexed).")
             logging.debug("Asynchronous Indexing ended, stopping periodic check")
             self.asyncIndexerTimer.stop()
             self.asyncIndexer.stopProcess()
-            if self.settings.autosort:
+            if self.settings.autosort and self.sortedBy != self.settings.sort_method:
                 self.sortMediaList()
+        else:
+            self.statusBar().showMessage(f"Indexing {self.path}: {indexed} indexed / {discovered} discovered.")
+
+    def hideDuplicates(self, newEntries: list[MediaEntry]) -> list[MediaEntry]:
+        """
+        Removes the duplicates found since the last call from the list, and returns the new entries without them.
+        Duplicates not fetched from the indexer yet are removed once they are
+        """
+        self.duplicatesToHide.update(self.duplicates.takeDuplicates())
+        if not self.duplicatesToHide:
+            return newEntries
+        entries = [entry for entry in newEntries if entry.path not in self.duplicatesToHide]
+        self.duplicatesToHide.difference_update(entry.path for entry in newEntries)
+        pendingPaths = {entry.path for entry in self.asyncIndexer.pending}
+        positions = self.findPositions(self.duplicatesToHide.difference(pendingPaths))
+        self.duplicatesToHide.intersection_update(pendingPaths)
+        if positions:
+            currentRemoved = False
+            for position in sorted(positions.values(), reverse=True):
+                self.mediaList.pop(position)
+                if position < self.mediaListPosition:
+                    self.mediaListPosition -= 1
+                elif position == self.mediaListPosition:
+                    currentRemoved = True
+            logging.info("Hid %s duplicates", len(positions))
+            if currentRemoved:
+                self.next(move=False)
+            else:
+                self.updateProgress()
+        return entries
 
-    def addNewUndo(self, action: HistoryEntry):
-        self.redoHistory = []
+    def findPositions(self, paths: set[str]) -> dict[str, int]:
+        """
+        Returns the position of the files of the media list among paths
+        """
+        positions = {}
+        for path in paths:
+            position = self.mediaList.positionOf(path)
+            if position is not None:
+                positions[path] = position
+        return positions
+
+    def nextDuplicate(self):
+        """
+        Jumps to the next file with the same content as the current one
+        """
+        if not self.isActive or self.duplicates is None:
+            self.statusBar().showMessage("Duplicates aren't looked for (see indexing settings).")
+            return
+        path = self.mediaList.getPath(self.mediaListPosition)
+        others = self.duplicates.duplicates(path)
+        if not others:
+            self.statusBar().showMessage("No duplicate of this file was found.")
+            return
+        # The duplicates found after the current file come first
+        group = self.duplicates.groupOf[path]
+        index = group.index(path)
+        candidates = group[index + 1:] + group[:index]
+        positions = self.findPositions(set(candidates))
+        for candidate in candidates:
+            if candidate in positions:
+                self.statusBar().showMessage(f"Jumping to duplicate {candidate}.")
+                self.mediaListPosition = positions[candidate]
+                self.updateProgress()
+                self.updateCurrentMedia()
+                return
+        self.statusBar().showMessage(f"The duplicates of this file aren't in the list: {', '.join(others)}")
+
+    def showGallery(self, shown: bool):
+        """
+        Shows the gallery instead of the media viewer, or the other way around
+        """
+        for i in range(self.myWidget.count()):
+            widget = self.myWidget.widget(i)
+            if widget is not self.actionWidget and widget is not self.gallery:
+                widget.setVisible(not shown)
+        self.gallery.setVisible(shown)
+        if shown:
+            self.galleryModel.synchronize(self.mediaList)
+            self.gallery.setCurrentPosition(self.mediaListPosition)
+            self.gallery.setFocus()
+        else:
+            self.updateCurrentMedia()
+
+    def galleryCurrentChanged(self, current: QModelIndex, _previous: QModelIndex):
+        if self.galleryModel.updating:
+            return
+        if current.isValid() and current.row() != self.mediaListPosition and current.row() < len(self.mediaList):
+            self.mediaListPosition = current.row()
+            self.updateProgress()
+
+    def galleryActivated(self, index: QModelIndex):
+        """
+        Displays the media activated in the gallery (double-click or Enter)
+        """
+        self.mediaListPosition = index.row()
+        self.galleryAction.setChecked(False)
+        self.updateProgress()
+
+    def selectedPositions(self) -> list[int]:
+        """
+        Returns the positions of the media actions apply to: those selected in the gallery if it's shown, else the
+        current one
+        """
+        if self.gallery.isVisible():
+            self.galleryModel.synchronize(self.mediaList)
+            positions = self.gallery.selectedPositions()
+            if positions:
+                return positions
+        return [self.mediaListPosition]
+
+    def removeMedia(self, position: int) -> MediaEntry:
+        """
+        Removes a media from the list, the current media staying the same unless it's the one removed
+        """
+        entry = self.galleryModel.pop(self.mediaList, position)
+        if position < self.mediaListPosition:
+            self.mediaListPosition -= 1
+        return entry
+
+    def canMergeSorted(self) -> bool:
+        if not self.settings.autosort or self.settings.sort_method == SortMethod.none or self.sortWorker is not None:
+            return False
+        return len(self.mediaList) == 0 or self.sortedBy == self.settings.sort_method
+
+    @staticmethod
+    def repositionHistory(history: History, positions: dict[int, int]) -> History:
+        """
+        Returns the history with the positions of its entries replaced, entries being identified by their id
+        """
+        return collections.deque((hist._replace(position=positions[id(hist)]) if id(hist) in positions else hist
+                                  for hist in history), maxlen=history.maxlen)
+
+    def shiftPositions(self, insertedPositions: list[int]):
+        """
+        Updates the current position after entries were inserted in the sorted list.
+        Undo finds where entries go back by itself while the list is sorted
+        """
+        for inserted in insertedPositions:
+            if inserted <= self.mediaListPosition:
+                self.mediaListPosition += 1
+
+    def addNewUndo(self, action: HistoryEntry, operationId: int = None):
+        self.journal.do(action, operationId)
+        self.redoHistory.clear()
         self.redoAction.setEnabled(False)
         self.undoHistory.append(action)
-        self.undoAction.setEnabled(len(self.undoHistory) > 0)
-        if len(self.undoHistory) > self.settings.historyLength:
-            self.undoHistory.pop(0)
+        self.undoAction.setEnabled(True)
 
     def emptyUndoRedo(self):
-        self.undoHistory = []
-        self.redoHistory = []
+        self.undoHistory.clear()
+        self.redoHistory.clear()
         self.undoAction.setEnabled(False)
         self.redoAction.setEnabled(False)
 
+    def finishFileOperations(self):
+        """
+        Waits for the queued file operations, so that they're journaled and undone in the session they belong to.
+        Called before the media list or the session changes
+        """
+        if len(self.fileOperations) > 0:
+            self.statusBar().showMessage(f"Waiting for {len(self.fileOperations)} file operations to finish.")
+            self.fileOperations.waitForDone()
+
+    def startSession(self):
+        """
+        Starts a new history for the opened directory, journaled if enabled. The history of a resumed session
+        is restored, and its journal goes on
+        """
+        resumed, self.resumedSession = self.resumedSession, None
+        self.emptyUndoRedo()
+        if resumed is not None:
+            self.undoHistory.extend(resumed.undoHistory)
+            self.redoHistory.extend(resumed.redoHistory)
+            self.undoAction.setEnabled(len(self.undoHistory) > 0)
+            self.redoAction.setEnabled(len(self.redoHistory) > 0)
+        if not self.settings.fileOperations_journal:
+            self.journal.close()
+        elif resumed is not None:
+            self.journal.startSession(self.path, resumed.path, resumed.lastId)
+        else:
+            self.journal.startSession(self.path)
+
+    def recoverJournal(self):
+        """
+        Finishes or rolls back the file operations interrupted when the last session crashed
+        """
+        if not self.settings.fileOperations_journal:
+            return
+        journals = sessionJournals(self.journal.directory)
+        if not journals:
+            return
+        session = SessionJournal(journals[-1])
+        try:
+            session.read()
+            if session.ended or not session.unfinished:
+                return
+            done, rolledBack = session.reconcile()
+        except OSError as err:
+            logging.error("Unable to recover journal %s: %s", session.path, err)
+            return
+        logging.warning("Last session was interrupted: %s operations were done, %s rolled back", done, rolledBack)
+        self.statusBar().showMessage(f"Last session was interrupted: {done} file operations were done, "
+                                     f"{rolledBack} rolled back. It can be resumed from the File menu.")
+
+    def lastSession(self) -> SessionJournal | None:
+        """
+        Returns the last session but the current one, with its interrupted operations reconciled
+        """
+        journals = [path for path in sessionJournals(self.journal.directory)
+                    if self.journal.file is None or path != self.journal.path]
+        if not journals:
+            self.statusBar().showMessage("No previous session was journaled.")
+            return None
+        session = SessionJournal(journals[-1])
+        try:
+            session.read()
+            session.reconcile()
+        except OSError as err:
+            logging.error("Unable to read journal %s: %s", session.path, err)
+            self.statusBar().showMessage(f"Unable to read journal {session.path}: {err}")
+            return None
+        if session.root is None:
+            self.statusBar().showMessage(f"Journal {session.path} is empty.")
+            return None
+        return session
+
+    def restoreSession(self, rollback: bool = False, replay: bool = False) -> SessionJournal | None:
+        """
+        Opens the directory of the last session again with its history, once all its actions were undone (rollback)
+        or redone (replay) if asked. Files are moved before indexing, so that the list includes the files put back
+        """
+        session = self.lastSession()
+        if session is None:
+            return None
+        if rollback or replay:
+            history = collections.deque(session.undoHistory if rollback else session.redoHistory)
+            otherHistory = collections.deque(session.redoHistory if rollback else session.undoHistory)
+            records = []
+            while history:
+                _msg, _position, newAction = doHistory(history, otherHistory, [], 0)
+                records.append({"type": "undo" if rollback else "redo", "history": historyRecord(newAction)})
+            try:
+                writeRecords(session.path, records)
+            except OSError as err:
+                logging.error("Unable to write journal %s: %s", session.path, err)
+            session.undoHistory, session.redoHistory = ((list(otherHistory), []) if replay
+                                                        else ([], list(otherHistory)))
+        self.resumedSession = session
+        self.prepareMediaList(path=session.root)
+        return session
+
+    def resumeSession(self):
+        session = self.restoreSession()
+        if session is not None:
+            self.statusBar().showMessage(f"Resumed session of {session.root}: {len(self.undoHistory)} actions "
+                                         f"can be undone.")
+
+    def rollbackSession(self):
+        answer = QMessageBox.question(self, "Roll back last session",
+                                      "Undo all the file operations of the last session?")
+        if answer != QMessageBox.Yes:
+            return
+        session = self.restoreSession(rollback=True)
+        if session is not None:
+            self.statusBar().showMessage(f"Rolled back session of {session.root}: {len(self.redoHistory)} actions "
+                                         f"can be redone.")
+
+    def replaySession(self):
+        answer = QMessageBox.question(self, "Replay last session",
+                                      "Redo all the file operations undone in the last session?")
+        if answer != QMessageBox.Yes:
+            return
+        session = self.restoreSession(replay=True)
+        if session is not None:
+            self.statusBar().showMessage(f"Replayed session of {session.root}: {len(self.undoHistory)} actions "
+                                         f"can be undone.")
+
+    def resizeHistory(self):
+        """
+        Applies the history length setting, dropping the oldest entries if it was reduced
+        """
+        if self.undoHistory.maxlen != self.settings.historyLength:
+            self.undoHistory = collections.deque(self.undoHistory, maxlen=self.settings.historyLength)
+            self.redoHistory = collections.deque(self.redoHistory, maxlen=self.settings.historyLength)
+
+    def insertPosition(self, entry: MediaEntry) -> int:
+        """
+        Returns where undo puts an entry back, -1 if the list isn't sorted
+        """
+        if self.sortedBy is None:
+            return -1
+        return sortedPosition(self.mediaList, entry, self.sortedBy)
+
+    def stepHistory(self, undo: bool) -> str:
+        """
+        Undoes or redoes the last action, recording it in the journal
+        """
+        history, otherHistory = (self.undoHistory, self.redoHistory) if undo else (self.redoHistory, self.undoHistory)
+        if len(history) == 0:
+            return "no action"
+        msg, self.mediaListPosition, newAction = doHistory(history, otherHistory, self.mediaList,
+                                                           self.mediaListPosition, self.insertPosition)
+        if undo:
+            self.journal.undo(newAction)
+        else:
+            self.journal.redo(newAction)
+        return msg
+
     def undo(self):
-        msg, self.mediaListPosition = doHistory(self.settings.historyLength, self.undoHistory, self.redoHistory, self.mediaList, self.mediaListPosition)
+        msg = self.stepHistory(True)
         self.statusBar().showMessage(f"Undo: {msg}.")
         self.updateProgress()
         self.updateCurrentMedia()
@@ -265,7 +683,7 @@ class MainWindow(QMainWindow):
         self.redoAction.setEnabled(len(self.redoHistory) > 0)
 
     def redo(self):
-        msg, self.mediaListPosition = doHistory(self.settings.historyLength, self.redoHistory, self.undoHistory, self.mediaList, self.mediaListPosition)
+        msg = self.stepHistory(False)
         self.statusBar().showMessage(f"Redo: {msg}.")
         self.updateProgress()
         self.updateCurrentMedia()
@@ -291,8 +709,12 @@ class MainWindow(QMainWindow):
         rez = fileDialog.exec()
         if rez == 1:
             chosenFile = fileDialog.selectedFiles()[0]
-            with open(chosenFile, 'wb') as f:
-                pickle.dump((self.path, self.mediaList, self.mediaListPosition), f)
+            try:
+                IndexFile.saveIndex(chosenFile, self.path, self.mediaList, self.mediaListPosition)
+            except OSError as err:
+                logging.error("Unable to save directory index in %s: %s", chosenFile, err)
+                self.statusBar().showMessage(f"Unable to save directory index at {chosenFile}.")
+                return
             logging.info("Saved directory index in %s", chosenFile)
             self.statusBar().showMessage(f"Saved directory index at {chosenFile}.")
 
@@ -302,14 +724,74 @@ class MainWindow(QMainWindow):
         rez = fileDialog.exec()
         if rez == 1:
             chosenFile = fileDialog.selectedFiles()[0]
-            with open(chosenFile, 'rb') as f:
-                (self.path, self.mediaList, self.mediaListPosition) = pickle.load(f)
-            logging.info("Loaded directory index from %s", chosenFile)
-            self.statusBar().showMessage(f"Loaded directory index from {chosenFile}.")
+            try:
+                if IndexFile.isPickleIndex(chosenFile):
+                    convertedFile = IndexFile.convertedIndexPath(chosenFile)
+                    answer = QMessageBox.question(self, "Old directory index",
+                                                  "This directory index was saved by an older version, it must be "
+                                                  f"converted to be loaded. Convert it to {convertedFile}? "
+                                                  "The original index is kept.")
+                    if answer != QMessageBox.Yes:
+                        return
+                    IndexFile.convertPickleIndex(chosenFile, convertedFile)
+                    chosenFile = convertedFile
+                reader = IndexFile.IndexReader(chosenFile)
+                reader.open()
+                firstEntries = reader.read(INDEXFIRSTCHUNK)
+            except (OSError, IndexFile.IndexFileError) as err:
+                logging.error("Unable to load directory index from %s: %s", chosenFile, err)
+                self.statusBar().showMessage(f"Unable to load directory index from {chosenFile}: {err}")
+                return
+            self.finishFileOperations()
+            self.asyncIndexerTimer.stop()
+            if self.asyncIndexer.isRunning():
+                self.asyncIndexer.stopProcess()
+            self.stopDirIndexLoading()
+            self.path = reader.rootPath
+            self.mediaList = MediaList(firstEntries)
+            self.sortedBy = None
+            self.duplicates = None
             self.mediaListPosition = 0
+            self.startSession()
+            self.newMediaList()
+            self.indexedMedia(firstEntries)
+            self.isActive = len(self.mediaList) > 0
             self.updateCurrentMedia()
-            self.isActive = True
             self.updateProgress()
+            if reader.isFinished():
+                logging.info("Loaded directory index from %s", chosenFile)
+                self.statusBar().showMessage(f"Loaded directory index from {chosenFile}.")
+            else:
+                # The remaining entries are streamed, so that the first media is displayed right away
+                self.indexReader = reader
+                self.indexLoaderTimer.start(0)
+
+    def loadDirIndexStep(self):
+        try:
+            newEntries = self.indexReader.read(INDEXLOADCHUNK)
+        except (OSError, IndexFile.IndexFileError) as err:
+            logging.error("Directory index loading stopped: %s", err)
+            self.statusBar().showMessage(f"Directory index loading stopped: {err}")
+            self.stopDirIndexLoading()
+            return
+        self.mediaList += newEntries
+        self.indexedMedia(newEntries)
+        if not self.isActive and len(self.mediaList) > 0:
+            self.isActive = True
+            self.updateCurrentMedia()
+        self.updateProgress()
+        if self.indexReader.isFinished():
+            logging.info("Loaded directory index from %s", self.indexReader.path)
+            self.statusBar().showMessage(f"Loaded directory index from {self.indexReader.path}.")
+            self.stopDirIndexLoading()
+        else:
+            self.statusBar().showMessage(f"Loading directory index: {len(self.mediaList)}/{self.indexReader.count}.")
+
+    def stopDirIndexLoading(self):
+        self.indexLoaderTimer.stop()
+        if self.indexReader is not None:
+            self.indexReader.close()
+            self.indexReader = None
 
     def editSettings(self):
         dialog = SettingsDialog(self.settings, self)
@@ -317,10 +799,38 @@ class MainWindow(QMainWindow):
             logging.info("Saving new settings")
             self.statusBar().showMessage("Saving new settings")
             self.settings.save(self.size(), self.pos())
+            self.fileOperations.setPerDestination(self.settings.fileOperations_perDestination)
+            self.resizeHistory()
+            self.gallery.setThumbnailSize(self.settings.gallery_thumbnailSize)
+            if not self.settings.fileOperations_journal:
+                self.journal.close()
+            elif self.journal.root is None and self.isActive:
+                self.journal.startSession(self.path)
+            self.applySettings()
         else:
             logging.info("Cancelled, not saving settings")
             self.statusBar().showMessage("Cancelled, not saving settings")
 
+    def applySettings(self):
+        """
+        Called once settings were modified, for sorters to apply their own settings
+        """
+
+    def forgetMedia(self, path: str):
+        """
+        Called once a file was moved or deleted, for sorters to drop what they know about it
+        """
+
+    def newMediaList(self):
+        """
+        Called once the media list was replaced, for sorters to drop what they know about the previous one
+        """
+
+    def indexedMedia(self, entries: list[MediaEntry]):
+        """
+        Called once entries were added to the media list by indexing, for sorters to process them
+        """
+
     def chooseConfig(self):
         dialog = QFileDialog(self)
         dialog.setFileMode(QFileDialog.ExistingFile)
@@ -412,49 +922,101 @@ class MainWindow(QMainWindow):
 
     def actDelete(self):
         if self.isActive:
-            self.statusBar().showMessage(f"Deleting file {self.mediaList[self.mediaListPosition].path}.")
-            newUndo = fsUtils.deleteFile(self.mediaList[self.mediaListPosition].path)
-            if newUndo is not None:
-                newUndo.position = self.mediaListPosition
-                newUndo.entry = self.mediaList[self.mediaListPosition]
-                self.addNewUndo(newUndo)
-                self.mediaList.pop(self.mediaListPosition)
-                self.next(move=False)
+            positions = self.selectedPositions()
+            if len(positions) == 1:
+                self.statusBar().showMessage(f"Deleting file {self.mediaList[positions[0]].path}.")
             else:
-                self.statusBar().showMessage(f"Failed to delete file {self.mediaList[self.mediaListPosition].path}.")
+                self.statusBar().showMessage(f"Deleting {len(positions)} files.")
+            # From the last one, so that the positions of the other ones stay valid
+            for position in reversed(positions):
+                self.queueFileOperation(FileOperation("delete", self.mediaList[position], position,
+                                                      mediaList=self.mediaList))
+            self.next(move=False)
 
     def moveFile(self, newDirectory: str):
         if self.isActive:
-            self.statusBar().showMessage(f"Moving file to {newDirectory}.")
-            newUndo = fsUtils.moveFile(self.mediaList[self.mediaListPosition].path, newDirectory)
-            if newUndo is not None:
-                newUndo.position = self.mediaListPosition
-                newUndo.entry = self.mediaList[self.mediaListPosition]
-                self.addNewUndo(newUndo)
-                self.mediaList.pop(self.mediaListPosition)
-                self.next(move=False)
-            else:
-                self.statusBar().showMessage(f"Failed to move file to {newDirectory}.")
+            positions = self.selectedPositions()
+            files = "file" if len(positions) == 1 else f"{len(positions)} files"
+            self.statusBar().showMessage(f"Moving {files} to {newDirectory}.")
+            for position in reversed(positions):
+                self.queueFileOperation(FileOperation("move", self.mediaList[position], position, newDirectory,
+                                                      self.mediaList))
+            self.next(move=False)
 
     def copyFile(self, newDirectory: str):
         if self.isActive:
-            self.statusBar().showMessage(f"Copying file to {newDirectory}.")
-            newUndo = fsUtils.copyFile(self.mediaList[self.mediaListPosition].path, newDirectory)
-            if newUndo is not None:
-                newUndo.position = self.mediaListPosition
-                self.addNewUndo(newUndo)
-            else:
-                self.statusBar().showMessage(f"Failed to copy file to {newDirectory}.")
+            positions = self.selectedPositions()
+            files = "file" if len(positions) == 1 else f"{len(positions)} files"
+            self.statusBar().showMessage(f"Copying {files} to {newDirectory}.")
+            for position in positions:
+                self.queueFileOperation(FileOperation("copy", self.mediaList[position], position, newDirectory))
+
+    def queueFileOperation(self, operation: FileOperation):
+        """
+        Queues a file operation, the file leaving the list right away if it's moved or deleted.
+        Its undo entry is added once the operation is done
+        """
+        operation.id = self.journal.begin(operation.action, operation.entry.path, operation.destination,
+                                          operation.position)
+        self.fileOperations.enqueue(operation)
+        if operation.action != "copy":
+            self.forgetMedia(operation.entry.path)
+            self.removeMedia(operation.position)
+
+    def fileOperationFinished(self, operation: FileOperation):
+        if operation.action == "copy":
+            self.addNewUndo(operation.history._replace(position=operation.position), operation.id)
+        else:
+            self.addNewUndo(operation.history._replace(entry=operation.entry, position=operation.position),
+                            operation.id)
+        method = f" ({', '.join(operation.methods)})" if operation.methods else ""
+        logging.info("Done %s%s", operation.describe(), method)
+        # Only forgotten once done, so that the file stays among the duplicates if the operation fails
+        if operation.action != "copy" and self.duplicates is not None and operation.mediaList is self.mediaList:
+            self.duplicates.forget(operation.entry.path)
+        if len(self.fileOperations) == 0:
+            self.statusBar().showMessage(f"Done {operation.describe()}{method}.")
+
+    def fileOperationFailed(self, operation: FileOperation):
+        """
+        Puts a file whose operation failed back in the list
+        """
+        self.statusBar().showMessage(f"Failed {operation.describe()}: {operation.error}")
+        self.journal.failed(operation.id)
+        if operation.action == "copy" or operation.mediaList is not self.mediaList:
+            return
+        if self.sortedBy is not None:
+            position = sortedPosition(self.mediaList, operation.entry, self.sortedBy)
+        else:
+            position = -1
+        if position < 0:
+            position = min(operation.position, len(self.mediaList))
+        self.mediaList.insert(position, operation.entry)
+        # Forgotten when the operation was queued
+        self.indexedMedia([operation.entry])
+        if not self.isActive:
+            self.mediaListPosition = position
+            self.isActive = True
+            self.updateCurrentMedia()
+        elif self.sortedBy is not None:
+            self.shiftPositions([position])
+        elif position <= self.mediaListPosition:
+            # The displayed media stays the same
+            self.mediaListPosition += 1
+        self.updateProgress()
+
+    def updateFileOperationsLabel(self, pending: int):
+        self.fileOperationsLabel.setText(f"{pending} file operations pending" if pending else "")
 
     def hideFile(self):
         if self.isActive or self.nonexist:
-            self.statusBar().showMessage("Removing file from list.")
-            hist = HistoryEntry()
-            hist.action = "hide"
-            hist.entry = self.mediaList[self.mediaListPosition]
-            hist.position = self.mediaListPosition
-            self.addNewUndo(hist)
-            self.mediaList.pop(self.mediaListPosition)
+            positions = self.selectedPositions()
+            self.statusBar().showMessage("Removing file from list." if len(positions) == 1 else
+                                         f"Removing {len(positions)} files from list.")
+            # Undone from the first one, each one going back where it was
+            for position in reversed(positions):
+                self.addNewUndo(HistoryEntry("hide", self.mediaList[position], position))
+                self.removeMedia(position)
             self.next(move=False)
 
     def copyCurrentToClipboard(self):
@@ -468,8 +1030,16 @@ class MainWindow(QMainWindow):
         raise NotImplementedError()
 
     def updateProgress(self):
+        self.galleryModel.synchronize(self.mediaList)
+        if self.gallery.isVisible():
+            self.gallery.setCurrentPosition(self.mediaListPosition)
         if self.isActive:
-            self.progressionLabel.setText(f"{self.mediaListPosition + 1}/{len(self.mediaList)}")
+            progression = f"{self.mediaListPosition + 1}/{len(self.mediaList)}"
+            if self.duplicates is not None and self.mediaListPosition < len(self.mediaList):
+                duplicates = len(self.duplicates.duplicates(self.mediaList.getPath(self.mediaListPosition)))
+                if duplicates:
+                    progression += f" ({duplicates} duplicates)"
+            self.progressionLabel.setText(progression)
         else:
             self.progressionLabel.setText("0/0")
 
@@ -484,6 +1054,11 @@ class MainWindow(QMainWindow):
         self.actionsAvailable.resizeRowsToContents()
 
     def closeEvent(self, a0: QCloseEvent) -> None:
+        if self.sortWorker is not None:
+            self.sortWorker.wait()
+        self.finishFileOperations()
+        self.journal.close()
+        self.thumbnails.stop()
         self.settings.save(self.size(), self.pos())
         super().closeEvent(a0)
         a0.accept()
@@ -493,7 +1068,10 @@ class MainWindow(QMainWindow):
         eventKey = event.key()
         # logging.debug("mainWindow : Key pressed %s", eventKey)
         if eventKey == Qt.Key_Escape:
-            self.close()
+            if self.gallery.isVisible():
+                self.galleryAction.setChecked(False)
+            else:
+                self.close()
             event.accept()
         elif eventKey in self.settings.globalKeys:
             act = self.settings.globalKeys[eventKey]
@@ -511,6 +1089,10 @@ class MainWindow(QMainWindow):
                 self.copyCurrentToClipboard()
             elif act == "hide":
                 self.hideFile()
+            elif act == "duplicate":
+                self.nextDuplicate()
+            elif act == "gallery":
+                self.galleryAction.toggle()
             else:
                 logging.error("Unsupported action from settings (%s). This should never happen", act)
             event.accept()